@@ -0,0 +1,312 @@
+"""Switchable display and input backend for the experiments.
+
+The experiment code imports visual, core, event and calib from here instead
+of from psychopy. These are proxies that forward to whichever backend is
+active: psychopy itself (the default, imported the first time it is used)
+or a headless backend for running whole experiments without a display.
+
+The headless backend keeps a virtual clock that only moves when the
+experiment waits or flips a window (one frame per flip), so a run takes as
+long as its Python code does. Windows record every flip along with the
+stimuli drawn for it, and key presses come from a script of (time, key)
+pairs on the virtual clock.
+
+Example:
+
+    import backend
+    backend.use("headless", keys=[(0, "space")])
+    context_dmc.run_experiment(["-headless"])
+
+or, to keep the run's files and output out of the current directory:
+
+    with backend.headless_run(keys=[(0, "space")]):
+        context_dmc.run_experiment(["-headless"])
+
+"""
+from __future__ import division
+import os
+import os.path as op
+import sys
+import copy
+import types
+import shutil
+import tempfile
+from functools import partial
+from contextlib import contextmanager
+
+
+_active = [None]
+
+
+class _Proxy(object):
+    """Module stand-in that forwards to the active backend."""
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attr):
+        return getattr(current().modules[self._name], attr)
+
+    def __setattr__(self, attr, value):
+        setattr(current().modules[self._name], attr, value)
+
+
+visual = _Proxy("visual")
+core = _Proxy("core")
+event = _Proxy("event")
+calib = _Proxy("calib")
+
+
+def use(name, **kwargs):
+    """Switch to a backend by name ("psychopy" or "headless").
+
+    Keyword arguments go to the backend class. A backend object returned
+    by an earlier call can also be passed to switch back to it, and None
+    leaves no backend chosen (so the default is used). Returns the active
+    backend.
+
+    """
+    if name is None:
+        _active[0] = None
+    elif name == "psychopy":
+        _active[0] = PsychopyBackend(**kwargs)
+    elif name == "headless":
+        _active[0] = HeadlessBackend(**kwargs)
+    elif hasattr(name, "modules"):
+        _active[0] = name
+    else:
+        raise ValueError("Unknown backend: %s" % name)
+    return _active[0]
+
+
+def active():
+    """The active backend, or None if none has been used yet."""
+    return _active[0]
+
+
+def current():
+    """The active backend, starting psychopy if none has been chosen."""
+    if _active[0] is None:
+        use("psychopy")
+    return _active[0]
+
+
+@contextmanager
+def headless_run(data_dir=None, sched_dir="schedules", quiet=True,
+                 **kwargs):
+    """Context for running an experiment headless in a scratch directory.
+
+    The experiments read ./schedules and write to ./data, so the run
+    happens in a temporary directory with links to sched_dir and data_dir
+    (or an empty data directory if data_dir is None). Keyword arguments go
+    to HeadlessBackend, and the backend is yielded. The working directory,
+    output streams and previous backend are restored afterwards.
+
+    Parameters
+    ----------
+    data_dir: string, optional
+        directory the run's data files go to
+    sched_dir: string
+        directory with the event schedules
+    quiet: bool
+        discard what the run prints to stdout and stderr
+
+    """
+    sched_dir = op.abspath(sched_dir)
+    scratch = tempfile.mkdtemp()
+    orig_dir, orig_stdout, orig_stderr = os.getcwd(), sys.stdout, sys.stderr
+    previous = active()
+    devnull = open(os.devnull, "w") if quiet else None
+    try:
+        os.symlink(sched_dir, op.join(scratch, "schedules"))
+        if data_dir is None:
+            os.mkdir(op.join(scratch, "data"))
+        else:
+            os.symlink(op.abspath(data_dir), op.join(scratch, "data"))
+        os.chdir(scratch)
+        if quiet:
+            sys.stdout = sys.stderr = devnull
+        yield use("headless", **kwargs)
+    finally:
+        sys.stdout, sys.stderr = orig_stdout, orig_stderr
+        if devnull is not None:
+            devnull.close()
+        os.chdir(orig_dir)
+        shutil.rmtree(scratch)
+        use(previous)
+
+
+class PsychopyBackend(object):
+    """The real psychopy modules."""
+    name = "psychopy"
+
+    def __init__(self):
+        from psychopy import visual, core, event
+        import psychopy.monitors.calibTools as calib
+        self.modules = dict(visual=visual, core=core, event=event,
+                            calib=calib)
+
+
+class HeadlessBackend(object):
+    """Virtual clock, recording renderer and scripted keyboard."""
+    name = "headless"
+
+    def __init__(self, keys=(), refresh_hz=60, time_limit=4 * 3600,
+                 on_flip=None):
+        """Set up the backend.
+
+        Parameters
+        ----------
+        keys: sequence of (time, key) pairs
+            key presses that arrive at these times on the virtual clock
+        refresh_hz: float
+            refresh rate of the virtual display
+        time_limit: float
+            virtual seconds after which a run is stopped with an error
+            (so a wait for a key that never comes can't hang)
+        on_flip: callable, optional
+            called with the window after every flip, so key presses can
+            be scripted in response to what is on the screen
+
+        """
+        self.now = 0.
+        self.frame_dur = 1 / refresh_hz
+        self.time_limit = time_limit
+        self.on_flip = on_flip
+        self.pending = sorted(keys)
+        self.windows = []
+
+        core = types.ModuleType("core")
+        core.Clock = partial(_Clock, self)
+        core.wait = self.wait
+        core.getTime = lambda: self.now
+        core.quit = _quit
+
+        event = types.ModuleType("event")
+        event.getKeys = self.get_keys
+        event.clearEvents = self.clear_events
+
+        visual = types.ModuleType("visual")
+        visual.Window = partial(_Window, self)
+        visual.PatchStim = visual.GratingStim = _Stim
+        visual.TextStim = _Stim
+        visual.BufferImageStim = _BufferImage
+
+        calib = types.ModuleType("calib")
+        calib.Monitor = _Monitor
+        calib.monitorFolder = None
+
+        self.modules = dict(visual=visual, core=core, event=event,
+                            calib=calib)
+
+    def advance(self, secs):
+        """Move the virtual clock forward."""
+        self.now += max(secs, 0)
+        if self.now > self.time_limit:
+            raise RuntimeError("Headless run went past its time limit "
+                               "(%g s)" % self.time_limit)
+
+    def wait(self, secs, hogCPUperiod=None):
+        self.advance(secs)
+
+    def press(self, keys):
+        """Add (time, key) pairs to the key script."""
+        self.pending = sorted(self.pending + list(keys))
+
+    def get_keys(self, keyList=None, timeStamped=False):
+        """Return the scripted keys that have arrived, like event.getKeys.
+
+        As with psychopy, keys not in keyList stay in the buffer.
+
+        """
+        arrived, pending = [], []
+        for stamp, key in self.pending:
+            if stamp <= self.now and (keyList is None or key in keyList):
+                arrived.append((stamp, key))
+            else:
+                pending.append((stamp, key))
+        self.pending = pending
+        if not timeStamped:
+            return [key for _, key in arrived]
+        offset = 0 if timeStamped is True else \
+                 self.now - timeStamped.getTime()
+        return [(key, stamp - offset) for stamp, key in arrived]
+
+    def clear_events(self, eventType=None):
+        self.pending = [(t, k) for t, k in self.pending if t > self.now]
+
+
+class _Clock(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reset()
+
+    def reset(self):
+        self._start = self.backend.now
+
+    def getTime(self):
+        return self.backend.now - self._start
+
+
+def _quit():
+    raise SystemExit
+
+
+class _Window(object):
+    """Window that records the stimuli drawn before each flip."""
+    def __init__(self, backend, *args, **kwargs):
+        self.backend = backend
+        self.color = kwargs.get("color", (0, 0, 0))
+        self.size = kwargs.get("size", (800, 600))
+        self.frames = []
+        self.drawn = []
+        backend.windows.append(self)
+
+    @property
+    def n_flips(self):
+        return len(self.frames)
+
+    def flip(self, clearBuffer=True):
+        self.backend.advance(self.backend.frame_dur)
+        self.frames.append((self.backend.now, self.drawn))
+        if clearBuffer:
+            self.drawn = []
+        else:
+            self.drawn = list(self.drawn)
+        if self.backend.on_flip is not None:
+            self.backend.on_flip(self)
+
+    def clearBuffer(self):
+        self.drawn = []
+
+    def close(self):
+        pass
+
+
+class _Stim(object):
+
+    def __init__(self, win, *args, **kwargs):
+        self.win = win
+        self.__dict__.update(kwargs)
+
+    def draw(self, win=None):
+        (win or self.win).drawn.append(self)
+
+    def setColor(self, color):
+        self.color = color
+
+    def setOri(self, ori):
+        self.ori = ori
+
+
+class _BufferImage(_Stim):
+    """Image of stimuli as they were when it was made, like a screen grab."""
+    def __init__(self, win, stim=(), *args, **kwargs):
+        _Stim.__init__(self, win, *args, **kwargs)
+        self.stim = [copy.copy(s) for s in stim]
+
+
+class _Monitor(object):
+
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
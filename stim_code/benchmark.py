@@ -0,0 +1,333 @@
+"""Benchmarks for the schedule generation and trial loop hot paths.
+
+Each case is timed in its own forked process, which also gives a clean
+measurement of its peak memory. Cases that produce a schedule also report
+the first order counterbalancing cost of what they found, so optimizer
+changes can be checked for design quality as well as speed.
+
+Examples:
+
+    python benchmark.py -quick
+    python benchmark.py -save baseline.json
+    python benchmark.py -compare baseline.json -tolerance .25
+
+The trial loop case runs context_dmc.run_experiment on the headless
+backend, with a virtual clock so the waits take no time and the frame
+counting behaves as it would on a 60 Hz display.
+
+"""
+from __future__ import division
+import os.path as op
+import sys
+import json
+import argparse
+import platform
+import resource
+import warnings
+import multiprocessing
+from timeit import default_timer
+import numpy as np
+import backend
+import tools
+import design
+import make_schedule
+
+
+# Benchmark cases
+# ---------------
+# Each case function takes its parameters and returns a callable that runs
+# the code under test once and returns the achieved cost (or None).
+
+def schedule_cost(sched, n_cat):
+    """First order counterbalancing cost of a 0-based schedule."""
+    sched = np.asarray(sched)
+    ev_count = np.bincount(sched, minlength=n_cat)
+    mat = design.cb1_prob(sched + 1, ev_count)
+    return float(design.cb1_cost(design.cb1_ideal(ev_count), mat))
+
+
+def bench_make_schedule(n_cat, n_total):
+    rs = np.random.RandomState(0)
+    def run():
+        design.make_schedule(n_cat, n_total, 3, random_state=rs)
+    return run
+
+
+def bench_optimize_event_schedule(n_cat, n_total, n_search):
+    rs = np.random.RandomState(0)
+    def run():
+        sched = design.optimize_event_schedule(n_cat, n_total, 3, n_search,
+                                              random_state=rs)
+        return schedule_cost(sched, n_cat)
+    return run
+
+
+def bench_cb1_optimize(n_cat, n_total, n_search, method):
+    rs = np.random.RandomState(0)
+    ev_count = [n_total // n_cat] * n_cat
+    def run():
+        sched = design.cb1_optimize(ev_count, n_search, method=method,
+                                   random_state=rs)
+        return schedule_cost(np.asarray(sched) - 1, n_cat)
+    return run
+
+
+def bench_cb1_prob(n_cat, n_total):
+    rs = np.random.RandomState(0)
+    sched = rs.randint(n_cat, size=n_total)
+    ev_count = np.bincount(sched, minlength=n_cat)
+    def run():
+        design.cb1_prob(sched + 1, ev_count)
+    return run
+
+
+def bench_cb1_prob_batch(n_cat, n_total, n_search):
+    rs = np.random.RandomState(0)
+    scheds = rs.randint(n_cat, size=(n_search, n_total))
+    ev_count = [n_total // n_cat] * n_cat
+    kernel = design.CB1Kernel(ev_count, n_search)
+    def run():
+        kernel(scheds + 1)
+    return run
+
+
+def bench_run_length_loop(n_cat, n_total, n_search):
+    rs = np.random.RandomState(0)
+    scheds = rs.randint(n_cat, size=(n_search, n_total)).tolist()
+    def run():
+        [design.max_three_in_a_row(s) for s in scheds]
+    return run
+
+
+def bench_run_length_batch(n_cat, n_total, n_search):
+    rs = np.random.RandomState(0)
+    scheds = rs.randint(n_cat, size=(n_search, n_total))
+    def run():
+        design.run_length_ok(scheds, 3)
+    return run
+
+
+def bench_build_run_schedule(method):
+    p = tools.Params("context_dmc")
+    seeds = iter(xrange(10 ** 6))
+    def run():
+        df = make_schedule.build_run_schedule(p, 1, [0, 0, next(seeds)],
+                                              method)
+        events = (1 - df.context.values) * 2 + df.attend_cat.values
+        return schedule_cost(events, 4)
+    return run
+
+
+def bench_trial_loop(run):
+    """Run context_dmc.run_experiment headless in a scratch directory."""
+    import context_dmc
+
+    sched_dir = op.abspath("schedules")
+    def run_once():
+        # Press space to get past the instructions, then never respond
+        with backend.headless_run(sched_dir=sched_dir, keys=[(0, "space")]):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                context_dmc.run_experiment(["-run", str(run), "-headless"])
+    return run_once
+
+
+def grid(**axes):
+    """Expand a dict of parameter lists into a list of parameter dicts."""
+    keys = sorted(axes)
+    combos = [{}]
+    for key in keys:
+        combos = [dict(c, **{key: val}) for c in combos for val in axes[key]]
+    return combos
+
+
+def benchmark_cases(quick=False):
+    """Return (name, function, params, number) for each benchmark case.
+
+    number is how many calls go into each timing sample, so the fast
+    kernels are measured over enough work to be above timer resolution.
+
+    """
+    sizes = dict(n_cat=[4], n_total=[24]) if quick else \
+            dict(n_cat=[4, 8], n_total=[24, 96])
+    searches = [1000] if quick else [1000, 10000]
+
+    cases = []
+    for params in grid(**sizes):
+        cases.append(("make_schedule", bench_make_schedule, params, 100))
+        cases.append(("cb1_prob", bench_cb1_prob, params, 100))
+    for params in grid(n_search=searches, **sizes):
+        cases.append(("optimize_event_schedule",
+                      bench_optimize_event_schedule, params, 1))
+        cases.append(("cb1_prob_batch", bench_cb1_prob_batch, params, 1))
+        cases.append(("run_length_loop", bench_run_length_loop, params, 1))
+        cases.append(("run_length_batch", bench_run_length_batch, params, 1))
+    for params in grid(n_search=searches, method=["anneal", "brute"],
+                       **sizes):
+        cases.append(("cb1_optimize", bench_cb1_optimize, params, 1))
+    for method in ["search", "construct"]:
+        cases.append(("build_run_schedule", bench_build_run_schedule,
+                      dict(method=method), 1))
+    cases.append(("trial_loop", bench_trial_loop, dict(run=1), 1))
+    return cases
+
+
+# Running and comparing
+# ---------------------
+
+def case_key(name, params):
+    """Unique string identifying a case and its parameters."""
+    args = ",".join("%s=%s" % (k, params[k]) for k in sorted(params))
+    return "%s(%s)" % (name, args)
+
+
+def _measure(func, params, number, repeat, conn=None):
+    """Time a case and report its memory growth and achieved cost."""
+    try:
+        base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        run = func(**params)
+        times, cost = [], None
+        for i in xrange(repeat):
+            start = default_timer()
+            for j in xrange(number):
+                cost = run()
+            times.append((default_timer() - start) / number)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = dict(time_best=min(times),
+                      time_mean=sum(times) / len(times),
+                      peak_mb=(peak_rss - base_rss) / 1024,
+                      cost=cost)
+    except Exception as err:
+        result = dict(error="%s: %s" % (type(err).__name__, err))
+    if conn is None:
+        return result
+    conn.send(result)
+    conn.close()
+
+
+def run_case(func, params, number, repeat, fork=True):
+    """Run one case, in a child process unless fork is False."""
+    if not fork:
+        return _measure(func, params, number, repeat)
+    parent, child = multiprocessing.Pipe(duplex=False)
+    proc = multiprocessing.Process(target=_measure,
+                                   args=(func, params, number, repeat, child))
+    proc.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = dict(error="benchmark process died")
+    proc.join()
+    return result
+
+
+def compare(results, baseline, tolerance=.25, cost_tolerance=0):
+    """Return a list of (key, message) for regressions against a baseline.
+
+    Time and memory regress when they grow by more than tolerance as a
+    fraction of the baseline value. The achieved cost regresses when it
+    grows by more than cost_tolerance; with fixed seeds this catches any
+    change in what the optimizers find.
+
+    """
+    regressions = []
+    for key, res in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None or "error" in base:
+            continue
+        if "error" in res:
+            regressions.append((key, res["error"]))
+            continue
+        ratio = res["time_best"] / base["time_best"]
+        if ratio > 1 + tolerance:
+            regressions.append((key, "time %.2fx baseline" % ratio))
+        # Allow a little slack for allocator noise on small cases
+        if res["peak_mb"] > base["peak_mb"] * (1 + tolerance) + 1:
+            regressions.append((key, "peak memory %.1f MB (was %.1f MB)"
+                                     % (res["peak_mb"], base["peak_mb"])))
+        if res["cost"] is not None and base["cost"] is not None:
+            if res["cost"] > base["cost"] * (1 + cost_tolerance) + 1e-12:
+                regressions.append((key, "cost %.4g (was %.4g)"
+                                         % (res["cost"], base["cost"])))
+    return regressions
+
+
+def format_row(key, res, base=None):
+    """One line of the results table."""
+    if "error" in res:
+        return "%-60s ERROR %s" % (key, res["error"])
+    cost = "" if res["cost"] is None else "%.4f" % res["cost"]
+    row = "%-60s %10.3f ms %8.1f MB %8s" % (key, res["time_best"] * 1000,
+                                            res["peak_mb"], cost)
+    if base is not None and "error" not in base:
+        row += "  (%.2fx)" % (res["time_best"] / base["time_best"])
+    return row
+
+
+def main(arglist):
+
+    args = parse_args(arglist)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fid:
+            baseline = json.load(fid)["results"]
+
+    results = {}
+    for name, func, params, number in benchmark_cases(args.quick):
+        key = case_key(name, params)
+        if args.filter and not any(f in key for f in args.filter):
+            continue
+        res = run_case(func, params, number, args.repeat, not args.no_fork)
+        results[key] = res
+        base = None if baseline is None else baseline.get(key)
+        print format_row(key, res, base)
+        sys.stdout.flush()
+
+    if args.save is not None:
+        info = dict(python=platform.python_version(),
+                    numpy=np.__version__,
+                    machine=platform.machine(),
+                    node=platform.node())
+        with open(args.save, "w") as fid:
+            json.dump(dict(info=info, results=results), fid,
+                      sort_keys=True, indent=1)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance,
+                              args.cost_tolerance)
+        for key, msg in regressions:
+            print "REGRESSION %s: %s" % (key, msg)
+        if regressions:
+            return 1
+        print "No regressions against %s" % args.compare
+
+
+def parse_args(arglist):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-quick", action="store_true",
+                        help="only run the smallest size of each case")
+    parser.add_argument("-filter", nargs="*",
+                        help="only run cases whose name contains one of "
+                             "these strings")
+    parser.add_argument("-repeat", type=int, default=3,
+                        help="timing samples per case (best is reported)")
+    parser.add_argument("-save", help="write the results to this json file")
+    parser.add_argument("-compare",
+                        help="flag regressions against this json baseline")
+    parser.add_argument("-tolerance", type=float, default=.25,
+                        help="fractional slowdown or memory growth that "
+                             "counts as a regression")
+    parser.add_argument("-cost_tolerance", type=float, default=0,
+                        help="fractional growth in achieved cost that "
+                             "counts as a regression")
+    parser.add_argument("-no_fork", action="store_true",
+                        help="run cases in this process (memory numbers then "
+                             "include earlier cases)")
+    return parser.parse_args(arglist)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
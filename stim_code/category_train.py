@@ -3,9 +3,9 @@ import sys
 from textwrap import dedent
 import numpy as np
 from numpy.random import randint
-from psychopy import visual, core, event
-import psychopy.monitors.calibTools as calib
+import backend
 import tools
+from backend import visual, core, calib
 from tools import draw_all, wait_check_quit
 
 
@@ -15,6 +15,13 @@ def run_experiment(arglist):
     p = tools.Params("category_train")
     p.set_by_cmdline(arglist)
 
+    # Possibly run on a virtual clock, by default getting through the
+    # instructions and then answering every trial correctly
+    default_headless = p.headless and not isinstance(backend.active(),
+                                                     backend.HeadlessBackend)
+    if default_headless:
+        backend.use("headless", keys=[(0, "space")])
+
     # Open up the stimulus window
     calib.monitorFolder = "./calib"
     mon = calib.Monitor(p.monitor_name)
@@ -42,10 +49,17 @@ def run_experiment(arglist):
     wrong = [wrong_patch, fix]
     feedback = [wrong, right]
 
+    # Render every color and orientation combination ahead of time
+    atlas = tools.StimulusAtlas(win, stims, color, grate, p.cat_colors,
+                                p.cat_orients, p.stim_size * m.pix_per_deg)
+    atlas.warm_up()
+
     # Set up the cue stimuli
     color_text = visual.TextStim(win, text="color")
     orient_text = visual.TextStim(win, text="orient")
     cue_stims = dict(color=color_text, orient=orient_text)
+    if default_headless:
+        backend.current().on_flip = headless_responder(p, atlas, cue_stims)
 
     # Draw the instructions and wait to go
     instruct = dedent("""
@@ -57,7 +71,11 @@ def run_experiment(arglist):
     Green feedback means correct, red means incorrect.
     """)
 
-    tools.WaitText(win, instruct, height=.7)(check_keys=["space"])
+    # Keys are timestamped as they are polled
+    poller = tools.InputPoller(p.quit_keys)
+
+    tools.WaitText(win, instruct, height=.7)(check_keys=["space"],
+                                             poller=poller)
 
     # TODO this?
     # Start a data file and write the params to it
@@ -88,12 +106,12 @@ def run_experiment(arglist):
             # Context cue
             cue_stims[context].draw()
             win.flip()
-            wait_check_quit(p.cue_dur, p.quit_keys)
+            wait_check_quit(p.cue_dur, poller=poller)
 
             # Prestim fix
             fix.draw()
             win.flip()
-            wait_check_quit(p.isi)
+            wait_check_quit(p.isi, poller=poller)
 
             # Iterate through the block
             for t in range(p.n_per_block):
@@ -105,36 +123,33 @@ def run_experiment(arglist):
                 i_exemplar = randint(3)
 
                 if context == "color":
-                    col = p.cat_colors[a_category][a_exemplar]
-                    ori = p.cat_orients[i_category][i_exemplar]
+                    col = a_category, a_exemplar
+                    ori = i_category, i_exemplar
                 else:
-                    col = p.cat_colors[i_category][i_exemplar]
-                    ori = p.cat_orients[a_category][a_exemplar]
-
-                color.setColor(col)
-                grate.setOri(ori)
+                    col = i_category, i_exemplar
+                    ori = a_category, a_exemplar
 
                 # Draw the stimulus
-                draw_all(*stims)
+                atlas.get(col, ori).draw()
                 win.flip()
                 core.wait(p.stim_dur)
 
                 # Draw the resp fix and wait
                 r_fix.draw()
                 win.flip()
-                response = wait_for_response(p)
+                response = wait_for_response(p, poller)
                 correct = int(response == a_category)
                 acc_arrays[context][t] = correct
 
                 # Draw the feedback
                 draw_all(*feedback[correct])
                 win.flip()
-                wait_check_quit(p.feedback_dur)
+                wait_check_quit(p.feedback_dur, poller=poller)
 
                 # Draw the ISI fix
                 fix.draw()
                 win.flip()
-                wait_check_quit(p.isi)
+                wait_check_quit(p.isi, poller=poller)
 
             if acc_arrays[context].mean() >= p.acc_threshold:
                 context_done[context] += 1
@@ -148,6 +163,7 @@ def run_experiment(arglist):
             trained = all(is_trained.values())
 
     finally:
+        poller.stop()
         #f.close()
         win.close()
 
@@ -157,12 +173,12 @@ def run_experiment(arglist):
     print "Total orient blocks: %d" % train_blocks["orient"]
 
 
-def wait_for_response(p):
+def wait_for_response(p, poller):
     """Get response info specific to this experiment."""
     listen_keys = p.resp_keys + list(p.quit_keys)
     response = None
     while response is None:
-        for key in event.getKeys(keyList=listen_keys):
+        for key, _ in poller.wait_keys(listen_keys):
             if key in p.quit_keys:
                 core.quit()
             elif key == p.cat_one_key:
@@ -173,5 +189,33 @@ def wait_for_response(p):
                 break
     return response
 
+
+def headless_responder(p, atlas, cue_stims, rt=None):
+    """Make a headless on_flip hook that answers every trial correctly.
+
+    The hook follows the context from the cue on the screen and presses
+    the key for the attended category of each atlas image rt seconds
+    after it appears (by default .3 s into the response period).
+
+    """
+    if rt is None:
+        rt = p.stim_dur + .3
+    cues = dict((id(stim), context) for context, stim in cue_stims.items())
+    images = dict((id(image), key) for key, image in atlas.images.items())
+    resp_keys = [p.cat_one_key, p.cat_two_key]
+    context = [None]
+
+    def on_flip(win):
+        flip_time, drawn = win.frames[-1]
+        for stim in drawn:
+            if id(stim) in cues:
+                context[0] = cues[id(stim)]
+            elif id(stim) in images:
+                color_key, orient_key = images[id(stim)]
+                attended = color_key if context[0] == "color" else orient_key
+                win.backend.press([(flip_time + rt, resp_keys[attended[0]])])
+
+    return on_flip
+
 if __name__ == "__main__":
     run_experiment(sys.argv[1:])
@@ -1,14 +1,13 @@
 from __future__ import division
 import sys
 import os.path as op
+import traceback
 from textwrap import dedent
-from numpy.random import randint
-from psychopy import visual, core, event
-import psychopy.monitors.calibTools as calib
-from matplotlib.mlab import csv2rec
-import pandas
+import numpy as np
+import backend
 import tools
-from tools import draw_all, check_quit, wait_check_quit
+from backend import visual, core, calib
+from trial_data import AsyncWriter, TrialWriter
 
 
 def run_experiment(arglist):
@@ -17,12 +16,22 @@ def run_experiment(arglist):
     p = tools.Params("context_dmc")
     p.set_by_cmdline(arglist)
 
+    # Possibly run on a virtual clock, by default just getting through
+    # the instructions and the scanner trigger
+    if p.headless and not isinstance(backend.active(),
+                                     backend.HeadlessBackend):
+        backend.use("headless", keys=[(0, "space"), (5, "5")])
+
     # Open up the stimulus window
     calib.monitorFolder = "./calib"
     mon = calib.Monitor(p.monitor_name)
     m = tools.WindowInfo(p, mon)
     win = visual.Window(**m.window_kwargs)
 
+    # Record every flip and check the real refresh rate
+    timer = tools.FlipTimer(win, m.refresh_hz)
+    timer.measure_refresh()
+
     # Set up the stimulus objects
     fix = visual.PatchStim(win, tex=None, mask="circle",
                        color=p.fix_color, size=p.fix_size)
@@ -36,17 +45,23 @@ def run_experiment(arglist):
                             color=win.color, size=p.stim_size / 6)
     stims = [grate, color, disk, fix]
 
+    # Render every color and orientation combination ahead of time
+    atlas = tools.StimulusAtlas(win, stims, color, grate, p.cat_colors,
+                                p.cat_orients, p.stim_size * m.pix_per_deg)
+    atlas.warm_up()
+
     # Set up the cue stimuli
     color_text = visual.TextStim(win, text="color")
     orient_text = visual.TextStim(win, text="orient")
     cue_stims = dict(color=color_text, orient=orient_text)
 
-    # Get the schedule for this run
-    sched_file = "schedules/run_%02d.csv" % p.run
-    s = pandas.read_csv(sched_file)
+    # Get the schedule for this run and work out every trial in advance
+    import pandas
+    s = pandas.read_csv(schedule_file(p.subject, p.run))
+    plan = compile_trial_plan(p, s)
 
-    # Convenience map
-    context_map = ["color", "orient"]
+    # Keys are timestamped as they are polled, which happens every frame
+    poller = tools.InputPoller(p.quit_keys)
 
     # Draw the instructions and wait to go
     instruct = dedent("""
@@ -56,203 +71,334 @@ def run_experiment(arglist):
     1 = match                          2 = nonmatch
 
     Experimenter: press space to begin""")
-    tools.WaitText(win, instruct, height=.7)(check_keys=["space"])
+    tools.WaitText(win, instruct, height=.7)(check_keys=["space"],
+                                             poller=poller)
 
     # Possibly wait for the scanner
     if p.fmri:
-        tools.wait_for_trigger(win, p)
+        tools.wait_for_trigger(win, p, poller)
+
+    # All data file writing happens on a background thread
+    io = AsyncWriter()
 
     # Start a data file and write the params to it
     f, fname = tools.start_data_file(p.subject, p.experiment_name, p.run)
-    p.to_text_header(f)
+    io.call(p.to_text_header, f)
 
     # Save the params to json
     save_name = op.join("./data", op.splitext(fname)[0])
-    p.to_json(save_name)
-
-    # Write the datafile header
-    header = ["trial", "context", "match",
-              "samp_color", "samp_orient",
-              "samp_color_cat", "samp_orient_cat",
-              "targ_color", "targ_orient",
-              "targ_color_cat", "targ_orient_cat",
-              "cue_time", "block_time",
-              "psi_time", "isi_time", "iti_time",
-              "response", "rt", "acc"]
-    tools.save_data(f, *header)
-
-    # Start a clock and flush the event buffer
-    total_time = 0
-    exp_clock = core.Clock()
-    trial_clock = core.Clock()
-    block_clock = core.Clock()
-    event.clearEvents()
+    io.call(p.to_json, save_name)
+
+    # Save the trial plan, including the target choices
+    io.call(np.save, save_name + "_plan.npy", plan)
+
+    # Set up the trial data writer with the datafile schema
+    schema = [("trial", int), ("context", "S6"), ("match", int),
+              ("samp_color", int), ("samp_orient", int),
+              ("samp_color_cat", int), ("samp_orient_cat", int),
+              ("targ_color", int), ("targ_orient", int),
+              ("targ_color_cat", int), ("targ_orient_cat", int),
+              ("cue_time", float), ("block_time", float),
+              ("psi_time", float), ("isi_time", float), ("iti_time", float),
+              ("response", int), ("rt", float), ("acc", int)]
+    writer = TrialWriter(f, schema, buffer_size=len(plan), writer=io)
+
+    # Log the frame timing of each trial next to the behavioral data
+    frames_f = open(op.join("data", op.splitext(fname)[0] + "_frames.csv"),
+                    "w")
+    frame_header = ["trial", "n_intervals", "dropped", "mean_interval",
+                    "jitter", "max_interval", "onset_error"]
+    io.write(frames_f, ",".join(frame_header) + "\n")
+
+    # Keep running performance statistics as trials come in
+    perf = tools.PerformanceTracker()
+
+    # Every phase is shown against a deadline relative to the run start
+    timeline = tools.Timeline(timer)
+
+    def check_quit_keys(frame):
+        poller.check_quit()
+
+    # Time responses from the onset of the response cue
+    resp_onset = [0]
+
+    def start_response():
+        resp_onset[0] = timer.last_flip
+        poller.clear()
 
     # Main experiment loop
     # --------------------
+    finished = False
     try:
 
         # Dummy scans
-        fix.draw()
-        win.flip()
-        dummy_secs = p.dummy_trs * p.tr
-        total_time += dummy_secs
-        wait_check_quit(dummy_secs, p.quit_keys)
-
-        for t in s.trial:
-
-            # Get this trial's context
-            context = context_map[s.context[t]]
-
-            # Get this trial's timing info
-            psi_secs = s.psi_tr[t] * p.tr
-            isi_secs = p.stim_sfix_dur + (s.isi_tr[t] * p.tr)
-            iti_secs = s.iti_tr[t] * p.tr
-            block_time = (p.cue_dur + psi_secs +
-                          p.stim_samp_dur + isi_secs +
-                          p.stim_targ_dur + p.resp_dur + iti_secs)
-            total_time += block_time
+        timeline.present("dummy", fix.draw, 0, plan["cue_onset"][0],
+                         every_frame=check_quit_keys)
+
+        for trial in plan:
+
+            t = trial["trial"]
+            trial_flips = timer.n_flips
+            trial_phases = len(timeline.onsets)
 
             # Cue period
-            cue_stims[context].draw()
-            win.flip()
-            cue_time = exp_clock.getTime()
-            block_clock.reset()
-            core.wait(p.cue_dur)
+            cue = cue_stims[trial["context"]]
+            cue_time = timeline.present("cue", cue.draw,
+                                        trial["cue_onset"], p.cue_dur,
+                                        every_frame=check_quit_keys)
 
             # Pre-stim fixation (PSI)
-            fix.draw()
-            win.flip()
-            wait_check_quit(psi_secs, p.quit_keys)
+            timeline.present("psi", fix.draw, trial["psi_onset"],
+                             trial["psi_secs"], every_frame=check_quit_keys)
 
             # Sample stimulus
-            a_cat = s.attend_cat[t]
-            a_exemp = s.attend_exemp[t]
-
-            i_cat = s.ignore_cat[t]
-            i_exemp = s.ignore_exemp[t]
-
-            c_cat = a_cat if context == "color" else i_cat
-            o_cat = a_cat if context == "orient" else i_cat
-            c_exemp = a_exemp if context == "color" else i_exemp
-            o_exemp = a_exemp if context == "orient" else i_exemp
-
-            if context == "color":
-                samp_color = p.cat_colors[a_cat][a_exemp]
-                samp_orient = p.cat_orients[i_cat][i_exemp]
-            else:
-                samp_color = p.cat_colors[i_cat][i_exemp]
-                samp_orient = p.cat_orients[a_cat][a_exemp]
-
-            color.setColor(samp_color)
-            grate.setOri(samp_orient)
-
-            draw_all(*stims)
-            win.flip()
-            core.wait(p.stim_samp_dur)
+            samp_color = trial["samp_color_cat"], trial["samp_color_exemp"]
+            samp_orient = trial["samp_orient_cat"], trial["samp_orient_exemp"]
+            sample = atlas.get(samp_color, samp_orient)
+            timeline.present("sample", sample.draw,
+                             trial["samp_onset"], p.stim_samp_dur,
+                             every_frame=check_quit_keys)
 
             # Post stim fix and ISI
-            fix.draw()
-            win.flip()
-            wait_check_quit(isi_secs, p.quit_keys)
+            timeline.present("isi", fix.draw, trial["isi_onset"],
+                             trial["isi_secs"], every_frame=check_quit_keys)
 
             # Target stimulus
-            match = s.match[t]
-            idx2 = randint(2)
-            idx3 = randint(3)
-            if match:
-                if context == "color":
-                    t_c_cat = a_cat
-                    t_o_cat = idx2
-                elif context == "orient":
-                    t_c_cat = idx2
-                    t_o_cat = a_cat
-            else:
-                if context == "color":
-                    t_c_cat = int(not a_cat)
-                    t_o_cat = idx2
-                elif context == "orient":
-                    t_c_cat = idx2
-                    t_o_cat = int(not a_cat)
-            t_c_exemp, t_o_exemp = idx3, idx3
-            targ_color = p.cat_colors[t_c_cat][t_c_exemp]
-            targ_orient = p.cat_orients[t_o_cat][t_o_exemp]
-
-            color.setColor(targ_color)
-            grate.setOri(targ_orient)
-
-            draw_all(*stims)
-            win.flip()
-            core.wait(p.stim_targ_dur)
+            targ_color = trial["targ_color_cat"], trial["targ_color_exemp"]
+            targ_orient = trial["targ_orient_cat"], trial["targ_orient_exemp"]
+            target = atlas.get(targ_color, targ_orient)
+            timeline.present("target", target.draw,
+                             trial["targ_onset"], p.stim_targ_dur,
+                             every_frame=check_quit_keys)
 
             # Response
-            r_fix.draw()
-            trial_clock.reset()
-            event.clearEvents()
-            win.flip()
-            core.wait(p.resp_dur)
+            timeline.present("response", r_fix.draw, trial["resp_onset"],
+                             p.resp_dur, on_onset=start_response,
+                             every_frame=check_quit_keys)
 
             # Collect the response
-            corr, resp, resp_rt = collect_response(p, trial_clock, match)
+            match = trial["match"]
+            corr, resp, resp_rt = collect_response(p, poller.get_keys(),
+                                                   resp_onset[0], match)
 
             # ITI interval
-            # Go by screen refreshes for precise timing
-            iti_time = total_time - exp_clock.getTime()
-            iti_frames = int(iti_time * 60) # 60 Hz monitor
-            for frame in xrange(iti_frames):
-                fix.draw()
-                win.flip()
+            timeline.present("iti", fix.draw, trial["iti_onset"],
+                             trial["iti_secs"], every_frame=check_quit_keys)
+
+            # Check the frame timing
+            frames = timer.frame_stats(trial_flips)
+            errors = timeline.onset_errors(trial_phases)
+            onset_error = errors[np.argmax(np.abs(errors))]
+            if abs(onset_error) > timer.frame_dur:
+                print >> sys.stderr, ("Warning: trial %d onsets were off by "
+                                      "up to %.3f s" % (t, onset_error))
+            if frames["dropped"]:
+                print >> sys.stderr, ("Warning: trial %d dropped %d frames"
+                                      % (t, frames["dropped"]))
+            f_data = [t] + [frames[k] for k in frame_header[1:-1]]
+            io.write(frames_f, ",".join(map(str, f_data + [onset_error])) +
+                     "\n")
 
             # Possibly check for late response
             if resp == -1:
-                corr, resp, resp_rt = collect_response(p, trial_clock, match)
+                corr, resp, resp_rt = collect_response(p, poller.get_keys(),
+                                                       resp_onset[0], match)
             else:
-                check_quit()
+                poller.check_quit()
 
             # Write out the trial data
-            t_data = [t, context, match,
-                      c_exemp, o_exemp,
-                      c_cat, o_cat,
-                      t_c_exemp, t_o_exemp,
-                      t_c_cat, t_o_cat,
-                      cue_time, block_time,
-                      psi_secs, isi_secs, iti_secs,
+            t_data = [t, trial["context"], match,
+                      trial["samp_color_exemp"], trial["samp_orient_exemp"],
+                      trial["samp_color_cat"], trial["samp_orient_cat"],
+                      trial["targ_color_exemp"], trial["targ_orient_exemp"],
+                      trial["targ_color_cat"], trial["targ_orient_cat"],
+                      cue_time, trial["block_time"],
+                      trial["psi_secs"], trial["isi_secs"], trial["iti_secs"],
                       resp, resp_rt, corr]
-            tools.save_data(f, *t_data)
+            writer.write(*t_data)
+            writer.flush()
+            perf.update(trial["context"], match, resp, resp_rt, corr)
+        finished = True
 
     finally:
-        # Clean up
-        f.close()
+        # Log every key press relative to the start of the run
+        poller.stop()
+        keys_f = open(op.join("data", op.splitext(fname)[0] + "_keys.csv"),
+                      "w")
+        run_start = timeline.start if timeline.start is not None else 0
+        key_lines = ["%s,%.6f" % (key, stamp - run_start)
+                     for key, stamp in poller.log]
+        io.write(keys_f, "\n".join(["key,time"] + key_lines) + "\n")
+        io.close_file(keys_f)
+
+        # Clean up, waiting until the data are safely on disk. If the run
+        # stopped early, an error saving the data shouldn't replace the
+        # one that stopped it
+        writer.close()
+        io.close_file(frames_f)
         win.close()
-
-    # Calculate some performance data and print it to the screen
-    data = csv2rec(op.join("data", fname))
-    accuracy = data["acc"].mean()
-    rt = data["rt"][data["rt"] > 0].mean()
-    missed = (data["response"] == -1).sum()
-
+        try:
+            io.close()
+        except Exception:
+            if finished:
+                raise
+            print >> sys.stderr, "Error saving the data:"
+            traceback.print_exc()
+
+    # Print some performance data to the screen
     print "Run: %d" % p.run
-    print "Accuracy: %.2f" % accuracy
-    print "Mean RT: %.4f" % rt
-    print "Missed responses: %d" % missed
-
-
-def collect_response(p, clock, match):
-    """Get response info specific to this experiment."""
-    keys = event.getKeys(timeStamped=clock)
+    print "Accuracy: %.2f" % perf.accuracy()
+    print "  color: %.2f  orient: %.2f" % (perf.accuracy("color"),
+                                            perf.accuracy("orient"))
+    print "  match: %.2f  nonmatch: %.2f" % (perf.accuracy(match=1),
+                                              perf.accuracy(match=0))
+    print "Mean RT: %.4f (SD %.4f)" % (perf.rt.mean, perf.rt.std)
+    print "Missed responses: %d" % perf.n_missed
+
+    if p.debug:
+        stats = io.stats()
+        print "Writer jobs: %d (%d stalls, max queue depth %d)" % (
+            stats["n_jobs"], stats["n_stalls"], stats["max_depth"])
+        print "Writer latency: %.2f ms mean, %.2f ms max" % (
+            stats["mean_latency"] * 1000, stats["max_latency"] * 1000)
+
+
+def schedule_file(subject, run, sched_dir="schedules"):
+    """Find the event schedule for a run.
+
+    make_schedule.py can write a set of schedules for each subject under
+    <sched_dir>/<subject>; when there isn't one for this subject the shared
+    set in sched_dir is used.
+
+    """
+    fname = "run_%02d.csv" % run
+    subj_file = op.join(sched_dir, subject, fname)
+    if op.exists(subj_file):
+        return subj_file
+    return op.join(sched_dir, fname)
+
+
+def compile_trial_plan(p, s, random_state=None):
+    """Resolve everything about each trial before the run starts.
+
+    Parameters
+    ----------
+    p: Params
+        experiment parameters
+    s: DataFrame
+        event schedule for the run (see make_schedule.py)
+    random_state: RandomState, optional
+        source of the random target choices, defaults to the global
+        numpy state
+
+    Returns a structured array with a record for each trial holding its
+    context, stimulus features, target choice, durations and the planned
+    onsets of its phases (in seconds from the start of the dummy scans).
+
+    """
+    if random_state is None:
+        random_state = np.random
+    n_trials = len(s)
+    cat_colors = np.array(p.cat_colors, float)
+    cat_orients = np.array(p.cat_orients, float)
+
+    plan = np.zeros(n_trials, [("trial", int), ("context", "S6"),
+                               ("match", int),
+                               ("samp_color_cat", int),
+                               ("samp_orient_cat", int),
+                               ("samp_color_exemp", int),
+                               ("samp_orient_exemp", int),
+                               ("targ_color_cat", int),
+                               ("targ_orient_cat", int),
+                               ("targ_color_exemp", int),
+                               ("targ_orient_exemp", int),
+                               ("samp_color", float, 3),
+                               ("samp_orient", float),
+                               ("targ_color", float, 3),
+                               ("targ_orient", float),
+                               ("psi_secs", float), ("isi_secs", float),
+                               ("iti_secs", float), ("block_time", float),
+                               ("cue_onset", float), ("psi_onset", float),
+                               ("samp_onset", float), ("isi_onset", float),
+                               ("targ_onset", float), ("resp_onset", float),
+                               ("iti_onset", float)])
+    plan["trial"] = s.trial if "trial" in s else np.arange(n_trials)
+    plan["match"] = s.match
+
+    # Sort the attended and ignored features onto the two dimensions
+    is_color = s.context.values == 0
+    plan["context"] = np.where(is_color, "color", "orient")
+    a_cat, a_exemp = s.attend_cat.values, s.attend_exemp.values
+    i_cat, i_exemp = s.ignore_cat.values, s.ignore_exemp.values
+    plan["samp_color_cat"] = np.where(is_color, a_cat, i_cat)
+    plan["samp_orient_cat"] = np.where(is_color, i_cat, a_cat)
+    plan["samp_color_exemp"] = np.where(is_color, a_exemp, i_exemp)
+    plan["samp_orient_exemp"] = np.where(is_color, i_exemp, a_exemp)
+
+    # The target matches (or not) on the relevant dimension and is random
+    # on the other, with one exemplar position for both features
+    rel_cat = np.where(s.match.values, a_cat, 1 - a_cat)
+    irrel_cat = random_state.randint(2, size=n_trials)
+    exemp = random_state.randint(3, size=n_trials)
+    plan["targ_color_cat"] = np.where(is_color, rel_cat, irrel_cat)
+    plan["targ_orient_cat"] = np.where(is_color, irrel_cat, rel_cat)
+    plan["targ_color_exemp"] = exemp
+    plan["targ_orient_exemp"] = exemp
+
+    # Look up the stimulus features
+    plan["samp_color"] = cat_colors[plan["samp_color_cat"],
+                                    plan["samp_color_exemp"]]
+    plan["samp_orient"] = cat_orients[plan["samp_orient_cat"],
+                                      plan["samp_orient_exemp"]]
+    plan["targ_color"] = cat_colors[plan["targ_color_cat"],
+                                    plan["targ_color_exemp"]]
+    plan["targ_orient"] = cat_orients[plan["targ_orient_cat"],
+                                      plan["targ_orient_exemp"]]
+
+    # Work out the timing of each phase
+    plan["psi_secs"] = s.psi_tr * p.tr
+    plan["isi_secs"] = p.stim_sfix_dur + s.isi_tr * p.tr
+    plan["iti_secs"] = s.iti_tr * p.tr
+    durations = [("cue_onset", p.cue_dur),
+                 ("psi_onset", plan["psi_secs"]),
+                 ("samp_onset", p.stim_samp_dur),
+                 ("isi_onset", plan["isi_secs"]),
+                 ("targ_onset", p.stim_targ_dur),
+                 ("resp_onset", p.resp_dur),
+                 ("iti_onset", plan["iti_secs"])]
+    plan["block_time"] = sum(dur for _, dur in durations)
+    block_start = np.cumsum(plan["block_time"]) - plan["block_time"]
+    onset = p.dummy_trs * p.tr + block_start
+    for phase, dur in durations:
+        plan[phase] = onset
+        onset = onset + dur
+
+    return plan
+
+
+def collect_response(p, keys, onset, match):
+    """Get response info specific to this experiment.
+
+    keys are (key, time) pairs from an InputPoller and onset is the time
+    of the response cue flip, which the reaction time is measured from.
+
+    """
     corr, response, resp_rt = 0, -1, -1
     for key, stamp in keys:
         if key in p.quit_keys:
             core.quit()
+        elif stamp < onset:
+            # Pressed before the response cue but not yet cleared
+            continue
         elif key in p.match_keys:
             corr = 1 if match else 0
             response = 1
-            resp_rt = stamp
+            resp_rt = stamp - onset
             break
         elif key in p.nonmatch_keys:
             corr = 0 if match else 1
             response = 2
-            resp_rt = stamp
+            resp_rt = stamp - onset
             break
     return corr, response, resp_rt
 
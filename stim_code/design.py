@@ -0,0 +1,1126 @@
+"""Event schedule and design optimization math.
+
+Everything here depends only on numpy, so schedules can be generated (and
+these functions tested) without loading psychopy or any other display
+code. tools re-exports these names for existing callers.
+
+"""
+from __future__ import division
+from math import gamma as gamma_fn
+import numpy as np
+
+__all__ = ["max_three_in_a_row", "max_four_in_a_row", "run_lengths",
+           "max_run_lengths", "run_length_ok", "run_length_constraint",
+           "make_schedule", "sample_schedules", "optimize_event_schedule",
+           "counterbalanced_schedule", "balance_cost_batch", "cb1_optimize",
+           "cb1_anneal", "cb1_ideal", "cb1_prob", "cb1_cost",
+           "cb1_prob_batch", "cb1_cost_batch", "cb_ideal", "cb_prob_batch",
+           "cb_cost_batch", "CBKernel", "CB1Kernel", "spm_hrf",
+           "DesignEfficiency"]
+
+
+def max_three_in_a_row(seq):
+    """Only allow sequences with 3 or fewer tokens in a row."""
+    return run_length_ok(seq, 3)
+
+
+def max_four_in_a_row(seq):
+    """Only allow sequences with 4 or fewer tokens in a row."""
+    return run_length_ok(seq, 4)
+
+
+def run_lengths(scheds):
+    """Find how far into its run of identical events each event is.
+
+    Parameters
+    ----------
+    scheds: 1D or 2D integer array
+        one schedule or an n_schedules x n_events array of schedules
+
+    Returns
+    -------
+    lengths: integer array
+        same shape as scheds, where each entry is the length of the run it
+        belongs to up to and including that event
+
+    """
+    scheds = np.asarray(scheds)
+    index = np.arange(scheds.shape[-1])
+    starts = np.ones(scheds.shape, bool)
+    starts[..., 1:] = np.diff(scheds, axis=-1) != 0
+    run_start = np.where(starts, index, 0)
+    np.maximum.accumulate(run_start, axis=-1, out=run_start)
+    return index - run_start + 1
+
+
+def max_run_lengths(scheds):
+    """Find the longest run of identical events in each schedule."""
+    lengths = run_lengths(scheds)
+    if not lengths.shape[-1]:
+        return np.zeros(lengths.shape[:-1], int)
+    return lengths.max(axis=-1)
+
+
+def run_length_ok(scheds, max_run, default=None):
+    """Check whether schedules respect limits on runs of identical events.
+
+    Parameters
+    ----------
+    scheds: 1D or 2D integer array
+        one schedule or an n_schedules x n_events array of schedules
+    max_run: int or dict
+        longest allowed run, or a mapping from event id to the longest run
+        allowed for that event
+    default: int, optional
+        limit for event ids missing from a max_run dict (unlimited if None)
+
+    Returns
+    -------
+    ok: bool or 1D bool array
+        whether each schedule satisfies the limits
+
+    """
+    scheds = np.asarray(scheds)
+    lengths = run_lengths(scheds)
+    if not isinstance(max_run, dict):
+        return ~(lengths > max_run).any(axis=-1)
+
+    # Look up the limit for each event by its id
+    if default is None:
+        default = scheds.shape[-1]
+    labels = np.array(sorted(max_run))
+    limits = np.array([max_run[l] for l in labels] + [default])
+    pos = np.searchsorted(labels, scheds)
+    known = labels[np.minimum(pos, len(labels) - 1)] == scheds
+    limit = limits[np.where(known, pos, len(labels))]
+    return ~(lengths > limit).any(axis=-1)
+
+
+def run_length_constraint(max_run, default=None):
+    """Make a constraint function from run length limits.
+
+    The returned function takes one schedule and returns a bool or a 2D
+    batch of schedules and returns a bool array, so it can be used both as
+    the constraint for cb1_optimize and as a filter on candidate matrices
+    in optimize_event_schedule. See run_length_ok for the parameters.
+
+    """
+    return lambda scheds: run_length_ok(scheds, max_run, default)
+
+
+def make_schedule(n_cat, n_total, max_repeat, random_state=None):
+    """Generate an event schedule subject to a repeat constraint."""
+    sched = sample_schedules(n_cat, n_total, max_repeat, 1, random_state)
+    return sched[0].tolist()
+
+
+def sample_schedules(n_cat, n_total, max_repeat, n_chains,
+                     random_state=None, out=None):
+    """Generate many event schedules subject to a repeat constraint.
+
+    All of the chains are advanced in lockstep. Each step draws one uniform
+    number per chain and looks it up in a cumulative transition table,
+    where the table row depends only on whether the chain has hit its
+    repeat limit. The current run length is tracked as integer state.
+
+    As with the original sampler, the repeat window is the whole schedule
+    until max_repeat events have been drawn, so the second event always
+    differs from the first.
+
+    Parameters
+    ----------
+    n_cat: int
+        Total number of event types
+    n_total: int
+        Total number of events in each schedule
+    max_repeat: int
+        Maximum number of event repetitions allowed
+    n_chains: int
+        Number of independent schedules to generate
+    random_state: RandomState, optional
+        source of random numbers, defaults to the global numpy state
+    out: 2D integer array, optional
+        n_chains x n_total buffer to fill with the schedules
+
+    Returns
+    -------
+    schedules: 2D integer array
+        n_chains x n_total array of 0-based event ids
+
+    """
+    if random_state is None:
+        random_state = np.random
+    if out is None:
+        out = np.empty((n_chains, n_total), np.min_scalar_type(n_cat - 1))
+
+    # Build the cumulative transition tables. The last row is the
+    # unconstrained distribution; row i excludes a repeat of event i
+    tmats = np.ones((n_cat + 1, n_cat))
+    tmats[np.arange(n_cat), np.arange(n_cat)] = 0
+    cdfs = tmats.cumsum(axis=1)
+    cdfs /= cdfs[:, -1:]
+
+    # Generate the schedules
+    current = np.zeros(n_chains, np.intp)
+    run = np.zeros(n_chains, np.intp)
+    table = np.empty(n_chains, np.intp)
+    for i in xrange(n_total):
+        # Check if we're at our repeat limit
+        table.fill(n_cat)
+        if i:
+            blocked = run >= min(i, max_repeat)
+            table[blocked] = current[blocked]
+
+        # Draw this step's events from the relevant tables
+        u = random_state.random_sample(n_chains)
+        events = (cdfs[table] <= u[:, np.newaxis]).sum(axis=1)
+
+        # Update the run length state
+        run = np.where(events == current, run + 1, 1)
+        current = events
+        out[:, i] = events
+
+    return out
+
+
+def optimize_event_schedule(n_cat, n_total, max_repeat, n_search=1000,
+                            enforce_balance=False, chunk_size=10000,
+                            constraint=None, objectives=None,
+                            random_state=None):
+    """Generate an event schedule optimizing CB1 and even conditions.
+
+    The candidate schedules are held in one compact integer matrix and
+    scored in vectorized passes of up to chunk_size rows, so memory and
+    time grow linearly with n_search.
+
+    Parameters
+    ----------
+    n_cat: int
+        Total number of event types
+    n_total: int
+        Total number of events
+    max_repeat: int
+        Maximum number of event repetitions allowed
+    n_search: int
+        Size of the searc space
+    enforce_balance: bool
+        If true, only schedules with balanced event types are considered,
+        and a ValueError is raised if there aren't any
+    chunk_size: int
+        Number of candidate schedules to score in each vectorized pass
+    constraint: callable, optional
+        function that takes a 2D array of schedules and returns a boolean
+        array marking the acceptable ones (e.g. run_length_constraint)
+    objectives: dict, optional
+        weight of each zscored cost term in the total cost, where the terms
+        are "balance" for even event counts and "cb1", "cb2", ... for
+        counterbalancing of that order. Other terms can be given as a
+        (weight, function) pair, where the function takes a 2D array of
+        schedules and returns their costs (e.g. DesignEfficiency.cost).
+        Defaults to equal weights on balance and cb1.
+    random_state: RandomState, optional
+        source of random numbers, defaults to the global numpy state
+
+    Returns
+    -------
+    schedule: numpy array
+        Optimal event schedule with 0-based event ids
+
+    """
+    # Determine the ideal event counts
+    ev_count = [n_total / n_cat] * n_cat
+
+    # Set up the cost terms
+    if objectives is None:
+        objectives = dict(balance=1, cb1=1)
+    kernels, weights = {}, {}
+    for name, weight in objectives.items():
+        if isinstance(weight, tuple):
+            weight, kernels[name] = weight
+        elif name.startswith("cb") and name[2:].isdigit():
+            kernels[name] = CBKernel(ev_count, min(chunk_size, n_search),
+                                     int(name[2:]))
+        elif name != "balance":
+            raise ValueError("Unknown objective: %s" % name)
+        weights[name] = weight
+    costs = dict((name, np.empty(n_search)) for name in kernels)
+    costs["balance"] = np.empty(n_search)
+
+    # Generate the space of schedules
+    schedules = np.empty((n_search, n_total), np.min_scalar_type(n_cat - 1))
+    valid = np.ones(n_search, bool)
+    for start in xrange(0, n_search, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        sample_schedules(n_cat, n_total, max_repeat, len(valid[chunk]),
+                         random_state, schedules[chunk])
+        balance_cost_batch(schedules[chunk], n_cat, costs["balance"][chunk])
+        for name, kernel in kernels.items():
+            costs[name][chunk] = kernel(schedules[chunk])
+        if constraint is not None:
+            valid[chunk] = constraint(schedules[chunk])
+
+    # Only consider schedules that satisfy the constraint
+    if constraint is not None and not valid.any():
+        raise ValueError("Could not satisfy constraint")
+
+    # Possibly only consider balanced schedules, erroring out if none are
+    if enforce_balance:
+        balanced = valid & (costs["balance"] == 0)
+        if not balanced.any():
+            raise ValueError("Failed to generate balanced schedule")
+        valid = balanced
+    index = np.flatnonzero(valid)
+    costs = dict((name, c[valid]) for name, c in costs.items())
+
+    # Zscore the costs and take the weighted sum
+    total = np.zeros(len(index))
+    for name, weight in weights.items():
+        total += weight * _zscore(costs[name])
+
+    # Return the best schdule
+    return schedules[index[np.argmin(total)]].astype(int)
+
+
+def counterbalanced_schedule(n_cat, n_total, max_repeat=None, n_attempts=20,
+                            random_state=None):
+    """Construct an event schedule with near exact first-order counterbalance.
+
+    Rather than searching over random schedules, this picks the matrix of
+    integer transition counts with the lowest CB1 cost and then walks a
+    random Eulerian path through the corresponding multigraph, so every
+    transition in the matrix is used exactly once. When n_total - 1 is a
+    multiple of n_cat ** 2 (and there are no repeat restrictions) every
+    ordered pair of events occurs equally often.
+
+    The best transition counts depend on the first and last events only
+    through how often those events occur and whether they are the same, so
+    each of those endpoint classes is scored once. Endpoints are then drawn
+    at random from the best class and a random path is walked until one
+    satisfies the repeat limit, moving on to worse classes if needed. If
+    none of the n_attempts paths work, this falls back to cb1_anneal.
+
+    Parameters
+    ----------
+    n_cat: int
+        Total number of event types
+    n_total: int
+        Total number of events
+    max_repeat: int, optional
+        Maximum number of event repetitions allowed
+    n_attempts: int
+        Maximum number of random paths to try
+    random_state: RandomState, optional
+        source of random numbers, defaults to the global numpy state
+
+    Returns
+    -------
+    schedule: numpy array
+        Event schedule with 0-based event ids
+
+    """
+    if random_state is None:
+        random_state = np.random
+    if max_repeat is None:
+        max_repeat = n_total
+
+    # Spread the events as evenly as possible over the categories
+    ev_count = np.ones(n_cat, int) * (n_total // n_cat)
+    ev_count[random_state.permutation(n_cat)[:n_total % n_cat]] += 1
+
+    # Don't allow self transitions if we can't repeat at all
+    allowed = np.ones((n_cat, n_cat), bool)
+    if max_repeat < 2:
+        allowed[np.diag_indices(n_cat)] = False
+
+    def best_transitions(first, last):
+        """Find the best transition counts given the endpoints."""
+        out_deg = ev_count.copy()
+        out_deg[last] -= 1
+        in_deg = ev_count.copy()
+        in_deg[first] -= 1
+        return _optimal_transitions(ev_count, out_deg, in_deg,
+                                    allowed, random_state)
+
+    # Group the possible endpoints into classes that share a CB1 cost
+    classes = {}
+    for first in range(n_cat):
+        for last in range(n_cat):
+            key = ev_count[first], ev_count[last], first == last
+            classes.setdefault(key, []).append((first, last))
+
+    # Score one representative of each class
+    ideal = cb1_ideal(ev_count)
+    ranked = []
+    for pairs in classes.values():
+        first, last = pairs[random_state.randint(len(pairs))]
+        tmat = best_transitions(first, last)
+        if tmat is not None:
+            cost = cb1_cost(ideal, tmat / ev_count[:, np.newaxis])
+            ranked.append((cost, pairs))
+    ranked.sort(key=lambda x: x[0])
+
+    # Walk random paths, starting with the best class of endpoints
+    attempt = 0
+    for cost, pairs in ranked:
+        tmats = {}
+        for i in xrange(n_attempts):
+            if attempt == n_attempts:
+                break
+            attempt += 1
+            first, last = pairs[random_state.randint(len(pairs))]
+            if (first, last) not in tmats:
+                tmats[first, last] = best_transitions(first, last)
+            sched = _eulerian_path(tmats[first, last], first, random_state)
+            if sched is not None and max_run_lengths(sched) <= max_repeat:
+                return np.array(sched)
+
+    # Fall back to searching for the best schedule we can reach
+    sched = cb1_anneal(ev_count, 100 * n_total, max_repeat=max_repeat,
+                       random_state=random_state)
+    return sched - 1
+
+
+def _optimal_transitions(ev_count, out_deg, in_deg, allowed, random_state):
+    """Find the integer transition counts with the lowest CB1 cost.
+
+    Each cell's contribution to the CB1 cost is convex in its count, so the
+    best matrix with the given row and column sums is a min cost flow from
+    the rows to the columns. This finds it by successive shortest paths,
+    adding one transition at a time. Ties between equally good matrices are
+    broken at random. Returns None if the degrees can't be satisfied.
+
+    """
+    n_cat = len(ev_count)
+    target = np.outer(ev_count, ev_count) / ev_count.sum()
+    weight = 1 / target
+    weight *= 1 + 1e-6 * random_state.random_sample((n_cat, n_cat))
+    marginal = lambda c: weight * (np.abs(c - target) -
+                                   np.abs(c - 1 - target))
+
+    tmat = np.zeros((n_cat, n_cat), int)
+    rows, cols = np.arange(n_cat), np.arange(n_cat)
+    for unit in xrange(out_deg.sum()):
+
+        # Residual costs of adding a forward or removing a backward transition
+        fwd = np.where(allowed, marginal(tmat + 1), np.inf)
+        bwd = np.where(tmat > 0, -marginal(tmat), np.inf)
+
+        # Shortest paths from the rows with spare capacity (Bellman-Ford)
+        # Only strict improvements update a predecessor, which keeps the
+        # path tree free of cycles when there are ties
+        row_dist = np.where(tmat.sum(axis=1) < out_deg, 0, np.inf)
+        row_pred = np.ones(n_cat, int) * -1
+        col_dist = np.ones(n_cat) * np.inf
+        col_pred = np.ones(n_cat, int) * -1
+        for i in xrange(2 * n_cat + 1):
+            cand = row_dist[:, np.newaxis] + fwd
+            best = cand.argmin(axis=0)
+            col_better = cand[best, cols] < col_dist - 1e-12
+            col_dist[col_better] = cand[best, cols][col_better]
+            col_pred[col_better] = best[col_better]
+            cand = col_dist[np.newaxis, :] + bwd
+            best = cand.argmin(axis=1)
+            row_better = cand[rows, best] < row_dist - 1e-12
+            row_dist[row_better] = cand[rows, best][row_better]
+            row_pred[row_better] = best[row_better]
+            if not (col_better.any() or row_better.any()):
+                break
+
+        # Augment along the path to the cheapest column with spare capacity
+        col_dist[tmat.sum(axis=0) >= in_deg] = np.inf
+        j = col_dist.argmin()
+        if np.isinf(col_dist[j]):
+            return None
+        while True:
+            i = col_pred[j]
+            tmat[i, j] += 1
+            if row_pred[i] < 0:
+                break
+            j = row_pred[i]
+            tmat[i, j] -= 1
+
+    return tmat
+
+
+def _eulerian_path(tmat, first, random_state):
+    """Walk a random path that uses every transition in tmat exactly once.
+
+    This is Hierholzer's algorithm with the outgoing edges of each node in
+    random order. Returns None if the transition graph isn't connected.
+
+    """
+    n_cat = len(tmat)
+    adj = []
+    for i in range(n_cat):
+        edges = np.repeat(np.arange(n_cat), tmat[i])
+        adj.append(random_state.permutation(edges).tolist())
+
+    stack, path = [first], []
+    while stack:
+        node = stack[-1]
+        if adj[node]:
+            stack.append(adj[node].pop())
+        else:
+            path.append(stack.pop())
+
+    if len(path) != tmat.sum() + 1:
+        return None
+    return path[::-1]
+
+
+def _zscore(x):
+    """Zscore an array of costs, treating a constant array as all zeros."""
+    std = x.std()
+    if not std:
+        return np.zeros_like(x)
+    return (x - x.mean()) / std
+
+
+def balance_cost_batch(scheds, n_cat, out=None):
+    """Calculate how far each schedule is from even event counts.
+
+    Parameters
+    ----------
+    scheds: 2D integer array
+        n_schedules x n_events array of 0-based event ids
+    n_cat: int
+        Total number of event types
+    out: 1D float array, optional
+        buffer to fill with the result
+
+    Returns
+    -------
+    costs: 1D float array
+        summed absolute deviation of each event count from the mean count
+
+    """
+    scheds = np.asarray(scheds)
+    n_sched, n_total = scheds.shape
+    codes = scheds + (np.arange(n_sched) * n_cat)[:, np.newaxis]
+    hist = np.bincount(codes.ravel(), minlength=n_sched * n_cat)
+    hist = hist.reshape(n_sched, n_cat) - n_total / n_cat
+    return np.abs(hist).sum(axis=1, out=out)
+
+
+def cb1_optimize(ev_count, n_search=1000, constraint=None, method="anneal",
+                 random_state=None):
+    """Given event counts, return a first order counterbalanced schedule.
+
+    The default method is a simulated annealing search over pairwise swaps
+    (see cb1_anneal). The "brute" method is bascially a Python port of Doug
+    Greve's C implementation of this in optseq with the addition of a
+    constraint option: it just scores n_search random permutations.
+
+    Inputs
+    ------
+    ev_count: sequence
+        desired number of appearences for each event t
+    constraint: callable
+        arbitrary function that takes a squence and returns a boolean
+    n_search: int
+        iterations of search algorithm
+    method: "anneal" or "brute"
+        search algorithm to use
+    random_state: RandomState, optional
+        source of random numbers, defaults to the global numpy state
+
+    """
+    if method == "anneal":
+        return cb1_anneal(ev_count, n_search, constraint,
+                          random_state=random_state)
+    elif method != "brute":
+        raise ValueError("Unknown optimization method: %s" % method)
+
+    if random_state is None:
+        random_state = np.random
+
+    # Set up a default constraint function
+    if constraint is None:
+        constraint = lambda x: True
+
+    # Set up the FOCB scoring workspace
+    kernel = CB1Kernel(ev_count, 1)
+
+    # Create n_search random schedules and pick the best one
+    sched = _unordered_schedule(ev_count)
+    best_sched, best_cost = None, np.inf
+    for i in xrange(n_search):
+        iter_sched = sched[random_state.permutation(len(sched))]
+        if not constraint(iter_sched):
+            continue
+        iter_cost = kernel(iter_sched[np.newaxis])[0]
+        if iter_cost < best_cost:
+            best_sched, best_cost = iter_sched, iter_cost
+
+    # Make sure we could permute
+    if best_sched is None:
+        raise ValueError("Could not satisfy constraint")
+
+    return best_sched
+
+
+def cb1_anneal(ev_count, n_iter=10000, constraint=None, temps=None,
+               random_state=None, max_repeat=None):
+    """Find a first order counterbalanced schedule by simulated annealing.
+
+    The search starts from a random schedule that satisfies the
+    constraints and proposes swaps of two events. With max_repeat, the
+    starting schedule is built directly (see _run_limited_schedule);
+    otherwise random permutations are drawn until one satisfies the
+    constraint, which can fail for tight constraints. The transition count
+    matrix is updated in place, so a swap only touches the (at most four)
+    transitions on either side of the swapped positions and its cost
+    change is evaluated in constant time. Constraints are only checked for
+    moves that would otherwise be accepted. The max_repeat limit is checked
+    in the window of max_repeat events on either side of each swapped
+    position, as any run that a swap makes too long has to pass through
+    one of them. The constraint function gets the whole schedule, so run
+    length limits are much faster given as max_repeat.
+
+    Inputs
+    ------
+    ev_count: sequence
+        desired number of appearences for each event t
+    n_iter: int
+        number of swaps to propose
+    constraint: callable
+        arbitrary function that takes a squence and returns a boolean
+    temps: pair of floats, optional
+        starting and final temperature of the geometric cooling schedule,
+        defaults to values scaled by the cost of a single transition
+    random_state: RandomState, optional
+        source of random numbers, defaults to the global numpy state
+    max_repeat: int, optional
+        longest allowed run of identical events
+
+    Returns
+    -------
+    best_sched: numpy array
+        lowest cost schedule with 1-based event ids
+
+    """
+    if random_state is None:
+        random_state = np.random
+
+    ev_count = np.asarray(ev_count)
+    n_cat = len(ev_count)
+    n_total = int(ev_count.sum())
+
+    # Find a starting schedule that satisfies the constraint
+    if max_repeat is not None:
+        sched = _run_limited_schedule(ev_count, max_repeat, random_state)
+        if constraint is not None and not constraint(sched):
+            raise ValueError("Could not satisfy constraint")
+    else:
+        sched = _unordered_schedule(ev_count)
+        for i in xrange(max(n_iter, 1)):
+            sched = sched[random_state.permutation(n_total)]
+            if constraint is None or constraint(sched):
+                break
+        else:
+            raise ValueError("Could not satisfy constraint")
+
+    # Tabulate the cost contribution of every possible count in every cell
+    ideal = cb1_ideal(ev_count)
+    counts = np.arange(n_total + 1)
+    cell_costs = np.abs(ideal[:, :, np.newaxis] -
+                        counts / ev_count[:, np.newaxis, np.newaxis])
+    cell_costs /= ideal[:, :, np.newaxis] * n_cat ** 2
+    cell_costs = cell_costs.tolist()
+
+    # Set up the running state as plain Python objects for fast indexing
+    codes = ((sched - 1) % n_cat).tolist()
+    sched = sched.tolist()
+    cb_mat = np.zeros((n_cat, n_cat), int)
+    np.add.at(cb_mat, (codes[:-1], codes[1:]), 1)
+    cb_mat = cb_mat.tolist()
+    cost = sum(cell_costs[i][j][cb_mat[i][j]]
+               for i in range(n_cat) for j in range(n_cat))
+    best_sched, best_cost = list(sched), cost
+
+    # Set up the cooling schedule
+    if temps is None:
+        quantum = (1 / (ev_count[:, np.newaxis] * ideal)).mean() / n_cat ** 2
+        temps = 2 * quantum, .05 * quantum
+    t_start, t_end = temps
+    temp_sched = t_start * (t_end / t_start) ** (np.arange(n_iter) / n_iter)
+
+    # Draw all of the random numbers up front
+    pos_a = random_state.randint(0, n_total, n_iter).tolist()
+    pos_b = random_state.randint(0, n_total, n_iter).tolist()
+    accept_p = np.log(random_state.random_sample(n_iter)) * temp_sched
+    accept_p = accept_p.tolist()
+
+    def shift(edges, step):
+        """Move the given transitions in or out of the count matrix."""
+        delta = 0
+        for k in edges:
+            i, j = codes[k], codes[k + 1]
+            c = cb_mat[i][j]
+            delta += cell_costs[i][j][c + step] - cell_costs[i][j][c]
+            cb_mat[i][j] = c + step
+        return delta
+
+    def swap(a, b):
+        sched[a], sched[b] = sched[b], sched[a]
+        codes[a], codes[b] = codes[b], codes[a]
+
+    def runs_ok(pos):
+        """Check for runs that are too long through one position."""
+        run = 1
+        for k in xrange(max(pos - max_repeat, 0) + 1,
+                        min(pos + max_repeat + 1, n_total)):
+            run = run + 1 if codes[k] == codes[k - 1] else 1
+            if run > max_repeat:
+                return False
+        return True
+
+    def allowed(a, b):
+        if max_repeat is not None and not (runs_ok(a) and runs_ok(b)):
+            return False
+        return constraint is None or constraint(np.array(sched))
+
+    last_edge = n_total - 2
+    for it in xrange(n_iter):
+        a, b = pos_a[it], pos_b[it]
+        if codes[a] == codes[b]:
+            continue
+
+        # Find the transitions touched by this swap
+        edges = set([a - 1, a, b - 1, b])
+        edges = [k for k in edges if 0 <= k <= last_edge]
+
+        # Compute the cost change while updating the counts in place
+        delta = shift(edges, -1)
+        swap(a, b)
+        delta += shift(edges, 1)
+
+        # Metropolis acceptance, where accept_p holds T * log(u)
+        if delta > -accept_p[it] or not allowed(a, b):
+            shift(edges, -1)
+            swap(a, b)
+            shift(edges, 1)
+            continue
+
+        cost += delta
+        if cost < best_cost - 1e-12:
+            best_sched, best_cost = list(sched), cost
+
+    return np.array(best_sched)
+
+
+def _run_limited_schedule(ev_count, max_repeat, random_state):
+    """Randomly order events so that no run is longer than max_repeat.
+
+    Events are placed one at a time. Each is drawn, in proportion to how
+    many of it are left, from the events that keep the rest placeable:
+    an event with n left fits as long as n <= max_repeat * (m + 1), where
+    m is the number of other events left, less the length of the current
+    run if it is that event. So the schedule never reaches a dead end.
+    Returns 1-based event ids.
+
+    """
+    left = np.array(ev_count, int)
+    n_total = left.sum()
+
+    def placeable(last, run):
+        room = max_repeat * (left.sum() - left + 1)
+        room[last] -= run
+        return (left <= room).all()
+
+    sched = []
+    last, run = -1, 0
+    for i in xrange(n_total):
+        options = []
+        for event in np.flatnonzero(left):
+            event_run = run + 1 if event == last else 1
+            if event_run > max_repeat:
+                continue
+            left[event] -= 1
+            if placeable(event, event_run):
+                options.append(event)
+            left[event] += 1
+        if not options:
+            raise ValueError("Could not satisfy constraint")
+        weights = left[options] / left[options].sum()
+        event = options[random_state.choice(len(options), p=weights)]
+        run = run + 1 if event == last else 1
+        last = event
+        left[event] -= 1
+        sched.append(event + 1)
+
+    return np.array(sched)
+
+
+def _unordered_schedule(ev_count):
+    """Make a sorted schedule with 1-based ids from event counts."""
+    sched_list = []
+    for i, n in enumerate(ev_count, 1):
+        sched_list.append(np.ones(int(n), int) * i)
+    return np.hstack(sched_list)
+
+
+def cb1_ideal(ev_count):
+    """Calculate the ideal FOCB matrix"""
+    return cb_ideal(ev_count, 1)
+
+
+def cb1_prob(sched, ev_count):
+    """Calculate the empirical FOCB matrix from a schedule."""
+    return cb1_prob_batch(np.atleast_2d(sched), ev_count)[0]
+
+
+def cb1_cost(ideal_mat, test_mat):
+    """Calculate the error between ideal and empirical FOCB matricies."""
+    cb1err = np.abs(ideal_mat - test_mat)
+    cb1err /= ideal_mat
+    cb1err = cb1err.sum()
+    cb1err /= ideal_mat.shape[0] ** 2
+    return cb1err
+
+
+def cb1_prob_batch(scheds, ev_count, out=None):
+    """Calculate the empirical FOCB matrices for a batch of schedules.
+
+    See cb_prob_batch for details.
+
+    """
+    return cb_prob_batch(scheds, ev_count, 1, out)
+
+
+def cb1_cost_batch(ideal_mat, test_mats, out=None):
+    """Calculate the FOCB error for a stack of empirical matrices.
+
+    See cb_cost_batch for details.
+
+    """
+    return cb_cost_batch(ideal_mat, test_mats, out)
+
+
+def cb_ideal(ev_count, order=1):
+    """Calculate the ideal counterbalancing tensor of a given order.
+
+    The ideal probability of an event doesn't depend on the events before
+    it, so this is the event rate broadcast over order + 1 dimensions.
+
+    """
+    n_events = len(ev_count)
+    ideal = np.zeros((n_events,) * (order + 1))
+    ideal[:] = ev_count / np.sum(ev_count)
+    return ideal
+
+
+def cb_prob_batch(scheds, ev_count, order=1, out=None):
+    """Calculate empirical counterbalancing tensors for a batch of schedules.
+
+    Each run of order + 1 consecutive events is encoded as a single index
+    into the flattened stack of tensors, so all of the counting happens in
+    one bincount call no matter the order. The counts are normalized by the
+    expected number of times each preceding sequence occurs, which for the
+    first order case is just the count of the first event (as in cb1_prob).
+    Event ids are mapped to indices the same way as in cb1_prob, so 1-based
+    ids index directly and 0 wraps around to the last event.
+
+    Parameters
+    ----------
+    scheds: 2D integer array
+        n_schedules x n_events array of event ids
+    ev_count: sequence
+        number of appearences for each event type
+    order: int
+        number of preceding events to condition on (1 for CB1, 2 for CB2)
+    out: float array, optional
+        n_schedules x n_cat x ... x n_cat buffer to fill with the result
+
+    Returns
+    -------
+    cb_mats: float array
+        n_schedules x n_cat x ... x n_cat counterbalancing tensors
+
+    """
+    scheds = np.asarray(scheds)
+    n_sched, n_total = scheds.shape
+    n_cat = len(ev_count)
+    shape = (n_sched,) + (n_cat,) * (order + 1)
+    if out is None:
+        out = np.empty(shape)
+
+    # Encode each sequence of order + 1 events as a flat index
+    codes = (scheds.astype(np.intp) - 1) % n_cat
+    n_seq = n_total - order
+    seqs = (np.arange(n_sched) * n_cat ** (order + 1))[:, np.newaxis]
+    seqs = seqs + codes[:, :n_seq] * n_cat ** order
+    for lag in range(1, order + 1):
+        seqs += codes[:, lag:lag + n_seq] * n_cat ** (order - lag)
+
+    # Count all sequences at once
+    counts = np.bincount(seqs.ravel(), minlength=np.prod(shape))
+    out[:] = counts.reshape(shape)
+
+    # Normalize by the expected count of each preceding sequence
+    ev_count = np.asarray(ev_count, float)
+    expected = ev_count.copy()
+    for lag in range(1, order):
+        expected = np.multiply.outer(expected, ev_count / ev_count.sum())
+    out /= expected[..., np.newaxis]
+
+    return out
+
+
+def cb_cost_batch(ideal_mat, test_mats, out=None):
+    """Calculate the counterbalancing error for a stack of empirical tensors.
+
+    This is the mean relative deviation from the ideal over all cells, as in
+    cb1_cost. Note that test_mats is used as scratch space and will be
+    overwritten.
+
+    """
+    test_mats -= ideal_mat
+    np.abs(test_mats, test_mats)
+    test_mats /= ideal_mat
+    out = test_mats.reshape(len(test_mats), -1).sum(axis=1, out=out)
+    out /= ideal_mat.size
+    return out
+
+
+class CBKernel(object):
+    """Preallocated workspace for repeatedly scoring batches of schedules.
+
+    The buffers are sized on initialization, so calling the kernel inside
+    a search loop doesn't allocate new output arrays on every iteration.
+
+    """
+    def __init__(self, ev_count, n_sched, order=1):
+        """Set up the buffers.
+
+        Parameters
+        ----------
+        ev_count: sequence
+            number of appearences for each event type
+        n_sched: int
+            maximum number of schedules that will be scored in one call
+        order: int
+            order of the counterbalancing to score
+
+        """
+        n_cat = len(ev_count)
+        self.ev_count = ev_count
+        self.order = order
+        self.ideal = cb_ideal(ev_count, order)
+        self.probs = np.empty((n_sched,) + (n_cat,) * (order + 1))
+        self.costs = np.empty(n_sched)
+
+    def __call__(self, scheds):
+        """Return a view on the costs for each schedule in scheds."""
+        n = len(scheds)
+        probs = cb_prob_batch(scheds, self.ev_count, self.order,
+                              self.probs[:n])
+        return cb_cost_batch(self.ideal, probs, self.costs[:n])
+
+
+class CB1Kernel(CBKernel):
+    """Preallocated workspace for scoring first order counterbalancing."""
+    def __init__(self, ev_count, n_sched):
+        CBKernel.__init__(self, ev_count, n_sched, 1)
+
+
+def spm_hrf(dt, duration=32):
+    """Canonical double gamma hemodynamic response sampled every dt seconds.
+
+    Uses the SPM shape: a response peaking around 5 seconds with an
+    undershoot peaking around 15 seconds that is 1/6 of its amplitude.
+
+    """
+    t = np.arange(0, duration, dt)
+    gamma_pdf = lambda t, a: t ** (a - 1) * np.exp(-t) / gamma_fn(a)
+    hrf = gamma_pdf(t, 6) - gamma_pdf(t, 16) / 6
+    return hrf / hrf.sum()
+
+
+class DesignEfficiency(object):
+    """Estimation efficiency of the context DMC design for event schedules.
+
+    This builds the HRF-convolved design matrix for each candidate, with a
+    sample and a target regressor for each event type, and scores it with
+    the optseq-style efficiency 1 / trace((X'X)^-1) over those regressors.
+    The trial timing follows make_schedule.build_run_schedule and
+    context_dmc.run_experiment, and each candidate's design matrix covers
+    exactly its own run. The sampled response to an event starting at
+    each point of the run is convolved once, so a design matrix is just a
+    lookup of each trial's response and a sum by event type. Everything
+    is batched over candidates, including inverting the normal equations;
+    scoring 5000 candidates with per-trial jitters takes about 0.1 s.
+
+    """
+    # Parameters the trial timing (and so the efficiency) depends on
+    timing_params = ("tr", "cue_dur", "stim_samp_dur", "stim_sfix_dur",
+                     "stim_targ_dur", "resp_dur")
+
+    def __init__(self, p, n_cat=4, dt=.5, batch_size=500, jitters=None):
+        """Set up the timing information.
+
+        Parameters
+        ----------
+        p: Params object
+            experiment parameters with tr and the phase durations
+        n_cat: int
+            Total number of event types
+        dt: float
+            resolution in seconds of the neural signal before sampling
+        batch_size: int
+            number of candidates to build design matrices for at once
+        jitters: sequence of three 2D arrays, optional
+            the run's psi, isi and iti jitters in TRs as n_cat x n_per_event
+            arrays, where the kth trial of an event type takes the kth
+            value in its row (see trial_jitters). Without these, every
+            jitter is 2 TRs.
+
+        """
+        self.p = p
+        self.n_cat = n_cat
+        self.dt = dt
+        self.batch_size = batch_size
+        self.hrf = spm_hrf(dt)
+        self._tables = {}
+        if jitters is not None:
+            jitters = [np.asarray(x) for x in jitters]
+        self.jitters = jitters
+
+    def trial_jitters(self, scheds):
+        """Look up the psi, isi and iti jitters of every trial in schedules.
+
+        A schedule with more trials of an event type than there are jitters
+        for it (which make_schedule would reject) reuses them in order.
+
+        """
+        scheds = np.atleast_2d(scheds).astype(np.intp)
+        onehot = scheds[:, :, np.newaxis] == np.arange(self.n_cat)
+        nth = (onehot.cumsum(axis=1) * onehot).sum(axis=-1) - 1
+        return [x[scheds, nth % x.shape[1]] for x in self.jitters]
+
+    def _default_jitters(self, scheds, psi_tr, isi_tr, iti_tr):
+        """Fill in the jitters that weren't given."""
+        jitters = [psi_tr, isi_tr, iti_tr]
+        if self.jitters is not None and all(x is None for x in jitters):
+            return self.trial_jitters(scheds)
+        return [np.ones(scheds.shape[-1]) * 2 if x is None else np.asarray(x)
+                for x in jitters]
+
+    def onsets(self, psi_tr, isi_tr, iti_tr):
+        """Find the sample and target onsets in seconds for each trial.
+
+        Also returns the duration of each run.
+
+        """
+        p = self.p
+        psi = psi_tr * p.tr
+        isi = p.stim_sfix_dur + isi_tr * p.tr
+        iti = iti_tr * p.tr
+        trial_dur = (p.cue_dur + psi + p.stim_samp_dur + isi +
+                     p.stim_targ_dur + p.resp_dur + iti)
+        trial_start = np.cumsum(trial_dur, axis=-1) - trial_dur
+        samp_onset = trial_start + p.cue_dur + psi
+        targ_onset = samp_onset + p.stim_samp_dur + isi
+        return samp_onset, targ_onset, trial_dur.sum(axis=-1)
+
+    def design_matrices(self, scheds, psi_tr=None, isi_tr=None, iti_tr=None):
+        """Build the HRF-convolved design matrices for a batch of schedules.
+
+        The jitters can be given per trial (1D) or per candidate (2D); by
+        default they come from the jitters the object was made with. Each
+        trial's sampled response is looked up by its onset bin (see
+        _response_table) and the regressors are sums of those responses.
+        The matrices cover the longest run in the batch, so calling this on
+        runs of different lengths pads the shorter ones (__call__ scores
+        each length separately).
+
+        Returns
+        -------
+        X: 3D float array
+            n_schedules x n_scans x (2 * n_cat + 1) design matrices, with the
+            sample regressors, then the target regressors, then a constant
+
+        """
+        p, n_cat = self.p, self.n_cat
+        scheds = np.atleast_2d(scheds).astype(np.intp)
+        n_sched, n_trials = scheds.shape
+        jitters = self._default_jitters(scheds, psi_tr, isi_tr, iti_tr)
+        samp_onset, targ_onset, run_dur = self.onsets(*jitters)
+        n_bins = int(np.ceil(np.max(run_dur) / self.dt))
+
+        # Event type indicators, arranged to sum trials by type
+        onehot = scheds[:, np.newaxis, :] == np.arange(n_cat)[:, np.newaxis]
+        onehot = onehot.astype(float)
+
+        X = None
+        for phase, (onset, dur) in enumerate([(samp_onset, p.stim_samp_dur),
+                                              (targ_onset, p.stim_targ_dur)]):
+            table = self._response_table(dur, n_bins)
+            if X is None:
+                X = np.ones((n_sched, table.shape[1], 2 * n_cat + 1))
+            onset_bin = np.round(onset / self.dt).astype(np.intp)
+            bold = np.matmul(onehot, table[onset_bin])
+            X[:, :, phase * n_cat:(phase + 1) * n_cat] = bold.transpose(0, 2, 1)
+        return X
+
+    def _response_table(self, dur, n_bins):
+        """Sampled responses to an event starting in each bin of a run.
+
+        Row b holds the HRF-convolved boxcar of a dur second event that
+        starts in fine time bin b, sampled at every TR of a run n_bins
+        long. The tables are cached, so every possible response is only
+        convolved once and a design matrix is a gather and a sum.
+
+        """
+        key = dur, n_bins
+        if key not in self._tables:
+            n_dur = max(int(round(dur / self.dt)), 1)
+            kernel = np.convolve(np.ones(n_dur), self.hrf)
+            step = int(round(self.p.tr / self.dt))
+            lag = np.arange(0, n_bins, step) - np.arange(n_bins)[:, np.newaxis]
+            valid = (lag >= 0) & (lag < len(kernel))
+            lag = np.clip(lag, 0, len(kernel) - 1)
+            self._tables[key] = np.where(valid, kernel[lag], 0)
+        return self._tables[key]
+
+    def __call__(self, scheds, psi_tr=None, isi_tr=None, iti_tr=None):
+        """Return the estimation efficiency of each schedule (higher is better).
+
+        The jitters default as in design_matrices. Candidates are grouped
+        by the length of their run, so each design matrix has exactly as
+        many scans as its run.
+
+        """
+        scheds = np.atleast_2d(scheds)
+        jitters = self._default_jitters(scheds, psi_tr, isi_tr, iti_tr)
+        _, _, run_dur = self.onsets(*jitters)
+        n_bins = np.ceil(np.broadcast_to(run_dur, len(scheds)) / self.dt)
+
+        eff = np.empty(len(scheds))
+        for length in np.unique(n_bins):
+            rows = np.flatnonzero(n_bins == length)
+            for start in xrange(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                batch_jitters = [x if x.ndim < 2 else x[batch]
+                                 for x in jitters]
+                X = self.design_matrices(scheds[batch], *batch_jitters)
+                eff[batch] = self._efficiency(X)
+        return eff
+
+    def _efficiency(self, X):
+        """Score a stack of design matrices."""
+        XtX = np.matmul(X.transpose(0, 2, 1), X)
+
+        # A tiny ridge keeps schedules missing an event type invertible
+        # (with an efficiency of nearly 0) instead of raising an error
+        diag = np.arange(XtX.shape[-1])
+        ridge = 1e-9 * XtX[:, diag, diag].mean(axis=-1)
+        XtX[:, diag, diag] += ridge[:, np.newaxis]
+        XtX_inv = np.linalg.inv(XtX)
+        n_reg = X.shape[-1] - 1
+        variance = np.einsum("nii->n", XtX_inv[:, :n_reg, :n_reg])
+        return 1 / variance
+
+    def cost(self, scheds):
+        """Negative efficiency, for use as an optimize_event_schedule term."""
+        return -self(scheds)
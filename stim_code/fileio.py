@@ -0,0 +1,51 @@
+"""File helpers that are safe when several processes share a directory.
+
+These are used by the schedule cache, the session store and the ingest
+cache, which can all be written to from more than one process (or machine)
+at once.
+
+"""
+import os
+import os.path as op
+import tempfile
+
+
+def makedirs(dirname):
+    """Make a directory and its parents unless it already exists."""
+    if not op.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another process may have just made it
+            if not op.isdir(dirname):
+                raise
+
+
+def atomic_write(fname, write, mode="wb"):
+    """Write a file through a temporary file and a rename.
+
+    Parameters
+    ----------
+    fname: string
+        file to write
+    write: callable
+        called with the open temporary file to write its contents
+    mode: string
+        mode to open the temporary file with
+
+    Readers see either the old file or the complete new one. The temporary
+    file goes in the same directory (so the rename stays on one filesystem)
+    and ends in .tmp; it is removed if writing fails.
+
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=op.dirname(fname), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as fid:
+            write(fid)
+        os.rename(tmp_name, fname)
+    except:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,118 @@
+"""Report how long each module takes to import.
+
+The builtin __import__ is wrapped so that every import made while loading
+the given modules is timed. A module's cumulative time includes the
+modules it imports in turn; its self time doesn't. Only the first import
+of a module is counted, as later ones just look it up in sys.modules.
+
+Example:
+
+    python importtime.py make_schedule tools context_dmc -n 15
+
+"""
+from __future__ import division
+import sys
+import argparse
+import __builtin__
+from timeit import default_timer
+
+
+class ImportTimer(object):
+    """Times the imports made while it is active."""
+    def __init__(self):
+        self.cumulative = {}
+        self.own = {}
+        self.parents = {}
+        self._stack = []
+        self._import = None
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None,
+                      level=-1):
+        args = name, globals, locals, fromlist, level
+
+        # Don't time imports of modules that are already loaded
+        if self._resolve(name, globals, level) in sys.modules:
+            return self._import(*args)
+
+        self._stack.append([name, 0])
+        start = default_timer()
+        try:
+            return self._import(*args)
+        finally:
+            elapsed = default_timer() - start
+            _, children = self._stack.pop()
+            name = self._resolve(name, globals, level)
+            self.cumulative[name] = elapsed
+            self.own[name] = elapsed - children
+            self.parents[name] = self._parent(globals)
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def _resolve(self, name, globals, level):
+        """Full name of a module, which may be imported relative to a package.
+
+        Python 2 tries a plain import inside a package as a relative import
+        first, so "testing" in numpy/__init__.py means numpy.testing.
+
+        """
+        if not level or not globals:
+            return name
+        package = globals.get("__package__") or globals.get("__name__", "")
+        if "__path__" not in globals and not globals.get("__package__"):
+            package = package.rpartition(".")[0]
+        for i in range(max(level - 1, 0)):
+            package = package.rpartition(".")[0]
+        full_name = package + "." + name if package else name
+        if sys.modules.get(full_name) is not None:
+            return full_name
+        return name
+
+    def _parent(self, globals):
+        if not globals:
+            return None
+        return globals.get("__name__")
+
+    def report(self, n=20):
+        """Return lines for the n modules with the most cumulative time."""
+        names = sorted(self.cumulative, key=self.cumulative.get,
+                       reverse=True)[:n]
+        lines = ["%-30s %10s %10s  %s" % ("module", "cum (ms)", "self (ms)",
+                                          "imported by")]
+        for name in names:
+            lines.append("%-30s %10.1f %10.1f  %s" % (
+                name, self.cumulative[name] * 1000, self.own[name] * 1000,
+                self.parents[name] or "-"))
+        return lines
+
+
+def main(arglist):
+
+    args = parse_args(arglist)
+    with ImportTimer() as timer:
+        for name in args.modules:
+            start = default_timer()
+            __import__(name)
+            print "%s: %.1f ms" % (name, (default_timer() - start) * 1000)
+    print
+    print "\n".join(timer.report(args.n))
+
+
+def parse_args(arglist):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="+")
+    parser.add_argument("-n", type=int, default=20,
+                        help="number of modules to list")
+    return parser.parse_args(arglist)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,302 @@
+"""Load the trial data for every session of an experiment.
+
+Each data file (<subject>_<exp>_runNN_K.csv) is read along with the params
+.json saved next to it, and the scalar parameters are added as columns.
+When a session has the binary .npy copy written by trial_data.TrialWriter
+that is used instead of parsing the CSV.
+
+Parsed sessions are kept in a columnar cache under <data_dir>/.ingest:
+one .npz file of columns per session, a consolidated .npz of all sessions,
+and a manifest recording the size, mtime and content hash of each source
+file. Later loads only re-parse sessions whose files have changed (an mtime
+change with identical contents just updates the manifest), and when nothing
+has changed the consolidated file is all that is read.
+
+Example:
+
+    python ingest.py -data_dir data -jobs 0
+
+"""
+from __future__ import division
+import os
+import os.path as op
+import sys
+import re
+import glob
+import json
+import hashlib
+import argparse
+import multiprocessing
+from timeit import default_timer
+import numpy as np
+import pandas
+from fileio import makedirs, atomic_write
+
+# Bump this when a change to the parsing should invalidate the cache
+INGEST_VERSION = 2
+
+# Data files (and not, say, the frame timing logs next to them)
+_data_file_re = re.compile(r"_run\d+_\d+\.csv$")
+
+
+def load_sessions(data_dir="data", exp="context_dmc", n_jobs=0,
+                  verbose=False):
+    """Return a DataFrame with the trials from every session.
+
+    Parameters
+    ----------
+    data_dir: string
+        directory with the data files
+    exp: string
+        experiment name in the data file names
+    n_jobs: int
+        processes for parsing changed sessions (0 means all cores)
+    verbose: bool
+        report how many sessions had to be parsed
+
+    """
+    start = default_timer()
+    cache = IngestCache(op.join(data_dir, ".ingest"), exp)
+    manifest = cache.read_manifest()
+
+    # Work out which sessions need parsing
+    pattern = op.join(data_dir, "*_%s_run*.csv" % exp)
+    sources = sorted(f for f in glob.glob(pattern) if _data_file_re.search(f))
+    entries, to_parse = {}, []
+    for fname in sources:
+        session = op.basename(fname)
+        state = _file_state(fname)
+        old = manifest.get(session)
+        if old is not None and op.exists(cache.part_file(session)):
+            if old["state"] == state:
+                entries[session] = old
+                continue
+            if old["sha1"] == _file_hash(fname, state):
+                entries[session] = dict(old, state=state)
+                continue
+        to_parse.append(fname)
+
+    # Parse the new and changed sessions, possibly in parallel
+    n_jobs = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(to_parse))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        parsed = pool.map(parse_session, to_parse)
+        pool.close()
+        pool.join()
+    else:
+        parsed = map(parse_session, to_parse)
+
+    new_parts = []
+    for fname, (columns, order) in zip(to_parse, parsed):
+        session = op.basename(fname)
+        cache.write_part(session, columns, order)
+        new_parts.append((columns, order))
+        state = _file_state(fname)
+        entries[session] = dict(state=state, sha1=_file_hash(fname, state),
+                                n_trials=len(columns["trial"]))
+
+    # Update the consolidated file if any sessions changed
+    removed = set(manifest) - set(entries)
+    if to_parse or removed or not op.exists(cache.all_file):
+        stale = removed | set(op.basename(f) for f in to_parse)
+        if manifest and op.exists(cache.all_file):
+            # Drop the stale sessions from the old file and add the new ones
+            old, order = cache.read_all()
+            keep = ~np.in1d(old["session"], list(stale))
+            parts = [(dict((k, v[keep]) for k, v in old.items()), order)]
+        else:
+            parts = [cache.read_part(s) for s in sorted(entries)
+                     if s not in stale]
+        columns, order = _concat_columns(parts + new_parts)
+        cache.write_all(columns, order)
+        for session in removed:
+            cache.remove_part(session)
+    else:
+        columns, order = cache.read_all()
+    if entries != manifest:
+        cache.write_manifest(entries)
+
+    df = pandas.DataFrame(columns, columns=order)
+    if verbose:
+        print >> sys.stderr, ("Loaded %d sessions (%d parsed) in %.2f s"
+                              % (len(entries), len(to_parse),
+                                 default_timer() - start))
+    return df
+
+
+def parse_session(fname):
+    """Read one session's trials and params into a dict of columns.
+
+    Returns the columns and their order: the trial fields in the order the
+    experiment wrote them, then the parameters in sorted order.
+
+    """
+    npy_fname = op.splitext(fname)[0] + ".npy"
+    if op.exists(npy_fname):
+        data = np.load(npy_fname)
+        order = list(data.dtype.names)
+        columns = dict((name, data[name]) for name in order)
+    else:
+        df = pandas.read_csv(fname, comment="#")
+        order = list(df.columns)
+        columns = dict((name, df[name].values) for name in order)
+    n_trials = len(columns["trial"])
+
+    # Add the scalar parameters from the params json
+    json_fname = op.splitext(fname)[0] + ".json"
+    params = {}
+    if op.exists(json_fname):
+        with open(json_fname) as fid:
+            params = json.load(fid)
+    params["session"] = op.basename(fname)
+    for key, val in sorted(params.items()):
+        if key in columns or not isinstance(val, (bool, int, float,
+                                                  basestring)):
+            continue
+        if isinstance(val, unicode):
+            val = val.encode("utf-8")
+        columns[key] = np.repeat(np.array(val), n_trials)
+        order.append(key)
+
+    # Object columns (strings from the CSV reader) can't go in an .npz
+    for key, val in columns.items():
+        if val.dtype == object:
+            columns[key] = val.astype(str)
+    return columns, order
+
+
+def _file_state(fname):
+    """Size and mtime of the files that make up a session."""
+    state = []
+    for ext in [".csv", ".npy", ".json"]:
+        try:
+            stat = os.stat(op.splitext(fname)[0] + ext)
+            state.append([stat.st_size, stat.st_mtime])
+        except OSError:
+            state.append(None)
+    return state
+
+
+def _file_hash(fname, state):
+    """Hash the contents of the files that make up a session."""
+    sha1 = hashlib.sha1(str(INGEST_VERSION))
+    for ext, ext_state in zip([".csv", ".npy", ".json"], state):
+        if ext_state is None:
+            continue
+        with open(op.splitext(fname)[0] + ext, "rb") as fid:
+            for chunk in iter(lambda: fid.read(2 ** 20), b""):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class IngestCache(object):
+    """Files of the columnar session cache for one experiment."""
+    def __init__(self, cache_dir, exp):
+        self.cache_dir = cache_dir
+        self.part_dir = op.join(cache_dir, exp)
+        self.all_file = op.join(cache_dir, exp + "_sessions.npz")
+        self.manifest_file = op.join(cache_dir, exp + "_manifest.json")
+        makedirs(self.part_dir)
+
+    def part_file(self, session):
+        return op.join(self.part_dir, op.splitext(session)[0] + ".npz")
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_file) as fid:
+                manifest = json.load(fid)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get("version") != INGEST_VERSION:
+            return {}
+        return manifest["sessions"]
+
+    def write_manifest(self, entries):
+        text = json.dumps(dict(version=INGEST_VERSION, sessions=entries),
+                          sort_keys=True, indent=1)
+        atomic_write(self.manifest_file, lambda fid: fid.write(text))
+
+    def read_part(self, session):
+        """Return one session's columns and their order."""
+        return self._read_columns(self.part_file(session))
+
+    def write_part(self, session, columns, order):
+        self._write_columns(self.part_file(session), columns, order)
+
+    def remove_part(self, session):
+        try:
+            os.remove(self.part_file(session))
+        except OSError:
+            pass
+
+    def read_all(self):
+        """Return the consolidated columns and their order."""
+        return self._read_columns(self.all_file)
+
+    def write_all(self, columns, order):
+        self._write_columns(self.all_file, columns, order)
+
+    def _read_columns(self, fname):
+        with np.load(fname) as npz:
+            columns = dict(npz.items())
+        order = [str(c) for c in columns.pop("__columns__")]
+        return columns, order
+
+    def _write_columns(self, fname, columns, order):
+        # The .npz keys come back unordered, so store the order with them
+        columns = dict(columns, __columns__=np.array(order, str))
+        atomic_write(fname, lambda fid: np.savez(fid, **columns))
+
+
+def _concat_columns(parts):
+    """Stack (columns, order) parts, with rows sorted by session.
+
+    A column missing from some parts is filled with empty strings or NaN
+    there. Returns the columns and the column order, which follows the
+    first part and adds new columns in the order they are seen.
+
+    """
+    order = []
+    for _, part_order in parts:
+        order.extend(k for k in part_order if k not in order)
+    parts = [part for part, _ in parts]
+
+    columns = {}
+    for name in order:
+        like = [part[name] for part in parts if name in part][0]
+        if like.dtype.kind in "SU":
+            fill = np.array("", like.dtype)
+        else:
+            fill = np.array(np.nan)
+        columns[name] = np.concatenate([
+            part[name] if name in part else
+            np.repeat(fill, len(part["session"])) for part in parts])
+
+    if not columns:
+        return columns, order
+    index = np.argsort(columns["session"], kind="mergesort")
+    columns = dict((k, v[index]) for k, v in columns.items())
+    return columns, order
+
+
+def main(arglist):
+
+    args = parse_args(arglist)
+    df = load_sessions(args.data_dir, args.exp, args.jobs, verbose=True)
+    if len(df):
+        print "%d trials from %d sessions" % (len(df), df.session.nunique())
+
+
+def parse_args(arglist):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-data_dir", default="data")
+    parser.add_argument("-exp", default="context_dmc")
+    parser.add_argument("-jobs", type=int, default=0,
+                        help="number of processes (0 means all cores)")
+    return parser.parse_args(arglist)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
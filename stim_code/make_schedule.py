@@ -1,41 +1,139 @@
 from __future__ import division
 import sys
+import os
 import os.path as op
-from numpy.random import permutation
-from pandas import DataFrame
+import argparse
+import zlib
+import multiprocessing
+import numpy as np
 import tools
+import design
+from schedule_cache import ScheduleCache
+
+# Each event type gets each of these jitters (in TRs) twice per run
+JITTER_TRS = [1, 2, 3]
 
 
 def main(arglist):
 
+    args = parse_args(arglist)
     p = tools.Params("context_dmc")
 
-    for run in range(1, p.n_runs + 1):
-        df = build_run_schedule(p, run)
-        fname = op.join("schedules", "run_%02d.csv" % run)
+    # Pick a master seed so the whole set can be regenerated
+    seed = args.seed
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+        print "Master seed: %d (pass -seed %d to reuse cached schedules)" \
+            % (seed, seed)
+
+    # Set up one task per schedule file
+    subjects = args.subjects if args.subjects else [None]
+    cache = None if args.no_cache else (args.cache_dir, args.cache_mb)
+    tasks = [(subj, run, seed, args.method, args.efficiency, cache)
+             for subj in subjects for run in range(1, p.n_runs + 1)]
+
+    # Build the schedules, possibly in parallel
+    n_jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    if n_jobs == 1:
+        results = (_build_task(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+        results = pool.imap_unordered(_build_task, tasks)
+
+    for i, (subj, run, df) in enumerate(results, 1):
+        sched_dir = "schedules" if subj is None else op.join("schedules", subj)
+        if not op.isdir(sched_dir):
+            os.makedirs(sched_dir)
+        fname = op.join(sched_dir, "run_%02d.csv" % run)
         df.to_csv(fname, index_label="trial")
+        if not args.quiet:
+            print >> sys.stderr, "[%d/%d] Wrote %s" % (i, len(tasks), fname)
+
+    if n_jobs > 1:
+        pool.close()
+        pool.join()
+
+
+def parse_args(arglist):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-seed", type=int,
+                        help="master seed for all schedules; without it a "
+                             "new seed is drawn (and printed), so cached "
+                             "schedules are only reused when this is given")
+    parser.add_argument("-subjects", nargs="*",
+                        help="write a schedule set for each subject")
+    parser.add_argument("-method", default="search",
+                        choices=["search", "construct"],
+                        help="search over random schedules or construct a "
+                             "counterbalanced one directly")
+    parser.add_argument("-efficiency", type=float, default=0,
+                        help="weight on GLM estimation efficiency when "
+                             "searching for the event order")
+    parser.add_argument("-cache_dir", default=".schedule_cache",
+                        help="directory for caching optimized event orders")
+    parser.add_argument("-cache_mb", type=float, default=50,
+                        help="size limit of the schedule cache in MB")
+    parser.add_argument("-no_cache", action="store_true",
+                        help="always optimize the event orders from scratch")
+    parser.add_argument("-jobs", type=int, default=1,
+                        help="number of processes (0 means all cores)")
+    parser.add_argument("-quiet", action="store_true",
+                        help="don't report progress as schedules finish")
+    return parser.parse_args(arglist)
+
+
+def run_seed(master_seed, subject, run):
+    """Seed sequence for one run that doesn't depend on the task order."""
+    subj_key = 0 if subject is None else zlib.crc32(subject) & 0xffffffff
+    return [master_seed, subj_key, run]
+
+
+def _build_task(task):
+    """Build one run's schedule in a (possibly worker) process."""
+    subj, run, seed, method, efficiency, cache = task
+    p = tools.Params("context_dmc")
+    if cache is not None:
+        cache_dir, cache_mb = cache
+        cache = ScheduleCache(cache_dir, int(cache_mb * 2 ** 20))
+    df = build_run_schedule(p, run, run_seed(seed, subj, run), method,
+                            efficiency, cache)
+    return subj, run, df
 
 
-def build_run_schedule(p, run):
+def schedule_metrics(events, n_cat):
+    """Summarize the design quality of an event order for the cache."""
+    ev_count = np.bincount(events, minlength=n_cat)
+    cb1_mat = design.cb1_prob(np.asarray(events) + 1, ev_count)
+    cb1_cost = design.cb1_cost(design.cb1_ideal(ev_count), cb1_mat)
+    bal_cost = design.balance_cost_batch([events], n_cat)[0]
+    return dict(cb1_cost=float(cb1_cost), balance_cost=float(bal_cost))
 
-    # Generate a schedule of events (context/category conjunction)
-    events = tools.optimize_event_schedule(4,
-                p.trials_per_run, p.trials_per_run,
-                n_search=5000, enforce_balance=True)
+
+def build_run_schedule(p, run, seed=None, method="search", efficiency=0,
+                       cache=None):
+
+    # Use separate random streams for the event order and the groupings
+    if seed is None:
+        event_rs = group_rs = np.random
+    else:
+        event_rs = np.random.RandomState(seed + [0])
+        group_rs = np.random.RandomState(seed + [1])
 
     # Set up original groupings
     attend = [range(3) * 2 for i in range(4)]
     igncat = [range(2) * 3 for i in range(4)]
     ignexm = [[range(3), range(3)] for i in range(4)]
 
-    psi_tr = [range(1, 4) * 2 for i in range(4)]
-    isi_tr = [range(1, 4) * 2 for i in range(4)]
-    iti_tr = [range(1, 4) * 2 for i in range(4)]
+    psi_tr = [JITTER_TRS * 2 for i in range(4)]
+    isi_tr = [JITTER_TRS * 2 for i in range(4)]
+    iti_tr = [JITTER_TRS * 2 for i in range(4)]
 
     # TODO this is shitty, do it better
     match_event = [range(2) * 3 for i in range(4)]
 
     # Randomize within groupings
+    permutation = group_rs.permutation
     scramble = lambda x: [permutation(l).tolist() for l in x]
     attend = scramble(attend)
     igncat = scramble(igncat)
@@ -48,6 +146,44 @@ def build_run_schedule(p, run):
     # TODO also shitty
     match_event = scramble(match_event)
 
+    # Generate a schedule of events (context/category conjunction)
+    def make_events():
+        if method == "construct":
+            events = design.counterbalanced_schedule(4,
+                        p.trials_per_run, p.trials_per_run,
+                        random_state=event_rs)
+        else:
+            objectives = dict(balance=1, cb1=1)
+            if efficiency:
+                # Score each order with the jitters its trials will get,
+                # which are popped off the end of each event's list below
+                jitters = [np.array(x)[:, ::-1] for x in (cue_tr, isi_tr,
+                                                          iti_tr)]
+                eff_cost = design.DesignEfficiency(p, 4,
+                                                   jitters=jitters).cost
+                objectives["efficiency"] = efficiency, eff_cost
+            events = design.optimize_event_schedule(4,
+                        p.trials_per_run, p.trials_per_run,
+                        n_search=5000, enforce_balance=True,
+                        objectives=objectives, random_state=event_rs)
+        return events, schedule_metrics(events, 4)
+
+    # Possibly reuse the event order from a previous call with the same design
+    if cache is None or seed is None:
+        events, _ = make_events()
+    else:
+        spec = dict(n_cat=4, n_total=p.trials_per_run,
+                    max_repeat=p.trials_per_run, n_search=5000,
+                    enforce_balance=True, method=method, seed=seed)
+        if efficiency and method == "search":
+            # The efficiency score also depends on the trial timing
+            spec["efficiency"] = efficiency
+            spec["timing"] = dict((name, getattr(p, name)) for name in
+                                  design.DesignEfficiency.timing_params)
+            spec["jitter_trs"] = JITTER_TRS
+        events, _ = cache.get_or_compute(spec, make_events)
+    events = events.astype(int)
+
     # Set up blank schedule vectors
     context = []
     a_categ = []
@@ -79,7 +215,9 @@ def build_run_schedule(p, run):
 
         match.append(match_event[event].pop())
 
-    # Create a Pandas DataFrame
+    # Create a Pandas DataFrame (pandas is slow to import, so only do it
+    # when a schedule is actually made)
+    from pandas import DataFrame
     df = DataFrame(dict(
         context=context,
         attend_cat=a_categ,
@@ -8,6 +8,7 @@ cni_lcd = dict(monitor_name='cni_lcd',
                width=64.3, # in cm. 25.5 inches(!)
                distance=190, # viewing distance in cm
                size=[2560, 1600],  # in pixels
+               refresh_hz=60,
                notes=dedent("""
                Parameters taken from the CNI wiki:
                http://cni.stanford.edu/wiki/MR_Hardware#Flat_Panel. 
@@ -18,12 +19,14 @@ cni_lcd = dict(monitor_name='cni_lcd',
 mlw_mbpro = dict(monitor_name='mlw-mbpro',
                  width=33.2,
                  size=[1400, 900],
+                 refresh_hz=60,
                  distance=63,
                  notes="")
 
 ben_octocore = dict(monitor_name='ben-octocore',
                     width=43.5,
                     size=[1680, 1050],
+                    refresh_hz=60,
                     distance=60,
                     notes=dedent("""Horizontal monitor on the Mac Pro
                                  in MLW's office."""))
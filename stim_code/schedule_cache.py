@@ -0,0 +1,199 @@
+"""Content-addressed on-disk cache of optimized event schedules.
+
+Results are keyed by a hash of everything that determines them (the design
+parameters, the optimizer settings and the seed). Each entry is a small JSON
+file holding the cost metrics and the hash of the schedule itself, which is
+stored once as a binary .npy blob, so identical schedules produced for
+different runs or subjects share storage. The entry files' modification
+times double as access times for least-recently-used eviction.
+
+All writes go through a temporary file and an atomic rename, so several
+processes can share one cache directory. A blob is written before the entry
+that refers to it, so eviction leaves recent unreferenced blobs alone, and
+an entry whose blob has gone anyway just counts as a miss.
+
+"""
+from __future__ import division
+import os
+import os.path as op
+import json
+import time
+import hashlib
+import numpy as np
+from fileio import makedirs, atomic_write
+
+# Bump this when a change to the optimizers should invalidate old results
+CACHE_VERSION = 1
+
+# Seconds an unreferenced blob is kept, as its entry may still be coming
+ORPHAN_GRACE = 60
+
+
+class ScheduleCache(object):
+    """Size-bounded LRU cache of schedules on disk."""
+    def __init__(self, cache_dir=".schedule_cache", max_bytes=50 * 2 ** 20):
+        """Set up the cache directory.
+
+        Parameters
+        ----------
+        cache_dir: string
+            directory to hold the cache
+        max_bytes: int
+            total size of the cache files above which old entries are evicted
+
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entry_dir = op.join(cache_dir, "entries")
+        self.blob_dir = op.join(cache_dir, "blobs")
+        for d in [self.entry_dir, self.blob_dir]:
+            makedirs(d)
+
+    def key(self, params):
+        """Hash a dict of JSON-serializable parameters into a cache key."""
+        params = dict(params, cache_version=CACHE_VERSION)
+        text = json.dumps(params, sort_keys=True)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def get(self, params):
+        """Return (schedule, metrics) for these parameters, or None.
+
+        A missing or unreadable entry or blob is a miss.
+
+        """
+        entry_file = self._entry_file(self.key(params))
+        try:
+            with open(entry_file) as fid:
+                entry = json.load(fid)
+            sched = np.load(self._blob_file(entry["blob"]))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(entry_file, None)
+        except OSError:
+            pass
+
+        return sched, entry["metrics"]
+
+    def put(self, params, schedule, metrics=None):
+        """Store a schedule and its cost metrics under these parameters."""
+        schedule = np.asarray(schedule)
+        if schedule.min() >= 0 and schedule.max() < 256:
+            schedule = schedule.astype(np.uint8)
+
+        # Store the schedule by its content so duplicates share a blob
+        blob = hashlib.sha1(schedule.dtype.str.encode("utf-8") +
+                            str(schedule.shape).encode("utf-8") +
+                            schedule.tobytes()).hexdigest()
+        blob_file = self._blob_file(blob)
+        try:
+            # Keep an existing blob from looking like an old orphan
+            os.utime(blob_file, None)
+        except OSError:
+            atomic_write(blob_file, lambda fid: np.save(fid, schedule))
+
+        entry = dict(params=params, blob=blob, metrics=metrics or {})
+        text = json.dumps(entry, sort_keys=True, indent=1)
+        atomic_write(self._entry_file(self.key(params)),
+                     lambda fid: fid.write(text))
+
+        self.evict()
+
+    def get_or_compute(self, params, compute):
+        """Look up a schedule, calling compute() to make it on a miss.
+
+        compute should return a (schedule, metrics) pair.
+
+        """
+        hit = self.get(params)
+        if hit is not None:
+            return hit
+        schedule, metrics = compute()
+        self.put(params, schedule, metrics)
+        return np.asarray(schedule), metrics
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its size.
+
+        A blob is removed (and its size credited) along with the last entry
+        that refers to it, so only as many entries go as are needed.
+
+        """
+        entries = self._listdir(self.entry_dir)
+        blobs = dict((op.splitext(op.basename(fname))[0], (fname, size, mtime))
+                     for fname, size, mtime in self._listdir(self.blob_dir))
+        total = (sum(size for _, size, _ in entries) +
+                 sum(size for _, size, _ in blobs.values()))
+        if total <= self.max_bytes:
+            return
+
+        # Count the entries that refer to each blob
+        refs = {}
+        entries = [entry + (self._entry_blob(entry[0]),) for entry in entries]
+        for _, _, _, blob in entries:
+            refs[blob] = refs.get(blob, 0) + 1
+
+        def remove_blob(blob):
+            fname, size, _ = blobs.pop(blob)
+            self._remove(fname)
+            return size
+
+        # Remove blobs that nothing refers to, unless they are recent enough
+        # to belong to an entry that is still being written
+        cutoff = time.time() - ORPHAN_GRACE
+        for blob, (_, _, mtime) in blobs.items():
+            if blob not in refs and mtime < cutoff:
+                total -= remove_blob(blob)
+
+        # Remove the oldest entries first, with the blobs only they used
+        entries.sort(key=lambda x: x[2])
+        for fname, size, _, blob in entries:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            self._remove(fname)
+            refs[blob] -= 1
+            if not refs[blob] and blob in blobs:
+                total -= remove_blob(blob)
+
+    def clear(self):
+        """Remove everything from the cache."""
+        for fname, _, _ in (self._listdir(self.entry_dir) +
+                            self._listdir(self.blob_dir)):
+            self._remove(fname)
+
+    def _entry_file(self, key):
+        return op.join(self.entry_dir, key + ".json")
+
+    def _blob_file(self, blob):
+        return op.join(self.blob_dir, blob + ".npy")
+
+    def _entry_blob(self, fname):
+        """Name of the blob an entry file refers to, or None."""
+        try:
+            with open(fname) as fid:
+                return json.load(fid)["blob"]
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _listdir(self, dirname):
+        """Return (path, size, mtime) for each finished file in dirname."""
+        files = []
+        for name in os.listdir(dirname):
+            if name.endswith(".tmp"):
+                continue
+            fname = op.join(dirname, name)
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            files.append((fname, stat.st_size, stat.st_mtime))
+        return files
+
+    def _remove(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
@@ -0,0 +1,171 @@
+"""Index of the data files written for each subject.
+
+Data files are named <subject>_<experiment>_run<NN>_<attempt>.csv. Rather
+than listing the data directory to find a free attempt number, the store
+keeps one small index file per subject under data/.index/ with a JSON line
+for each file it has created. Starting a run and looking up a subject's
+sessions then only read that subject's index, however many files are in
+the data directory.
+
+New files are created with O_CREAT | O_EXCL, so two machines sharing a
+data directory can never be given the same file; the loser of a race just
+moves on to the next attempt number. Index lines are appended with a single
+write on a file opened with O_APPEND, so concurrent appends don't mix.
+
+"""
+from __future__ import division
+import os
+import os.path as op
+import re
+import json
+import time
+import errno
+from fileio import makedirs, atomic_write
+
+_fname_re = re.compile(r"^(?P<subject>.+?)_(?P<exp>.+)"
+                       r"_run(?P<run>\d+)_(?P<attempt>\d+)\.csv$")
+
+
+class SessionStore(object):
+    """Allocates data files and looks up the sessions for a subject."""
+    def __init__(self, data_dir="./data", experiments=None):
+        """Set up the store.
+
+        Parameters
+        ----------
+        data_dir: string
+            directory holding the data files
+        experiments: list of strings, optional
+            experiment names, used to split file names when rebuilding the
+            index (subject ids and experiment names can both contain "_")
+
+        """
+        self.data_dir = data_dir
+        self.index_dir = op.join(data_dir, ".index")
+        self.experiments = experiments
+        makedirs(self.index_dir)
+
+    def data_file(self, subject, exp, run, attempt):
+        """Name of the data file for one attempt at a run."""
+        return "%s_%s_run%02d_%d.csv" % (subject, exp, run, attempt)
+
+    def create(self, subject, exp, run):
+        """Create the next data file for this run and open it for writing.
+
+        Returns the open file and its name (relative to the data directory).
+
+        """
+        attempts = [s["attempt"] for s in self.sessions(subject, exp, run)]
+        attempt = max(attempts) + 1 if attempts else 1
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        while True:
+            fname = self.data_file(subject, exp, run, attempt)
+            path = op.join(self.data_dir, fname)
+            try:
+                os.close(os.open(path, flags, 0o644))
+                break
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+                attempt += 1
+
+        self._append(subject, dict(subject=subject, exp=exp, run=run,
+                                   attempt=attempt, fname=fname,
+                                   time=time.time()))
+        # Reopen by name now that the file is ours, so it knows its path
+        return open(path, "w"), fname
+
+    def sessions(self, subject, exp=None, run=None):
+        """Return the index records for a subject, possibly filtered.
+
+        Each record is a dict with subject, exp, run, attempt, fname and
+        (creation) time keys, in the order the files were created.
+
+        """
+        records = []
+        try:
+            fid = open(self._index_file(subject))
+        except IOError:
+            return records
+        with fid:
+            for line in fid:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # Skip a line cut short by a crash
+                    continue
+                if exp is not None and rec["exp"] != exp:
+                    continue
+                if run is not None and rec["run"] != run:
+                    continue
+                records.append(rec)
+        return records
+
+    def latest(self, subject, exp, run):
+        """Name of the most recent data file for a run, or None."""
+        records = self.sessions(subject, exp, run)
+        if not records:
+            return None
+        return max(records, key=lambda r: r["attempt"])["fname"]
+
+    def subjects(self):
+        """List the subjects that have an index."""
+        return sorted(op.splitext(f)[0] for f in os.listdir(self.index_dir)
+                      if f.endswith(".jsonl"))
+
+    def rebuild_index(self):
+        """Recreate every subject's index from a scan of the data directory.
+
+        This is only needed for data written before the index existed or
+        after files were moved around by hand.
+
+        """
+        by_subject = {}
+        for fname in sorted(os.listdir(self.data_dir)):
+            rec = self._parse(fname)
+            if rec is None:
+                continue
+            stat = os.stat(op.join(self.data_dir, fname))
+            rec["time"] = stat.st_mtime
+            by_subject.setdefault(rec["subject"], []).append(rec)
+
+        for subject, records in by_subject.items():
+            records.sort(key=lambda r: (r["time"], r["attempt"]))
+            text = "".join(json.dumps(r, sort_keys=True) + "\n"
+                           for r in records)
+            atomic_write(self._index_file(subject),
+                         lambda fid: fid.write(text), "w")
+        return sorted(by_subject)
+
+    def _parse(self, fname):
+        """Split a data file name into an index record, or return None."""
+        if self.experiments is not None:
+            for exp in self.experiments:
+                match = re.match(r"^(.+)_%s_run(\d+)_(\d+)\.csv$"
+                                 % re.escape(exp), fname)
+                if match:
+                    subject, run, attempt = match.groups()
+                    break
+            else:
+                return None
+        else:
+            match = _fname_re.match(fname)
+            if match is None:
+                return None
+            subject, exp, run, attempt = match.group("subject", "exp",
+                                                     "run", "attempt")
+        return dict(subject=subject, exp=exp, run=int(run),
+                    attempt=int(attempt), fname=fname)
+
+    def _index_file(self, subject):
+        return op.join(self.index_dir, subject + ".jsonl")
+
+    def _append(self, subject, record):
+        """Add a record to a subject's index with one atomic append."""
+        line = json.dumps(record, sort_keys=True) + "\n"
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        fd = os.open(self._index_file(subject), flags, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
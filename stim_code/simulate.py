@@ -0,0 +1,264 @@
+"""Run the context_dmc experiment with simulated participants.
+
+Each session runs context_dmc.run_experiment on the headless backend with
+a key script generated from a synthetic observer's responses, so the data
+files come from the same trial loop, response scoring and logging as a
+real run. The recorded trials are then checked against what the observer
+did, which catches regressions anywhere between the keyboard and the data
+file. Sessions are spread over worker processes.
+
+Example:
+
+    python simulate.py -subjects 20 -data_dir sim_data -jobs 0
+
+"""
+from __future__ import division
+import os
+import os.path as op
+import sys
+import argparse
+import multiprocessing
+from timeit import default_timer
+import numpy as np
+import pandas
+import backend
+import tools
+import context_dmc
+from session_store import SessionStore
+from trial_data import load_trials
+
+# Time of the scanner trigger on the virtual clock; the run starts on the
+# first flip after it
+TRIGGER_TIME = 5
+
+
+class Observer(object):
+    """Synthetic participant with fixed accuracy and response timing."""
+    def __init__(self, accuracy=None, rt_mean=.7, rt_sd=.2, miss_rate=.05,
+                 late_rate=.02):
+        """Set the observer's behavior.
+
+        Parameters
+        ----------
+        accuracy: dict, optional
+            probability of a correct response in each context
+        rt_mean, rt_sd: floats
+            mean and standard deviation of the (lognormal) RT distribution
+            in seconds
+        miss_rate: float
+            probability of not responding on a trial
+        late_rate: float
+            probability of responding after the response window, during
+            the ITI
+
+        """
+        if accuracy is None:
+            accuracy = dict(color=.9, orient=.8)
+        self.accuracy = accuracy
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self.miss_rate = miss_rate
+        self.late_rate = late_rate
+
+    def respond(self, p, plan, random_state=None):
+        """Decide the response and RT for every trial in a plan.
+
+        Returns arrays of responses (1 for match, 2 for nonmatch and -1 for
+        no response) and RTs from the response cue onset (-1 when there is
+        no response).
+
+        """
+        if random_state is None:
+            random_state = np.random
+        n_trials = len(plan)
+
+        accuracy = np.array([self.accuracy[c] for c in plan["context"]])
+        correct = random_state.rand(n_trials) < accuracy
+        is_match = plan["match"].astype(bool)
+        response = np.where(correct == is_match, 1, 2)
+
+        sigma2 = np.log(1 + (self.rt_sd / self.rt_mean) ** 2)
+        rt = random_state.lognormal(np.log(self.rt_mean) - sigma2 / 2,
+                                    np.sqrt(sigma2), n_trials)
+        rt = np.clip(rt, .1, p.resp_dur - .1)
+
+        # Late responses fall somewhere in the middle of the ITI
+        outcome = random_state.rand(n_trials)
+        late = (outcome < self.late_rate) & (plan["iti_secs"] > 0)
+        iti_frac = random_state.uniform(.2, .8, n_trials)
+        rt[late] = p.resp_dur + iti_frac[late] * plan["iti_secs"][late]
+
+        missed = ((outcome >= self.late_rate) &
+                  (outcome < self.late_rate + self.miss_rate))
+        response[missed] = -1
+        rt[missed] = -1
+        return response, rt
+
+
+def key_script(p, plan, response, rt):
+    """Turn responses into key presses on the virtual clock.
+
+    Returns the (time, key) presses that start the run and an on_flip
+    callback for the backend. Response times are relative to the run
+    start, which is the first flip after the trigger, so the callback
+    schedules the responses from that flip's time when it happens.
+
+    """
+    keys = [(0, "space"), (TRIGGER_TIME, "5")]
+    resp_keys = {1: p.match_keys[0], 2: p.nonmatch_keys[0]}
+    responses = [(trial["resp_onset"] + resp_rt, resp_keys[resp])
+                 for trial, resp, resp_rt in zip(plan, response, rt)
+                 if resp != -1]
+
+    def on_flip(win):
+        run_start = win.backend.now
+        if responses and run_start > TRIGGER_TIME:
+            win.backend.press([(run_start + t, key) for t, key in responses])
+            del responses[:]
+
+    return keys, on_flip
+
+
+def simulate_session(subject, run, observer, seed=None, data_dir="data"):
+    """Run one simulated session and check the data it wrote.
+
+    The run uses the current directory's schedules and writes its files to
+    data_dir. Returns a dict with the data file name, number of trials and
+    number of trials whose recorded response, accuracy or RT disagree with
+    what the observer did.
+
+    The observer responds to a plan compiled from the same seed that the
+    global numpy state gets for the run (the caller's state is restored
+    afterwards), so it sees the trials the run will show. The recorded
+    trials are checked against the plan the run saved, and if that differs
+    every trial counts as an error.
+
+    """
+    rs = np.random.RandomState(seed)
+    run_seed = rs.randint(2 ** 31)
+    args = ["-subject", subject, "-run", str(run), "-fmri", "-headless"]
+    p = tools.Params("context_dmc")
+    p.set_by_cmdline(args)
+    s = pandas.read_csv(context_dmc.schedule_file(subject, run))
+    plan = context_dmc.compile_trial_plan(p, s,
+                                          np.random.RandomState(run_seed))
+    response, rt = observer.respond(p, plan, rs)
+    keys, on_flip = key_script(p, plan, response, rt)
+
+    rng_state = np.random.get_state()
+    try:
+        with backend.headless_run(data_dir, keys=keys, on_flip=on_flip):
+            np.random.seed(run_seed)
+            context_dmc.run_experiment(args)
+    finally:
+        np.random.set_state(rng_state)
+
+    fname = SessionStore(data_dir).latest(subject, "context_dmc", run)
+    data = load_trials(op.join(data_dir, fname), mmap_mode=None)
+    run_plan = np.load(op.join(data_dir, op.splitext(fname)[0] + "_plan.npy"))
+    if np.array_equal(plan, run_plan):
+        n_errors = check_trials(plan, data, response, rt)
+    else:
+        n_errors = len(plan)
+    return dict(subject=subject, run=run, fname=fname,
+                n_trials=len(data), n_errors=n_errors)
+
+
+def check_trials(plan, data, response, rt, tolerance=2 / 60):
+    """Count recorded trials that disagree with the intended responses."""
+    if len(data) != len(plan):
+        return len(plan)
+    expected_acc = np.where(response == -1, 0,
+                            (response == 1) == plan["match"].astype(bool))
+    rt_error = np.abs(data["rt"] - rt)
+    bad = ((data["response"] != response) |
+           (data["acc"] != expected_acc) |
+           (rt_error > tolerance) |
+           (data["trial"] != plan["trial"]) |
+           (data["context"] != plan["context"]))
+    return int(bad.sum())
+
+
+def _run_job(job):
+    """Pool wrapper around simulate_session."""
+    subject, run, observer, seed, data_dir = job
+    return simulate_session(subject, run, observer, seed, data_dir)
+
+
+def simulate_study(subjects, runs, observer, data_dir="data", n_jobs=0,
+                   seed=None):
+    """Simulate every run for every subject, in parallel.
+
+    Returns a DataFrame with a row of results for each session.
+
+    """
+    if not op.isdir(data_dir):
+        os.makedirs(data_dir)
+    sessions = [(subject, run) for subject in subjects for run in runs]
+    seeds = np.random.RandomState(seed).randint(2 ** 31, size=len(sessions))
+    jobs = [(subject, run, observer, job_seed, data_dir)
+            for (subject, run), job_seed in zip(sessions, seeds)]
+
+    n_jobs = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(jobs))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        results = pool.map(_run_job, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_run_job, jobs)
+    return pandas.DataFrame(results, columns=["subject", "run", "fname",
+                                              "n_trials", "n_errors"])
+
+
+def main(arglist):
+
+    args = parse_args(arglist)
+    if args.runs is None:
+        args.runs = range(1, tools.Params("context_dmc").n_runs + 1)
+    subjects = ["sim%03d" % (i + 1) for i in range(args.subjects)]
+    observer = Observer(dict(color=args.acc_color, orient=args.acc_orient),
+                        args.rt_mean, args.rt_sd, args.miss, args.late)
+
+    start = default_timer()
+    results = simulate_study(subjects, args.runs, observer, args.data_dir,
+                             args.jobs, args.seed)
+    elapsed = default_timer() - start
+
+    print "Simulated %d sessions (%d trials) in %.1f s" % (
+        len(results), results.n_trials.sum(), elapsed)
+    bad = results[results.n_errors > 0]
+    if len(bad):
+        print "%d sessions recorded trials that don't match the observer:" % (
+            len(bad))
+        print bad.to_string(index=False)
+        return 1
+    print "All recorded trials match the simulated responses"
+    return 0
+
+
+def parse_args(arglist):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-subjects", type=int, default=1,
+                        help="number of simulated subjects")
+    parser.add_argument("-runs", type=int, nargs="*",
+                        help="runs to simulate (default is all of them)")
+    parser.add_argument("-data_dir", default="sim_data")
+    parser.add_argument("-jobs", type=int, default=0,
+                        help="number of processes (0 means all cores)")
+    parser.add_argument("-seed", type=int)
+    parser.add_argument("-acc_color", type=float, default=.9)
+    parser.add_argument("-acc_orient", type=float, default=.8)
+    parser.add_argument("-rt_mean", type=float, default=.7)
+    parser.add_argument("-rt_sd", type=float, default=.2)
+    parser.add_argument("-miss", type=float, default=.05,
+                        help="proportion of trials without a response")
+    parser.add_argument("-late", type=float, default=.02,
+                        help="proportion of responses after the window")
+    return parser.parse_args(arglist)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+from __future__ import division
+import os
+import os.path as op
+import sys
+import nose.tools as nt
+import numpy.testing as npt
+import backend
+from trial_data import load_trials
+
+
+def test_headless_backend():
+
+    previous = backend.active()
+    b = backend.use("headless", keys=[(1, "space"), (1.5, "1"), (3, "q")])
+    try:
+        # Waits and flips should only move the virtual clock
+        clock = backend.core.Clock()
+        backend.core.wait(1)
+        win = backend.visual.Window(size=(100, 100))
+        stim = backend.visual.TextStim(win, text="hi")
+        stim.draw()
+        win.flip()
+        yield npt.assert_almost_equal, 1 + 1 / 60, clock.getTime()
+        yield nt.assert_equal, [stim], win.frames[0][1]
+
+        # Keys outside keyList should stay in the buffer
+        yield nt.assert_equal, ["space"], backend.event.getKeys(["space"])
+        backend.core.wait(1)
+        yield (nt.assert_equal,
+               [("1", 1.5)],
+               backend.event.getKeys(timeStamped=True))
+        yield nt.assert_equal, [(3, "q")], b.pending
+        backend.event.clearEvents()
+        yield nt.assert_equal, 1, len(b.pending)
+
+        # A run that waits forever should stop at the time limit
+        b.time_limit = 10
+        nt.assert_raises(RuntimeError, backend.core.wait, 10)
+    finally:
+        backend.use(previous or "headless")
+
+
+def test_headless_run():
+
+    import context_dmc
+
+    # Answer "match" every half second, from well into the run
+    keys = [(0, "space")] + [(10 + t / 2, "2") for t in range(1000)]
+    with backend.headless_run(keys=keys):
+        context_dmc.run_experiment(["-headless", "-subject", "s01"])
+        data = load_trials("data/s01_context_dmc_run01_1.csv")
+        written = [op.exists("data/s01_context_dmc_run01_1" + ext)
+                   for ext in [".json", "_frames.csv", "_keys.csv",
+                               "_plan.npy"]]
+
+    yield nt.assert_equal, 24, len(data)
+    yield nt.assert_true, (data["response"] == 1).all()
+    yield nt.assert_true, (data["rt"] > 0).all()
+    yield nt.assert_equal, [True] * 4, written
+
+
+def test_headless_run_restores():
+
+    orig_dir, orig_stdout = os.getcwd(), sys.stdout
+    previous = backend.active()
+    try:
+        with backend.headless_run(refresh_hz=100) as b:
+            scratch = os.getcwd()
+            made = op.isdir("data"), op.isdir("schedules")
+            raise ValueError
+    except ValueError:
+        pass
+
+    # Everything should be put back even when the run fails
+    yield nt.assert_equal, 1 / 100, b.frame_dur
+    yield nt.assert_equal, (True, True), made
+    yield nt.assert_equal, orig_dir, os.getcwd()
+    yield nt.assert_true, sys.stdout is orig_stdout
+    yield nt.assert_true, backend.active() is previous
+    yield nt.assert_false, op.exists(scratch)
+
+
+def test_headless_quit_with_write_error():
+
+    import context_dmc
+
+    # Quit partway through a run whose plan can't be saved
+    with backend.headless_run(keys=[(0, "space"), (30, "q")]):
+        os.mkdir("data/s01_context_dmc_run01_1_plan.npy")
+
+        # The quit should get through rather than the write error
+        nt.assert_raises(SystemExit, context_dmc.run_experiment,
+                         ["-headless", "-subject", "s01"])
+
+
+def test_headless_training():
+
+    import category_train
+    from StringIO import StringIO
+    orig_stdout = sys.stdout
+    previous = backend.active()
+    try:
+        # Run with the default headless setup, as from the command line
+        backend.use(None)
+        sys.stdout = output = StringIO()
+        category_train.run_experiment(["-headless"])
+    finally:
+        sys.stdout = orig_stdout
+        backend.use(previous or "headless")
+
+    # Every answer is right, so each context needs just its good blocks
+    lines = output.getvalue().splitlines()
+    yield nt.assert_equal, "Training done!", lines[0]
+    yield nt.assert_equal, "Total color blocks: 2", lines[1]
+    yield nt.assert_equal, "Total orient blocks: 2", lines[2]
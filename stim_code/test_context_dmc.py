@@ -0,0 +1,67 @@
+from __future__ import division
+import os
+import os.path as op
+import shutil
+import tempfile
+import numpy as np
+import nose.tools as nt
+import numpy.testing as npt
+import pandas
+import tools
+import context_dmc
+
+
+def test_compile_trial_plan():
+
+    p = tools.Params("context_dmc")
+    p.dummy_trs = 1
+    s = pandas.read_csv("schedules/run_01.csv")
+    plan = context_dmc.compile_trial_plan(p, s, np.random.RandomState(0))
+    yield nt.assert_equal, len(s), len(plan)
+
+    for t in [0, 5]:
+        trial, row = plan[t], s.iloc[t]
+
+        # The attended category should be on the cued dimension
+        dim = "color" if row.context == 0 else "orient"
+        yield nt.assert_equal, dim, trial["context"]
+        yield nt.assert_equal, row.attend_cat, trial["samp_%s_cat" % dim]
+        yield nt.assert_equal, row.attend_exemp, trial["samp_%s_exemp" % dim]
+
+        # The target should match the sample only when it's a match trial
+        same = trial["targ_%s_cat" % dim] == trial["samp_%s_cat" % dim]
+        yield nt.assert_equal, bool(row.match), same
+
+        # Features should come from the category lists
+        yield (npt.assert_array_equal,
+               p.cat_colors[trial["targ_color_cat"]][trial["targ_color_exemp"]],
+               trial["targ_color"])
+        yield (nt.assert_equal,
+               p.cat_orients[trial["samp_orient_cat"]][
+                   trial["samp_orient_exemp"]],
+               trial["samp_orient"])
+
+    # Phases should tile the run with no gaps after the dummy scans
+    yield nt.assert_equal, p.tr, plan["cue_onset"][0]
+    ends = plan["iti_onset"] + plan["iti_secs"]
+    yield npt.assert_array_almost_equal, ends[:-1], plan["cue_onset"][1:]
+    yield (npt.assert_array_almost_equal,
+           plan["psi_onset"] + plan["psi_secs"], plan["samp_onset"])
+
+
+def test_schedule_file():
+
+    sched_dir = tempfile.mkdtemp()
+    try:
+        os.mkdir(op.join(sched_dir, "s01"))
+        open(op.join(sched_dir, "s01", "run_01.csv"), "w").close()
+
+        # A subject's own schedule should win over the shared one
+        yield (nt.assert_equal, op.join(sched_dir, "s01", "run_01.csv"),
+               context_dmc.schedule_file("s01", 1, sched_dir))
+        yield (nt.assert_equal, op.join(sched_dir, "run_02.csv"),
+               context_dmc.schedule_file("s01", 2, sched_dir))
+        yield (nt.assert_equal, op.join(sched_dir, "run_01.csv"),
+               context_dmc.schedule_file("s02", 1, sched_dir))
+    finally:
+        shutil.rmtree(sched_dir)
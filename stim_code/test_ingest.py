@@ -0,0 +1,56 @@
+import os
+import os.path as op
+import json
+import shutil
+import tempfile
+import nose.tools as nt
+import numpy.testing as npt
+import ingest
+from trial_data import TrialWriter
+
+schema = [("trial", int), ("context", "S6"), ("rt", float)]
+
+
+def write_session(data_dir, fname, rts, binary=True):
+    """Write a small data file and params json like an experiment would."""
+    f = open(op.join(data_dir, fname), "w")
+    f.write("# subject : s01 \n")
+    writer = TrialWriter(f, schema)
+    for i, rt in enumerate(rts):
+        writer.write(i, ["color", "orient"][i % 2], rt)
+    writer.close()
+    if not binary:
+        os.remove(op.splitext(op.join(data_dir, fname))[0] + ".npy")
+    with open(op.join(data_dir, op.splitext(fname)[0] + ".json"), "w") as fid:
+        json.dump(dict(subject="s01", tr=2, cat_orients=[[0, 90]]), fid)
+
+
+def test_load_sessions():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        write_session(data_dir, "s01_context_dmc_run01_1.csv", [.5, .6])
+        write_session(data_dir, "s01_context_dmc_run02_1.csv", [.7], False)
+
+        df = ingest.load_sessions(data_dir, n_jobs=1)
+        yield nt.assert_equal, 3, len(df)
+        yield npt.assert_array_equal, [.5, .6, .7], df.rt
+        yield npt.assert_array_equal, ["color", "orient", "color"], df.context
+        yield npt.assert_array_equal, [2, 2, 2], df.tr
+        yield nt.assert_true, "cat_orients" not in df
+        columns = ["trial", "context", "rt", "session", "subject", "tr"]
+        yield nt.assert_equal, columns, list(df.columns)
+
+        # A changed session should replace its old rows
+        write_session(data_dir, "s01_context_dmc_run01_1.csv", [.4])
+        df = ingest.load_sessions(data_dir, n_jobs=1)
+        yield npt.assert_array_equal, [.4, .7], df.rt
+        yield nt.assert_equal, columns, list(df.columns)
+
+        # As should a removed one
+        os.remove(op.join(data_dir, "s01_context_dmc_run02_1.csv"))
+        df = ingest.load_sessions(data_dir, n_jobs=1)
+        yield npt.assert_array_equal, ["s01_context_dmc_run01_1.csv"], \
+            df.session.unique()
+    finally:
+        shutil.rmtree(data_dir)
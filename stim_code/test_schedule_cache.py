@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import nose.tools as nt
+import numpy.testing as npt
+from schedule_cache import ScheduleCache
+
+
+def test_schedule_cache():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ScheduleCache(cache_dir)
+        sched = np.array([0, 1, 2, 3, 2, 1])
+        params = dict(n_cat=4, seed=[1, 2])
+
+        # Test a miss and then a hit
+        yield nt.assert_equal, None, cache.get(params)
+        cache.put(params, sched, dict(cb1_cost=.5))
+        hit_sched, metrics = cache.get(params)
+        yield npt.assert_array_equal, sched, hit_sched
+        yield nt.assert_equal, .5, metrics["cb1_cost"]
+
+        # Identical schedules should share storage
+        cache.put(dict(params, seed=[1, 3]), sched)
+        yield nt.assert_equal, 1, len(os.listdir(cache.blob_dir))
+        yield nt.assert_equal, 2, len(os.listdir(cache.entry_dir))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_schedule_cache_eviction():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ScheduleCache(cache_dir, max_bytes=2000)
+        for seed in range(20):
+            sched = np.random.RandomState(seed).randint(0, 4, 24)
+            cache.put(dict(seed=seed), sched)
+
+        # The newest entry should survive and the oldest should be gone
+        yield nt.assert_true, cache.get(dict(seed=19)) is not None
+        yield nt.assert_equal, None, cache.get(dict(seed=0))
+        size = sum(os.path.getsize(os.path.join(d, f))
+                   for d in [cache.entry_dir, cache.blob_dir]
+                   for f in os.listdir(d))
+        yield nt.assert_true, size <= 2000
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_schedule_cache_blob_eviction():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        # Entries whose size is mostly in their blobs, used in seed order
+        cache = ScheduleCache(cache_dir)
+        for seed in range(10):
+            sched = np.random.RandomState(seed).randint(0, 4, 5000)
+            cache.put(dict(seed=seed), sched)
+            entry_file = os.path.join(cache.entry_dir,
+                                      cache.key(dict(seed=seed)) + ".json")
+            os.utime(entry_file, (1000 + seed, 1000 + seed))
+        size = sum(os.path.getsize(os.path.join(d, f))
+                   for d in [cache.entry_dir, cache.blob_dir]
+                   for f in os.listdir(d))
+
+        # Room for four and a half entries should keep the newest four
+        cache.max_bytes = int(size * .45)
+        cache.evict()
+        kept = [seed for seed in range(10)
+                if cache.get(dict(seed=seed)) is not None]
+        yield nt.assert_equal, [6, 7, 8, 9], kept
+        yield nt.assert_equal, 4, len(os.listdir(cache.blob_dir))
+
+        # An entry whose blob has gone is a miss
+        for fname in os.listdir(cache.blob_dir):
+            os.remove(os.path.join(cache.blob_dir, fname))
+        yield nt.assert_equal, None, cache.get(dict(seed=9))
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,58 @@
+import os.path as op
+import shutil
+import tempfile
+import nose.tools as nt
+from session_store import SessionStore
+
+
+def test_session_store():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        store = SessionStore(data_dir)
+        f, fname = store.create("s01", "context_dmc", 1)
+        f.close()
+        yield nt.assert_equal, "s01_context_dmc_run01_1.csv", fname
+        yield nt.assert_true, op.exists(op.join(data_dir, fname))
+
+        # Another attempt at the same run should get the next number
+        _, fname = store.create("s01", "context_dmc", 1)
+        yield nt.assert_equal, "s01_context_dmc_run01_2.csv", fname
+
+        # A file made behind the index's back should be skipped over
+        open(op.join(data_dir, "s01_context_dmc_run02_1.csv"), "w").close()
+        _, fname = store.create("s01", "context_dmc", 2)
+        yield nt.assert_equal, "s01_context_dmc_run02_2.csv", fname
+
+        # Test the lookups
+        store.create("s02", "context_dmc", 1)
+        yield nt.assert_equal, 3, len(store.sessions("s01"))
+        yield nt.assert_equal, 2, len(store.sessions("s01", run=1))
+        latest = store.latest("s01", "context_dmc", 1)
+        yield nt.assert_equal, "s01_context_dmc_run01_2.csv", latest
+        yield nt.assert_equal, None, store.latest("s03", "context_dmc", 1)
+        yield nt.assert_equal, ["s01", "s02"], store.subjects()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_rebuild_index():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        for fname in ["s_01_context_dmc_run01_1.csv",
+                      "s_01_context_dmc_run01_2.csv",
+                      "s02_category_train_run03_1.csv",
+                      "s02_category_train_run03_1.json"]:
+            open(op.join(data_dir, fname), "w").close()
+
+        store = SessionStore(data_dir, ["context_dmc", "category_train"])
+        yield nt.assert_equal, ["s02", "s_01"], store.rebuild_index()
+        yield nt.assert_equal, 2, len(store.sessions("s_01", "context_dmc"))
+        rec = store.sessions("s02")[0]
+        info = rec["exp"], rec["run"], rec["attempt"]
+        yield nt.assert_equal, ("category_train", 3, 1), info
+        _, fname = store.create("s_01", "context_dmc", 1)
+        yield nt.assert_equal, "s_01_context_dmc_run01_3.csv", fname
+    finally:
+        shutil.rmtree(data_dir)
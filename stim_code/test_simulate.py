@@ -0,0 +1,56 @@
+from __future__ import division
+import shutil
+import tempfile
+import numpy as np
+import nose.tools as nt
+import numpy.testing as npt
+import pandas
+import tools
+import context_dmc
+import simulate
+
+
+def test_observer():
+
+    p = tools.Params("context_dmc")
+    s = pandas.concat([pandas.read_csv("schedules/run_%02d.csv" % r)
+                       for r in range(1, 13)])
+    plan = context_dmc.compile_trial_plan(p, s, np.random.RandomState(0))
+    observer = simulate.Observer(dict(color=1, orient=.5), miss_rate=.1,
+                                 late_rate=0)
+    response, rt = observer.respond(p, plan, np.random.RandomState(0))
+
+    # Responses should follow the per-context accuracy
+    answered = response != -1
+    correct = (response == 1) == plan["match"].astype(bool)
+    is_color = plan["context"] == "color"
+    yield nt.assert_true, correct[answered & is_color].all()
+    yield (npt.assert_almost_equal,
+           .5, correct[answered & ~is_color].mean(), 1)
+    yield npt.assert_almost_equal, .1, 1 - answered.mean(), 1
+
+    # RTs should fall inside the response window
+    yield nt.assert_true, (rt[answered] > 0).all()
+    yield nt.assert_true, (rt[answered] < p.resp_dur).all()
+    yield npt.assert_array_equal, -1, rt[~answered]
+
+
+def test_simulate_study():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        np.random.seed(1)
+        observer = simulate.Observer(miss_rate=.2, late_rate=.2)
+        results = simulate.simulate_study(["s01"], [1, 2], observer,
+                                          data_dir, n_jobs=1, seed=0)
+        yield nt.assert_equal, ["s01_context_dmc_run01_1.csv",
+                                "s01_context_dmc_run02_1.csv"], \
+              list(results.fname)
+        yield npt.assert_array_equal, 0, results.n_errors
+
+        # The runs shouldn't disturb the caller's random state
+        after = np.random.rand()
+        np.random.seed(1)
+        yield nt.assert_equal, np.random.rand(), after
+    finally:
+        shutil.rmtree(data_dir)
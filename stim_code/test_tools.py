@@ -2,7 +2,9 @@ from __future__ import division
 import numpy as np
 import nose.tools as nt
 import numpy.testing as npt
+import backend
 import tools
+import design
 
 def test_cb1_ideal():
 
@@ -38,7 +40,7 @@ def test_cb1_prob():
            tools.cb1_prob(sched, evs))
 
 
-def teset_cb1_cost():
+def test_cb1_cost():
 
     # Test perfect 
     # (this won't actually ever happen)
@@ -54,3 +56,400 @@ def teset_cb1_cost():
            0.2,
            tools.cb1_cost(ideal, test))
 
+
+def test_cb1_prob_batch():
+
+    # Test against the single schedule function
+    scheds = np.random.randint(1, 4, (10, 20))
+    evs = [5, 7, 8]
+    expected = np.array([tools.cb1_prob(s, evs) for s in scheds])
+    yield (npt.assert_array_almost_equal,
+           expected,
+           tools.cb1_prob_batch(scheds, evs))
+
+    # Test the preallocated kernel
+    ideal = tools.cb1_ideal(evs)
+    expected = [tools.cb1_cost(ideal, m) for m in expected]
+    kernel = tools.CB1Kernel(evs, 20)
+    yield (npt.assert_array_almost_equal,
+           expected,
+           kernel(scheds))
+
+
+def test_balance_cost_batch():
+
+    scheds = np.array([[0, 1, 2, 0, 1, 2],
+                       [0, 0, 0, 1, 1, 2]])
+    yield (npt.assert_array_equal,
+           [0, 2],
+           tools.balance_cost_batch(scheds, 3))
+
+
+def test_optimize_event_schedule():
+
+    sched = tools.optimize_event_schedule(4, 24, 24, n_search=50,
+                                          chunk_size=16)
+    yield npt.assert_equal, (24,), sched.shape
+    yield nt.assert_true, sched.max() < 4
+
+    # With enforce_balance, the best balanced schedule should be returned
+    # even when an unbalanced one has a lower total cost
+    for seed in range(5):
+        rs = np.random.RandomState(seed)
+        sched = tools.optimize_event_schedule(4, 24, 24, n_search=1000,
+                                              enforce_balance=True,
+                                              objectives=dict(cb1=1),
+                                              random_state=rs)
+        yield npt.assert_array_equal, [6] * 4, np.bincount(sched, minlength=4)
+
+
+def test_sample_schedules():
+
+    rs = np.random.RandomState(0)
+    scheds = tools.sample_schedules(3, 30, 2, 200, rs)
+    yield npt.assert_equal, (200, 30), scheds.shape
+
+    # No event should appear more than twice in a row
+    repeats = (scheds[:, 2:] == scheds[:, 1:-1]) & \
+              (scheds[:, 1:-1] == scheds[:, :-2])
+    yield nt.assert_false, repeats.any()
+
+    # The repeat window covers the whole schedule at the start
+    yield nt.assert_false, (scheds[:, 0] == scheds[:, 1]).any()
+
+
+def test_cb1_anneal():
+
+    evs = [8] * 6
+    ideal = tools.cb1_ideal(evs)
+    rs = np.random.RandomState(0)
+    sched = tools.cb1_anneal(evs, 5000, tools.max_three_in_a_row,
+                             random_state=rs)
+
+    # Make sure the schedule is a permutation satisfying the constraint
+    yield npt.assert_array_equal, evs, np.bincount(sched)[1:]
+    yield nt.assert_true, tools.max_three_in_a_row(sched)
+
+    # This design can't do better than 25 cells with one transition and
+    # 11 cells with two transitions
+    best = (25 * .25 + 11 * .5) / 36
+    yield (nt.assert_almost_equal,
+           best,
+           tools.cb1_cost(ideal, tools.cb1_prob(sched, evs)))
+
+    # The repeat limit should reach the same optimum
+    sched = tools.cb1_anneal(evs, 5000, max_repeat=3, random_state=rs)
+    yield nt.assert_true, tools.max_three_in_a_row(sched)
+    yield (nt.assert_almost_equal,
+           best,
+           tools.cb1_cost(ideal, tools.cb1_prob(sched, evs)))
+
+    # Checking the limit around the swaps should accept the same moves as
+    # checking the whole schedule
+    evs = [12, 13]
+    scheds = [tools.cb1_anneal(evs, 2000, constraint, max_repeat=2,
+                               random_state=np.random.RandomState(1))
+              for constraint in [None, tools.run_length_constraint(2)]]
+    yield npt.assert_array_equal, scheds[0], scheds[1]
+    yield nt.assert_true, tools.run_length_ok(scheds[0], 2)
+
+
+def test_counterbalanced_schedule():
+
+    rs = np.random.RandomState(0)
+
+    # Test an exactly counterbalanced design
+    sched = tools.counterbalanced_schedule(4, 33, random_state=rs)
+    pairs = np.bincount(sched[:-1] * 4 + sched[1:], minlength=16)
+    yield npt.assert_array_equal, np.ones(16) * 2, pairs
+
+    # Test the run design with a repeat limit
+    sched = tools.counterbalanced_schedule(4, 24, 2, random_state=rs)
+    evs = [6] * 4
+    yield npt.assert_array_equal, evs, np.bincount(sched)
+    yield nt.assert_true, tools.max_three_in_a_row(sched)
+    yield (nt.assert_almost_equal,
+           1 / 3,
+           tools.cb1_cost(tools.cb1_ideal(evs), tools.cb1_prob(sched, evs)))
+
+    # Tight repeat limits where random permutations almost never qualify
+    for n_total in [49, 97]:
+        sched = tools.counterbalanced_schedule(2, n_total, 2, random_state=rs)
+        yield npt.assert_equal, n_total, len(sched)
+        yield nt.assert_true, tools.max_run_lengths(sched) <= 2
+        yield nt.assert_true, abs(np.diff(np.bincount(sched)))[0] <= 1
+
+
+def test_run_limited_schedule():
+
+    rs = np.random.RandomState(0)
+    for evs, max_repeat in [([24, 25], 2), ([10, 3, 1], 2), ([5, 5, 5], 1)]:
+        sched = design._run_limited_schedule(evs, max_repeat, rs)
+        yield npt.assert_array_equal, evs, np.bincount(sched)[1:]
+        yield nt.assert_true, tools.run_length_ok(sched, max_repeat)
+
+    # Counts that can't be spread out under the limit
+    nt.assert_raises(ValueError, design._run_limited_schedule,
+                     [10, 3], 2, rs)
+
+
+def test_run_length_ok():
+
+    scheds = np.array([[1, 1, 1, 2, 2, 10, 10, 10, 10],
+                       [1, 2, 1, 2, 2, 2, 10, 1, 10]])
+    yield npt.assert_array_equal, [4, 3], tools.max_run_lengths(scheds)
+    yield npt.assert_array_equal, [False, True], tools.run_length_ok(scheds, 3)
+
+    # Test per-event limits and a single schedule
+    limits = {1: 3, 10: 4}
+    yield npt.assert_array_equal, [True, True], \
+          tools.run_length_ok(scheds, limits)
+    yield npt.assert_array_equal, [True, False], \
+          tools.run_length_ok(scheds, limits, default=2)
+    yield nt.assert_false, tools.max_three_in_a_row(scheds[0])
+    yield nt.assert_true, tools.max_four_in_a_row(scheds[0])
+
+
+def test_cb_prob_batch():
+
+    # Test second order counts against a loop
+    evs = [3, 3]
+    scheds = np.array([[1, 2, 1, 1, 2, 2]])
+    expected = np.zeros((2, 2, 2))
+    for a, b, c in zip(scheds[0], scheds[0, 1:], scheds[0, 2:]):
+        expected[a - 1, b - 1, c - 1] += 1
+    expected /= 1.5
+    yield (npt.assert_array_almost_equal,
+           expected,
+           tools.cb_prob_batch(scheds, evs, 2)[0])
+
+    # The first order case should reduce to cb1
+    yield (npt.assert_array_almost_equal,
+           tools.cb1_prob(scheds[0], evs),
+           tools.cb_prob_batch(scheds, evs, 1)[0])
+    yield (npt.assert_array_equal,
+           tools.cb1_ideal(evs),
+           tools.cb_ideal(evs, 1))
+
+
+def test_design_efficiency():
+
+    p = tools.Params("context_dmc")
+    eff = tools.DesignEfficiency(p, 4)
+    rs = np.random.RandomState(0)
+    scheds = tools.sample_schedules(4, 24, 24, 20, rs)
+
+    X = eff.design_matrices(scheds)
+    yield npt.assert_equal, (20, 9), (X.shape[0], X.shape[2])
+
+    # A regressor should be the sampled convolution of its boxcars
+    samp_onset, _, run_dur = eff.onsets(*[np.ones(24) * 2] * 3)
+    neural = np.zeros(int(np.ceil(run_dur / eff.dt)))
+    for onset in samp_onset[scheds[0] == 1]:
+        neural[int(round(onset / eff.dt))] = 1
+    bold = np.convolve(neural, eff.hrf)[:len(neural):int(p.tr / eff.dt)]
+    yield npt.assert_array_almost_equal, bold, X[0, :, 1]
+
+    # Shared and per-candidate jitters should give the same answer
+    jitter = rs.randint(1, 4, 24)
+    yield (npt.assert_array_almost_equal,
+           eff(scheds, jitter, jitter, jitter),
+           eff(scheds, np.tile(jitter, (20, 1)), jitter, jitter))
+
+    # A schedule missing an event type can't estimate its regressors
+    balanced, missing = np.tile([0, 1, 2, 3], 6), np.tile([0, 1, 2], 8)
+    yield nt.assert_true, eff(missing)[0] < 1e-3 * eff(balanced)[0]
+
+    # Runs of different lengths should each be scored on their own
+    short, slow = np.ones(24), np.ones(24) * 3
+    both = eff(np.vstack([balanced, balanced]), np.vstack([short, slow]),
+               short, short)
+    yield (npt.assert_array_almost_equal,
+           [eff(balanced, short, short, short)[0],
+            eff(balanced, slow, short, short)[0]],
+           both)
+
+    # The kth trial of each event type gets the kth jitter for that type
+    jitters = [rs.randint(1, 4, (4, 6)) for _ in range(3)]
+    eff = tools.DesignEfficiency(p, 4, jitters=jitters)
+    psi, isi, iti = eff.trial_jitters(balanced)
+    yield npt.assert_array_equal, jitters[0].T.ravel(), psi[0]
+    yield npt.assert_array_equal, jitters[2].T.ravel(), iti[0]
+    yield (npt.assert_array_almost_equal,
+           eff(scheds, *eff.trial_jitters(scheds)),
+           eff(scheds))
+
+
+def test_performance_tracker():
+
+    trials = [("color", 1, 1, .5, 1),
+              ("color", 0, 2, .7, 1),
+              ("orient", 1, 2, .6, 0),
+              ("orient", 0, -1, -1, 0)]
+    perf = tools.PerformanceTracker()
+    yield npt.assert_equal, np.nan, perf.accuracy()
+    for trial in trials:
+        perf.update(*trial)
+
+    yield npt.assert_almost_equal, .5, perf.accuracy()
+    yield npt.assert_almost_equal, 1, perf.accuracy("color")
+    yield npt.assert_almost_equal, .5, perf.accuracy(match=1)
+    yield npt.assert_almost_equal, 0, perf.accuracy("orient", 0)
+    yield nt.assert_equal, 1, perf.n_missed
+
+    # RT statistics should only use trials with a response
+    rts = np.array([.5, .7, .6])
+    yield npt.assert_almost_equal, rts.mean(), perf.rt.mean
+    yield npt.assert_almost_equal, rts.var(ddof=1), perf.rt.var
+
+
+def test_flip_timer():
+
+    previous = backend.active()
+    b = backend.use("headless")
+    try:
+        # Steady 60 Hz frames, then one dropped frame
+        timer = tools.FlipTimer(backend.visual.Window(), 60, size=16)
+        npt.assert_almost_equal(60, timer.measure_refresh())
+        start = timer.n_flips
+        timer.flip()
+        b.advance(1 / 60)
+        timer.flip()
+        timer.flip()
+    finally:
+        backend.use(previous or "headless")
+
+    stats = timer.frame_stats(start - 1)
+    yield nt.assert_equal, 3, stats["n_intervals"]
+    yield nt.assert_equal, 1, stats["dropped"]
+    yield npt.assert_almost_equal, 2 / 60, stats["max_interval"]
+
+    # Only the most recent flips are kept
+    yield nt.assert_equal, 16, len(timer.flip_times(0))
+
+
+def test_timeline():
+
+    previous = backend.active()
+    b = backend.use("headless")
+    try:
+        # 60 Hz frames, except that one frame early on overruns by 100 ms
+        n_draws = [0]
+
+        def draw():
+            n_draws[0] += 1
+            if n_draws[0] == 6:
+                b.advance(.1)
+
+        timer = tools.FlipTimer(backend.visual.Window(), 60)
+        timeline = tools.Timeline(timer)
+        durations = [.5, 1.5, 2, .5, .25] * 4
+        onsets = np.r_[0, np.cumsum(durations)[:-1]]
+        for i, (onset, dur) in enumerate(zip(onsets, durations)):
+            timeline.present("phase%d" % i, draw, onset, dur)
+    finally:
+        backend.use(previous or "headless")
+
+    # The overrun should only delay the phase right after it
+    errors = timeline.onset_errors()
+    yield npt.assert_array_less, np.abs(errors[2:]), 1 / 60
+    yield nt.assert_true, errors[1] > .05
+    yield nt.assert_equal, len(durations), len(timeline.onsets)
+
+
+def test_input_poller():
+
+    previous = backend.active()
+    keys = [(0, "space"), (.5, "1"), (.7, "x"), (1.2, "q")]
+    b = backend.use("headless", keys=keys)
+    try:
+        # Keys from before the poller started are still picked up
+        poller = tools.InputPoller(rate=100)
+        yield nt.assert_equal, [("space", 0)], poller.get_keys()
+
+        # Waiting returns the first matching key with its time
+        pressed = poller.wait_keys(["1", "2"], timeout=2)
+        yield nt.assert_equal, [("1", .5)], pressed
+        yield nt.assert_equal, [], poller.wait_keys(["2"], timeout=.3)
+
+        # A quit key should end a wait early
+        yield nt.assert_true, poller.wait_quit(5)
+        yield nt.assert_true, b.now < 1.3
+        yield (nt.assert_equal,
+               ["space", "1", "x", "q"],
+               [k for k, _ in poller.log])
+    finally:
+        backend.use(previous or "headless")
+
+
+def test_wait_text():
+
+    previous = backend.active()
+    b = backend.use("headless", keys=[(3, "space")])
+    try:
+        # The static screen should be flipped once and then left alone
+        win = backend.visual.Window()
+        tools.WaitText(win, "wait")(["space"], duration=10)
+        yield nt.assert_equal, 1, win.n_flips
+        yield nt.assert_true, 3 <= b.now < 3.05
+
+        # Unless it asks to be redrawn
+        win = backend.visual.Window()
+        tools.WaitText(win, "wait")(duration=1, redraw_every=.4)
+        yield nt.assert_equal, 3, win.n_flips
+    finally:
+        backend.use(previous or "headless")
+
+
+def test_stimulus_atlas():
+
+    cat_colors = [["red", "pink", "orange"], ["blue", "teal", "navy"]]
+    cat_orients = [[60, 90, 120], [-30, 0, 30]]
+    previous = backend.active()
+    backend.use("headless")
+    try:
+        win = backend.visual.Window(size=(800, 600))
+        color = backend.visual.PatchStim(win)
+        grate = backend.visual.GratingStim(win)
+        fix = backend.visual.TextStim(win, text="+")
+        atlas = tools.StimulusAtlas(win, [grate, color, fix],
+                                    color, grate, cat_colors, cat_orients,
+                                    size=200)
+    finally:
+        backend.use(previous or "headless")
+
+    yield nt.assert_equal, 36, len(atlas)
+    image = atlas.get((1, 1), (1, 2))
+    yield (nt.assert_equal,
+           (30, "teal", "+"),
+           (image.stim[0].ori, image.stim[1].color, image.stim[2].text))
+    yield npt.assert_array_almost_equal, [-.25, 1 / 3, .25, -1 / 3], \
+          atlas.get((0, 0), (0, 0)).rect
+
+    # A stimulus taller than the window should be captured at window height
+    backend.use("headless")
+    try:
+        win = backend.visual.Window(size=(800, 600))
+        atlas = tools.StimulusAtlas(win, [grate], color, grate,
+                                    cat_colors, cat_orients, size=660)
+    finally:
+        backend.use(previous or "headless")
+    yield npt.assert_array_almost_equal, [-.75, 1, .75, -1], \
+          atlas.get((0, 0), (0, 0)).rect
+
+
+def test_wait_check_quit_clears_keys():
+
+    previous = backend.active()
+    backend.use("headless", keys=[(.5, "comma"), (1.5, "period")])
+    try:
+        # A key pressed during the wait shouldn't count as the next answer
+        poller = tools.InputPoller()
+        tools.wait_check_quit(1, poller=poller)
+        yield nt.assert_equal, [], poller.wait_keys(["comma", "period"], 0)
+
+        # But one pressed afterwards should
+        keys = poller.wait_keys(["comma", "period"], 1)
+        yield nt.assert_equal, [("period", 1.5)], keys
+    finally:
+        backend.use(previous or "headless")
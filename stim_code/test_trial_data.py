@@ -0,0 +1,110 @@
+import os.path as op
+import shutil
+import tempfile
+import numpy as np
+import nose.tools as nt
+import numpy.testing as npt
+import trial_data
+from trial_data import (AsyncWriter, TrialWriter, load_trials,
+                        recover_trials)
+
+schema = [("trial", int), ("context", "S6"), ("rt", float)]
+rows = [(0, "color", .5), (1, "orient", -1), (2, "color", .75)]
+
+
+def test_trial_writer():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        fname = op.join(data_dir, "test_run01_1.csv")
+        f = open(fname, "w")
+        f.write("# time : now\n")
+        writer = TrialWriter(f, schema, buffer_size=2)
+        for row in rows:
+            writer.write(*row)
+
+        # The first two rows should have been flushed on their own
+        yield nt.assert_equal, 2, len(load_trials(fname))
+        writer.close()
+
+        # The binary copy should hold every record
+        data = load_trials(fname)
+        yield nt.assert_true, isinstance(data, np.memmap)
+        yield npt.assert_array_equal, [0, 1, 2], data["trial"]
+        yield nt.assert_equal, "orient", data["context"][1]
+        yield npt.assert_array_equal, [.5, -1, .75], data["rt"]
+
+        # And the CSV should have the comments, header and rows
+        lines = open(fname).read().splitlines()
+        yield nt.assert_equal, "# time : now", lines[0]
+        yield nt.assert_equal, "trial,context,rt", lines[1]
+        yield nt.assert_equal, "1,orient,-1.0", lines[3]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_recover_trials():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        fname = op.join(data_dir, "test_run01_1.csv")
+        writer = TrialWriter(open(fname, "w"), schema)
+        writer.write(*rows[0])
+        writer.flush()
+
+        # Simulate a crash after appending records but before the header
+        # update, partway through writing another record
+        extra = np.array(rows[1:], writer.dtype).tobytes()
+        writer.npy_fid.write(extra[:-3])
+        writer.npy_fid.close()
+        yield nt.assert_equal, 1, len(load_trials(fname))
+
+        yield nt.assert_equal, 2, recover_trials(fname)
+        data = load_trials(fname)
+        yield npt.assert_array_equal, [0, 1], data["trial"]
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_async_writer():
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        io = AsyncWriter(max_queue=2, batch_size=2)
+        fname = op.join(data_dir, "test_run01_1.csv")
+        f = open(fname, "w")
+        io.write(f, "# time : now\n")
+        writer = TrialWriter(f, schema, buffer_size=1, writer=io)
+        for row in rows:
+            writer.write(*row)
+        writer.close()
+        io.close()
+
+        # Everything should be written, in order, once the writer closes
+        yield nt.assert_true, f.closed
+        data = load_trials(fname)
+        yield npt.assert_array_equal, [0, 1, 2], data["trial"]
+        lines = open(fname).read().splitlines()
+        yield nt.assert_equal, ["# time : now", "trial,context,rt"], lines[:2]
+        yield nt.assert_equal, 5, len(lines)
+
+        stats = io.stats()
+        yield nt.assert_equal, stats["n_jobs"], len(io.latencies)
+        yield nt.assert_true, stats["max_depth"] <= 2
+
+        # Closed writers shouldn't be kept around to close again at exit
+        yield nt.assert_false, io in trial_data._open_writers
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_async_writer_error():
+
+    io = AsyncWriter()
+
+    def fail():
+        raise IOError("disk full")
+
+    io.call(fail)
+    nt.assert_raises(IOError, io.sync)
+    io.close()
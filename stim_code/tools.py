@@ -1,15 +1,25 @@
 from __future__ import division
 
-import os
 import sys
 import time
 import json
 import argparse
+import threading
+from collections import deque
 from math import floor
 from subprocess import call
 import numpy as np
-from numpy.random import permutation, multinomial
-from psychopy import core, event, visual
+from backend import core, event, visual
+from session_store import SessionStore
+
+# The schedule math lives in design.py, which doesn't need psychopy
+from design import (max_three_in_a_row, max_four_in_a_row, max_run_lengths,
+                    run_length_ok, run_length_constraint, make_schedule,
+                    sample_schedules, optimize_event_schedule,
+                    counterbalanced_schedule, balance_cost_batch,
+                    cb1_optimize, cb1_anneal, cb1_ideal, cb1_prob, cb1_cost,
+                    cb1_prob_batch, cb_ideal, cb_prob_batch, CB1Kernel,
+                    DesignEfficiency)
 
 
 class Params(object):
@@ -44,6 +54,8 @@ class Params(object):
         parser.add_argument("-run", type=int, default=1)
         parser.add_argument("-fmri", action="store_true")
         parser.add_argument("-debug", action="store_true")
+        parser.add_argument("-headless", action="store_true",
+                            help="run on a virtual clock with no display")
 
         # Add additional arguments by experiment
         try:
@@ -85,24 +97,18 @@ class Params(object):
 
         # Save to JSON
         json.dump(data, fid, sort_keys=True, indent=4)
+        fid.close()
 
 
 def start_data_file(subject_id, exp, run):
     """Start a file object into which you will write the data.
 
-    Makes sure sure not to over-write previously existing files.
+    Makes sure sure not to over-write previously existing files. The file
+    is allocated through the data directory's session index (see
+    session_store.py), so this doesn't slow down as ./data fills up.
 
     """
-    list_data_dir = os.listdir('./data')
-
-    i = 1
-    data_file = '%s_%s_run%02d_%d.csv' % (subject_id, exp, run, i)
-    while data_file in list_data_dir:
-        i += 1
-        data_file = '%s_%s_run%02d_%d.csv' % (subject_id, exp, run, i)
-
-    #Open the file for writing into:
-    f = file('./data/%s' % data_file, 'w')
+    f, data_file = SessionStore("./data").create(subject_id, exp, run)
 
     #Write some header information
     f.write('# time : %s\n' % (time.asctime()))
@@ -141,8 +147,18 @@ def check_quit(quit_keys=None):
     event.clearEvents()
 
 
-def wait_check_quit(wait_time, quit_keys=None):
-    """Wait a given time, checking for a quit every second."""
+def wait_check_quit(wait_time, quit_keys=None, poller=None):
+    """Wait a given time, checking for a quit every second.
+
+    With an InputPoller, quit keys end the wait as soon as they arrive.
+    Either way, keys pressed during the wait are thrown away.
+
+    """
+    if poller is not None:
+        if poller.wait_quit(wait_time):
+            core.quit()
+        poller.clear()
+        return
     if quit_keys is None:
         quit_keys = ["q", "escape"]
     for sec in range(int(floor(wait_time))):
@@ -154,25 +170,47 @@ def wait_check_quit(wait_time, quit_keys=None):
     event.clearEvents()
 
 
-def wait_for_trigger(win, params):
+def wait_for_trigger(win, params, poller=None):
+    """Show a static "Get ready!" screen until the scanner trigger.
 
+    The screen is drawn and flipped once; the wait itself only watches for
+    keys (through the poller if there is one) without redrawing.
+
+    """
     event.clearEvents()
     visual.TextStim(win, text="Get ready!").draw()
     win.flip()
 
     # Here's where we expect pulses
-    wait = True
-    while wait:
-        trigger_keys = ["5", "t"]
-        listen_keys = trigger_keys + list(params.quit_keys)
-        for key in event.getKeys(keyList=listen_keys):
-            if key in params.quit_keys:
-                core.quit()
-            elif key:
-                wait = False
+    trigger_keys = ["5", "t"]
+    listen_keys = trigger_keys + list(params.quit_keys)
+    for key in wait_keys(listen_keys, poller=poller):
+        if key in params.quit_keys:
+            core.quit()
     event.clearEvents()
 
 
+def wait_keys(keyList=None, timeout=np.inf, poller=None, interval=.001):
+    """Sleep until a key in keyList is pressed or timeout elapses.
+
+    Returns the list of keys pressed, which is empty on a timeout. Without
+    an InputPoller, the keyboard is checked every interval seconds.
+
+    """
+    if poller is not None:
+        timeout = None if np.isinf(timeout) else timeout
+        return [key for key, _ in poller.wait_keys(keyList, timeout)]
+    clock = core.Clock()
+    while True:
+        keys = event.getKeys(keyList=keyList)
+        if keys:
+            return keys
+        remaining = timeout - clock.getTime()
+        if remaining <= 0:
+            return []
+        core.wait(interval, hogCPUperiod=0)
+
+
 def draw_all(*args):
     for stim in args:
         stim.draw()
@@ -193,6 +231,9 @@ class WindowInfo(object):
             sys.exit("Monitor name '%s' not found in monitors.py")
 
         size = minfo["size"] if params.full_screen else (800, 600)
+        self.refresh_hz = minfo.get("refresh_hz", 60)
+        self.pix_per_deg = (minfo["size"][0] / minfo["width"] *
+                            minfo["distance"] * np.pi / 180)
         info = dict(units=params.monitor_units,
                     fullscr=params.full_screen,
                     allowGUI=not params.full_screen,
@@ -204,21 +245,490 @@ class WindowInfo(object):
         self.window_kwargs = info
 
 
+class StimulusAtlas(object):
+    """Pre-rendered images of a layered stimulus for every feature pair.
+
+    Each color and orientation exemplar combination is drawn once at
+    startup and captured into a BufferImageStim, so showing a stimulus is
+    a single draw of a texture that is already on the GPU instead of
+    updating the stimulus objects and drawing every layer.
+
+    """
+    def __init__(self, win, stims, color_stim, grate, cat_colors,
+                 cat_orients, size=None):
+        """Render the images.
+
+        Parameters
+        ----------
+        win: psychopy Window
+            window to render in
+        stims: list of stimulus objects
+            layers of the composite, in drawing order
+        color_stim, grate: stimulus objects in stims
+            layers that get the color and orientation of each exemplar
+        cat_colors, cat_orients: nested lists
+            exemplar features for each category (as in the params)
+        size: float, optional
+            width of the captured square in pixels, limited to what fits
+            in the window (so a stimulus bigger than a debug window is
+            cropped); the whole window is captured otherwise
+
+        """
+        self.win = win
+        rect = None
+        if size is not None:
+            size = min(size, win.size[0], win.size[1])
+            w, h = size / win.size[0], size / win.size[1]
+            rect = [-w, h, w, -h]
+
+        self.images = {}
+        for color_key, col in _exemplars(cat_colors):
+            for orient_key, ori in _exemplars(cat_orients):
+                color_stim.setColor(col)
+                grate.setOri(ori)
+                win.clearBuffer()
+                image = visual.BufferImageStim(win, stim=stims, rect=rect)
+                self.images[color_key, orient_key] = image
+        win.clearBuffer()
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, color, orient):
+        """Image for a (category, exemplar) color and orientation."""
+        return self.images[tuple(color), tuple(orient)]
+
+    def warm_up(self):
+        """Draw every image once so its texture is resident on the GPU."""
+        for image in self.images.values():
+            image.draw()
+            self.win.clearBuffer()
+        self.win.flip()
+
+
+def _exemplars(cat_features):
+    """Yield ((category, exemplar), feature) for nested feature lists."""
+    for cat, features in enumerate(cat_features):
+        for exemp, feature in enumerate(features):
+            yield (cat, exemp), feature
+
+
+class InputPoller(object):
+    """Polls the keyboard and queues timestamped key presses.
+
+    Keys are stamped with core.getTime() (the clock FlipTimer uses) and
+    go onto a deque, which the trial code drains without locking. Every
+    key is also kept in a log for the whole run.
+
+    By default the keyboard is polled on the main thread whenever the
+    poller is queried, which the experiments do once per frame. Pumping
+    window events off the main thread isn't safe with pyglet (on OS X in
+    particular), so threaded=True, which polls at a high rate on a
+    background thread, is only for backends where that is known to work.
+    psychopy's iohub is the way to get asynchronous keyboard input there.
+
+    """
+    def __init__(self, quit_keys=("q", "escape"), rate=1000, threaded=False):
+        """Start polling.
+
+        Parameters
+        ----------
+        quit_keys: sequence of strings
+            keys that set the quit flag
+        rate: float
+            polls per second on the background thread, and waits between
+            polls otherwise
+        threaded: bool
+            whether to poll on a background thread
+
+        """
+        self.quit_keys = quit_keys
+        self.interval = 1 / rate
+        self.threaded = threaded
+        self.queue = deque()
+        self.log = []
+        self.quit_event = threading.Event()
+        self.key_event = threading.Event()
+        self._running = threaded
+        if threaded:
+            self.thread = threading.Thread(target=self._run,
+                                           name="InputPoller")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def poll(self):
+        """Move any new key presses onto the queue."""
+        keys = event.getKeys(timeStamped=True)
+        for key, stamp in keys:
+            self.queue.append((key, stamp))
+            self.log.append((key, stamp))
+            if key in self.quit_keys:
+                self.quit_event.set()
+        if keys:
+            self.key_event.set()
+
+    def get_keys(self, keyList=None):
+        """Drain the queue and return the (key, time) pairs in keyList."""
+        if not self.threaded:
+            self.poll()
+        keys = []
+        while self.queue:
+            key, stamp = self.queue.popleft()
+            if keyList is None or key in keyList:
+                keys.append((key, stamp))
+        return keys
+
+    def clear(self):
+        """Drop any queued keys (they stay in the log)."""
+        self.get_keys()
+
+    def wait_keys(self, keyList=None, timeout=None):
+        """Block until a key in keyList arrives or timeout (in seconds).
+
+        Returns the matching (key, time) pairs, which is empty on timeout.
+
+        """
+        deadline = None if timeout is None else core.getTime() + timeout
+        while True:
+            keys = self.get_keys(keyList)
+            if keys:
+                return keys
+            remaining = None if deadline is None else \
+                        deadline - core.getTime()
+            if remaining is not None and remaining <= 0:
+                return []
+            if self.threaded:
+                self.key_event.clear()
+                if not self.queue:
+                    self.key_event.wait(remaining)
+            else:
+                core.wait(self.interval, hogCPUperiod=0)
+
+    def wait_quit(self, timeout):
+        """Wait up to timeout seconds; return True early on a quit key."""
+        if self.threaded:
+            return self.quit_event.wait(timeout)
+        deadline = core.getTime() + timeout
+        while not self.quit_requested():
+            remaining = deadline - core.getTime()
+            if remaining <= 0:
+                return False
+            core.wait(self.interval, hogCPUperiod=0)
+        return True
+
+    def quit_requested(self):
+        """Whether a quit key has been pressed."""
+        if not self.threaded:
+            self.poll()
+        return self.quit_event.is_set()
+
+    def check_quit(self):
+        """Exit if a quit key has been pressed."""
+        if self.quit_requested():
+            core.quit()
+
+    def stop(self):
+        """Stop the polling thread."""
+        if self._running:
+            self._running = False
+            self.thread.join()
+
+    def _run(self):
+        while self._running:
+            self.poll()
+            time.sleep(self.interval)
+
+
+class RunningStats(object):
+    """Mean and variance of a stream of values (Welford's algorithm)."""
+    def __init__(self):
+        self.n = 0
+        self.mean = np.nan
+        self._m2 = 0.
+
+    def update(self, x):
+        """Add a value to the stream."""
+        self.n += 1
+        if self.n == 1:
+            self.mean = float(x)
+            return
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    @property
+    def var(self):
+        """Sample variance of the values so far."""
+        return self._m2 / (self.n - 1) if self.n > 1 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class PerformanceTracker(object):
+    """Running summary of task performance, updated trial by trial.
+
+    Counts are kept per (context, match) cell, so every query costs the
+    same however many trials have been recorded and can be made between
+    trials (e.g. to show the experimenter how things are going).
+
+    """
+    def __init__(self):
+        self.n_trials = 0
+        self.n_missed = 0
+        self.cells = {}
+        self.rt = RunningStats()
+
+    def update(self, context, match, response, rt, acc):
+        """Record one trial; response is -1 for a miss."""
+        n, n_correct = self.cells.get((context, match), (0, 0))
+        self.cells[context, match] = n + 1, n_correct + acc
+        self.n_trials += 1
+        if response == -1:
+            self.n_missed += 1
+        if rt > 0:
+            self.rt.update(rt)
+
+    def accuracy(self, context=None, match=None):
+        """Proportion correct, possibly within a context or match type.
+
+        Missed responses count as errors. Returns nan before any trials.
+
+        """
+        n, n_correct = 0, 0
+        for (cell_context, cell_match), counts in self.cells.items():
+            if context is not None and cell_context != context:
+                continue
+            if match is not None and cell_match != match:
+                continue
+            n += counts[0]
+            n_correct += counts[1]
+        return n_correct / n if n else np.nan
+
+    def summary(self):
+        """Return a dict of the overall performance measures."""
+        return dict(n_trials=self.n_trials,
+                    accuracy=self.accuracy(),
+                    rt_mean=self.rt.mean,
+                    rt_std=self.rt.std,
+                    missed=self.n_missed)
+
+
+class FlipTimer(object):
+    """Flips a window and keeps a ring buffer of the flip times.
+
+    Timing statistics can be computed for any run of recent flips (one
+    trial's frame-locked period, say) to find dropped frames and jitter.
+
+    """
+    def __init__(self, win, refresh_hz=60, size=4096):
+        """Set up the buffer.
+
+        Parameters
+        ----------
+        win: psychopy Window
+            window to flip
+        refresh_hz: float
+            nominal refresh rate, used until measure_refresh() is called
+        size: int
+            number of flip times to keep
+
+        """
+        self.win = win
+        self.nominal_hz = refresh_hz
+        self.frame_dur = 1 / refresh_hz
+        self.times = np.zeros(size)
+        self.n_flips = 0
+
+    @property
+    def refresh_hz(self):
+        return 1 / self.frame_dur
+
+    @property
+    def last_flip(self):
+        """Time of the most recent flip."""
+        return self.times[(self.n_flips - 1) % len(self.times)]
+
+    def flip(self):
+        """Flip the window and record when the flip happened."""
+        self.win.flip()
+        now = core.getTime()
+        self.times[self.n_flips % len(self.times)] = now
+        self.n_flips += 1
+        return now
+
+    def measure_refresh(self, n_frames=60, n_skip=10, tolerance=.05):
+        """Time a series of blank flips to find the real refresh rate.
+
+        Warns if the measured rate is more than tolerance (as a fraction)
+        away from the nominal one. Returns the measured rate.
+
+        """
+        for i in xrange(n_skip):
+            self.flip()
+        start = self.n_flips
+        for i in xrange(n_frames):
+            self.flip()
+        self.frame_dur = np.median(np.diff(self.flip_times(start)))
+
+        error = abs(self.refresh_hz - self.nominal_hz) / self.nominal_hz
+        if error > tolerance:
+            print >> sys.stderr, ("Warning: measured refresh rate %.2f Hz "
+                                  "(expected %g Hz)"
+                                  % (self.refresh_hz, self.nominal_hz))
+        return self.refresh_hz
+
+    def flip_times(self, start, stop=None):
+        """Times of the flips numbered start up to stop (still buffered)."""
+        if stop is None:
+            stop = self.n_flips
+        start = max(start, stop - len(self.times), 0)
+        return self.times[np.arange(start, stop) % len(self.times)]
+
+    def frame_stats(self, start, stop=None):
+        """Summarize the intervals between a run of consecutive flips.
+
+        Intervals are counted as dropped frames by how many refreshes
+        they span beyond the first. Times are in seconds.
+
+        """
+        intervals = np.diff(self.flip_times(start, stop))
+        if not len(intervals):
+            return dict(n_intervals=0, dropped=0, mean_interval=np.nan,
+                        jitter=np.nan, max_interval=np.nan)
+        frames = np.round(intervals / self.frame_dur)
+        return dict(n_intervals=len(intervals),
+                    dropped=int(np.maximum(frames - 1, 0).sum()),
+                    mean_interval=intervals.mean(),
+                    jitter=intervals.std(),
+                    max_interval=intervals.max())
+
+
+class Timeline(object):
+    """Presents the phases of a run against absolute onset deadlines.
+
+    Each phase is drawn and flipped every frame, for as many frames as
+    fit between its actual onset and the planned onset of the next phase.
+    Planned onsets are fixed relative to the start of the run, so a late
+    onset shortens that phase and the run stays on schedule instead of
+    drifting.
+
+    """
+    def __init__(self, timer):
+        """Set up the timeline.
+
+        Parameters
+        ----------
+        timer: FlipTimer
+            flips the window; its frame duration sets the frame counts
+
+        """
+        self.timer = timer
+        self.start = None
+        self.onsets = []
+
+    def present(self, label, draw, onset, duration, on_onset=None,
+                every_frame=None):
+        """Show a phase from its planned onset for a duration in seconds.
+
+        Parameters
+        ----------
+        label: string
+            name of the phase for the onset log
+        draw: callable
+            draws the phase's stimuli (called every frame)
+        onset: float
+            planned onset in seconds from the run start; the first phase
+            presented defines the start
+        duration: float
+            planned duration in seconds
+        on_onset: callable, optional
+            called right after the onset flip (e.g. to reset an RT clock)
+        every_frame: callable, optional
+            called with the frame number after each later flip
+
+        Returns the actual onset in seconds from the run start.
+
+        """
+        draw()
+        flip_time = self.timer.flip()
+        if self.start is None:
+            self.start = flip_time - onset
+        actual = flip_time - self.start
+        if on_onset is not None:
+            on_onset()
+
+        # Fill the time until the next phase's deadline
+        n_frames = int(round((onset + duration - actual) /
+                             self.timer.frame_dur))
+        for frame in xrange(1, n_frames):
+            draw()
+            self.timer.flip()
+            if every_frame is not None:
+                every_frame(frame)
+
+        self.onsets.append((label, onset, actual))
+        return actual
+
+    def onset_errors(self, start=0):
+        """Actual minus planned onset for the phases since number start."""
+        return np.array([actual - planned
+                         for _, planned, actual in self.onsets[start:]])
+
+
 class WaitText(object):
     """A class for showing text on the screen until a key is pressed. """
-    def __init__(self, win, text='Press a key to continue', **kwargs):
+    def __init__(self, win, text='Press a key to continue', static=True,
+                 **kwargs):
         """Set the text stimulus information.
 
         Will do the default thing(show 'text' in white on gray background),
         unless you pass in kwargs, which will just go through to
         visual.TextStim (see docstring of that class for more details)
 
+        With static=True the text is rendered once into an image buffer,
+        shown with a single flip, and the wait just sleeps on the keyboard
+        instead of redrawing every frame.
+
         """
         self.win = win
+        self.static = static
         self.text = visual.TextStim(win, text=text, **kwargs)
+        self.image = None
+        if static and hasattr(visual, "BufferImageStim"):
+            self.image = visual.BufferImageStim(win, stim=[self.text])
+
+    def draw(self):
+        """Draw the cached image of the text, or the text itself."""
+        if self.image is not None:
+            self.image.draw()
+        else:
+            self.text.draw()
+
+    def __call__(self, check_keys=None, duration=np.inf, poller=None,
+                 redraw_every=None):
+        """Dislpay text until a key is pressed or until duration elapses.
+
+        In static mode, the screen is only flipped again every redraw_every
+        seconds (if given), e.g. to restore a display that loses the image.
+
+        """
+        if not self.static:
+            return self._redraw_loop(check_keys, duration)
 
-    def __call__(self, check_keys=None, duration=np.inf):
-        """Dislpay text until a key is pressed or until duration elapses."""
+        clock = core.Clock()
+        while clock.getTime() < duration:
+            self.draw()
+            self.win.flip()
+            remaining = duration - clock.getTime()
+            if redraw_every is not None:
+                remaining = min(remaining, redraw_every)
+            if wait_keys(check_keys, remaining, poller):
+                return
+
+    def _redraw_loop(self, check_keys, duration):
+        """Redraw the text every frame until a key or the duration."""
         clock = core.Clock()
         t = 0
         #Keep going for the duration
@@ -229,205 +739,3 @@ class WaitText(object):
             for key in event.getKeys(keyList=check_keys):
                 if key:
                     return
-
-
-def max_three_in_a_row(seq):
-    """Only allow sequences with 3 or fewer tokens in a row.
-
-    This assumes the tokens are represnted by integers in [0, 9].
-
-    """
-    seq_str = "".join(map(str, seq))
-    for item in np.unique(seq):
-        item_str = str(item)
-        check_str = "".join([item_str for i in range(4)])
-        if check_str in seq_str:
-            return False
-    return True
-
-
-def max_four_in_a_row(seq):
-    """Only allow sequences with 4 or fewer tokens in a row.
-
-    This assumes the tokens are represnted by integers in [0, 9].
-
-    """
-    seq_str = "".join(map(str, seq))
-    for item in np.unique(seq):
-        item_str = str(item)
-        check_str = "".join([item_str for i in range(5)])
-        if check_str in seq_str:
-            return False
-    return True
-
-
-def make_schedule(n_cat, n_total, max_repeat):
-    """Generate an event schedule subject to a repeat constraint."""
-
-    # Make the uniform transition matrix
-    ideal_tmat = [1 / n_cat] * n_cat
-    # Build the transition matrices for when we've exceeded our repeat limit
-    const_mat_list = []
-    for i in range(n_cat):
-        const_mat_list.append([1 / (n_cat - 1)] * n_cat)
-        const_mat_list[-1][i] = 0
-
-    # Convenience function to make the transitions
-    cat_range = np.arange(n_cat)
-    draw = lambda x: np.asscalar(cat_range[multinomial(1, x).astype(bool)])
-
-    # Generate the schedule
-    schedule = []
-    for i in xrange(n_total):
-        trailing_set = set(schedule[-max_repeat:])
-        # Check if we're at our repeat limit
-        if len(trailing_set) == 1:
-            tdist = const_mat_list[trailing_set.pop()]
-        else:
-            tdist = ideal_tmat
-        # Assign this iteration's state
-        schedule.append(draw(tdist))
-
-    return schedule
-
-
-def optimize_event_schedule(n_cat, n_total, max_repeat,
-                            n_search=1000, enforce_balance=False):
-    """Generate an event schedule optimizing CB1 and even conditions.
-
-    Parameters
-    ----------
-    n_cat: int
-        Total number of event types
-    n_total: int
-        Total number of events
-    max_repeat: int
-        Maximum number of event repetitions allowed
-    n_search: int
-        Size of the searc space
-    enforce_balance: bool
-        If true, raises a ValueError if event types are not balanced
-
-    Returns
-    -------
-    schedule: numpy array
-        Optimal event schedule with 0-based event ids
-
-    """
-    # Determine the idea transition matrix
-    ev_count = [n_total / n_cat] * n_cat
-    ideal = cb1_ideal(ev_count)
-
-    # Generate the space of schedules
-    schedules = []
-    bal_costs = np.zeros(n_search)
-    cb1_costs = np.zeros(n_search)
-    for i in xrange(n_search):
-        sched = make_schedule(n_cat, n_total, max_repeat)
-        schedules.append(sched)
-
-        # Determine balance cost
-        hist = np.histogram(sched, n_cat)[0]
-        bal_costs[i] = np.sum(np.abs(hist - hist.mean()))
-
-        # Determine CB1 cost
-        cb1_mat = cb1_prob(sched, ev_count)
-        cb1_costs[i] = cb1_cost(ideal, cb1_mat)
-
-    # Possibly error out if schedules are not balanced
-    if enforce_balance and bal_costs.min():
-        raise ValueError("Failed to generate balanced schedule")
-
-    # Zscore the two costs and sum
-    zscore = lambda x: (x - x.mean()) / x.std()
-    bal_costs = zscore(bal_costs)
-    cb1_costs = zscore(cb1_costs)
-    costs = bal_costs + cb1_costs
-
-    # Return the best schdule
-    return np.array(schedules[np.argmin(costs)])
-
-
-def cb1_optimize(ev_count, n_search=1000, constraint=None):
-    """Given event counts, return a first order counterbalanced schedule.
-
-    Note that this is a stupid brute force algorithm. It's bascially a Python
-    port of Doug Greve's C implementation of this in optseq with the addition
-    of a constraint option.
-
-    Inputs
-    ------
-    ev_count: sequence
-        desired number of appearences for each event t
-    constraint: callable
-        arbitrary function that takes a squence and returns a boolean
-    n_search: int
-        iterations of search algorithm
-
-    """
-    # Figure the total event count
-    ev_count = np.asarray(ev_count)
-    n_total = ev_count.sum()
-
-    # Set up a default constraint function
-    if constraint is None:
-        constraint = lambda x: True
-
-    # Create the ideal FOCB matrix
-    ideal = cb1_ideal(ev_count)
-
-    # Make an unordered schedule
-    sched_list = []
-    for i, n in enumerate(ev_count, 1):
-        sched_list.append(np.ones(n, int) * i)
-    sched = np.hstack(sched_list)
-
-    # Create n_search random schedules and pick the best one
-    sched_costs = np.zeros(n_search)
-    best_sched = sched
-    for i in xrange(n_search):
-        iter_sched = sched[permutation(int(n_total))]
-        if not constraint(iter_sched):
-            continue
-        iter_cb1_mat = cb1_prob(iter_sched, ev_count)
-        iter_cost = cb1_cost(ideal, iter_cb1_mat)
-        sched_costs[i] = iter_cost
-        if (not i) or (cb1_cost == sched_costs[:i].min()):
-            best_sched = iter_sched
-
-    # Make sure we could permute
-    if np.array_equal(best_sched, sched):
-        raise ValueError("Could not satisfy constraint")
-
-    return best_sched
-
-
-def cb1_ideal(ev_count):
-    """Calculate the ideal FOCB matrix"""
-    n_events = len(ev_count)
-    ideal = np.zeros((n_events, n_events))
-    ideal[:] = ev_count / np.sum(ev_count)
-    return ideal
-
-
-def cb1_prob(sched, ev_count):
-    """Calculate the empirical FOCB matrix from a schedule."""
-    n_events = len(ev_count)
-    cb_mat = np.zeros((n_events, n_events))
-    for i, event in enumerate(sched[:-1]):
-        next_event = sched[i + 1]
-        cb_mat[event - 1, next_event - 1] += 1
-
-    for i, count in enumerate(ev_count):
-        cb_mat[i] /= count
-
-    return cb_mat
-
-
-def cb1_cost(ideal_mat, test_mat):
-    """Calculate the error between ideal and empirical FOCB matricies."""
-    cb1err = np.abs(ideal_mat - test_mat)
-    cb1err /= ideal_mat
-    cb1err = cb1err.sum()
-    cb1err /= ideal_mat.shape[0] ** 2
-    return cb1err
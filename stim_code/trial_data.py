@@ -0,0 +1,326 @@
+"""Buffered writer for trial data with a binary columnar copy.
+
+Trial records have a fixed schema and go into a preallocated structured
+array. Nothing touches the disk until the buffer is flushed, which the
+experiment does at points where a little I/O can't disturb stimulus timing.
+A flush appends the buffered rows to the CSV file in one write and appends
+the raw records to a .npy file next to it.
+
+The .npy header is written with room to spare, and after each flush it is
+rewritten with the new number of rows. The file is therefore always a valid
+array of every flushed trial, so a session's data loads without parsing
+(and can be memory-mapped). If the program dies between appending records
+and updating the header, recover_trials fixes the header from the file size.
+
+With an AsyncWriter, the flushes (and any other file writes handed to it)
+run on a background thread, so the experiment only pays for copying the
+buffered records onto a queue.
+
+"""
+from __future__ import division
+import os
+import os.path as op
+import sys
+import time
+import atexit
+import threading
+from Queue import Queue, Full, Empty
+import numpy as np
+from numpy.lib import format as npy_format
+
+# Writers that haven't been closed yet, which are drained at exit
+_open_writers = set()
+
+
+def _npy_header(dtype, n_rows):
+    """Return a .npy (version 1.0) header for n_rows records.
+
+    The length depends only on the dtype, with room for a 20 digit row
+    count, so the header can be rewritten in place as rows are added.
+
+    """
+    text = "{'descr': %r, 'fortran_order': False, 'shape': (%%s,), }" % (
+        npy_format.dtype_to_descr(dtype),)
+    prefix = npy_format.MAGIC_PREFIX + b"\x01\x00"
+
+    # Pad so the data starts on a 64 byte boundary
+    full_len = len(prefix) + 2 + len(text % ("0" * 20)) + 1
+    full_len = -(-full_len // 64) * 64
+    header = text % n_rows
+    header += " " * (full_len - len(prefix) - 2 - len(header) - 1) + "\n"
+    return prefix + np.array(len(header), "<u2").tobytes() + header.encode()
+
+
+class AsyncWriter(object):
+    """Runs file writing jobs in order on a background thread.
+
+    Jobs go through a bounded queue. The thread takes whatever jobs are
+    waiting (up to batch_size), runs them, and then flushes each file the
+    jobs returned once for the whole batch. Submitting only blocks when the
+    queue is full, which is counted as a stall.
+
+    """
+    def __init__(self, max_queue=256, batch_size=32):
+        """Start the writer thread.
+
+        Parameters
+        ----------
+        max_queue: int
+            jobs that can be waiting before submitting blocks
+        batch_size: int
+            most jobs to run between file flushes
+
+        """
+        self.queue = Queue(max_queue)
+        self.batch_size = batch_size
+        self.error = None
+
+        # Queue statistics
+        self.n_jobs = 0
+        self.n_stalls = 0
+        self.max_depth = 0
+        self.latencies = []
+
+        self._closed = False
+        self.thread = threading.Thread(target=self._run, name="AsyncWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Drain the queue even if the experiment exits from a quit key
+        _open_writers.add(self)
+
+    def call(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to run on the writer thread.
+
+        func can return a file object or a list of them to be flushed at
+        the end of its batch.
+
+        """
+        if self._closed:
+            raise ValueError("Writer is closed")
+        job = (time.time(), func, args, kwargs)
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            self.n_stalls += 1
+            self.queue.put(job)
+        self.n_jobs += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def write(self, fid, text):
+        """Queue text to be written to an open file."""
+        self.call(_write_text, fid, text)
+
+    def close_file(self, fid):
+        """Queue a flush, fsync and close of an open file."""
+        self.call(_sync_file, fid)
+
+    def sync(self):
+        """Wait for every queued job to finish.
+
+        Raises any error that a job hit on the writer thread.
+
+        """
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        """Finish the queued jobs and stop the thread."""
+        if self._closed:
+            return
+        self._closed = True
+        _open_writers.discard(self)
+        self.queue.put(None)
+        self.thread.join()
+        self.sync()
+
+    def stats(self):
+        """Summarize the queue depth, latency (in seconds) and stalls."""
+        latencies = np.array(self.latencies or [0])
+        return dict(n_jobs=self.n_jobs,
+                    n_stalls=self.n_stalls,
+                    max_depth=self.max_depth,
+                    mean_latency=latencies.mean(),
+                    max_latency=latencies.max())
+
+    def _run(self):
+        """Take batches of jobs off the queue until told to stop."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            to_flush = []
+            for job in batch:
+                if job is None:
+                    running = False
+                    continue
+                submitted, func, args, kwargs = job
+                try:
+                    fids = func(*args, **kwargs)
+                    if fids is not None:
+                        to_flush.extend(fids if isinstance(fids, list)
+                                        else [fids])
+                except Exception:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+                self.latencies.append(time.time() - submitted)
+
+            for fid in to_flush:
+                try:
+                    if not fid.closed:
+                        fid.flush()
+                except Exception:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+
+            for job in batch:
+                self.queue.task_done()
+
+
+def _write_text(fid, text):
+    fid.write(text)
+    return fid
+
+
+def _sync_file(fid):
+    """Flush a file all the way to the disk and close it."""
+    fid.flush()
+    os.fsync(fid.fileno())
+    fid.close()
+
+
+def _close_open_writers():
+    """Finish the jobs of every writer still open when Python exits."""
+    for writer in list(_open_writers):
+        writer.close()
+
+
+atexit.register(_close_open_writers)
+
+
+class TrialWriter(object):
+    """Collects trial records and writes them to CSV and .npy files."""
+    def __init__(self, fid, fields, buffer_size=32, writer=None):
+        """Start the binary file and write the CSV column header.
+
+        Parameters
+        ----------
+        fid: open file
+            text data file, possibly with comment lines already written;
+            the .npy file goes next to it with the same base name
+        fields: list of (name, dtype) pairs
+            schema of each trial record
+        buffer_size: int
+            records to hold before a flush happens on its own
+        writer: AsyncWriter, optional
+            do the file writes on this writer's thread
+
+        """
+        self.fid = fid
+        self.writer = writer
+        self.dtype = np.dtype(fields)
+        self.names = self.dtype.names
+        self.buffer = np.zeros(buffer_size, self.dtype)
+        self.n_buffered = 0
+        self.n_written = 0
+
+        self.npy_fname = op.splitext(fid.name)[0] + ".npy"
+        self.npy_fid = open(self.npy_fname, "wb")
+        self._do(self._write_header)
+
+    def write(self, *values):
+        """Add a trial record with values in schema order."""
+        if self.n_buffered == len(self.buffer):
+            self.flush()
+        self.buffer[self.n_buffered] = values
+        self.n_buffered += 1
+
+    def flush(self):
+        """Write the buffered records out to both files."""
+        if not self.n_buffered:
+            return
+        rows = self.buffer[:self.n_buffered]
+        if self.writer is not None:
+            rows = rows.copy()
+        self.n_written += self.n_buffered
+        self.n_buffered = 0
+        self._do(self._write_rows, rows, self.n_written)
+
+    def close(self):
+        """Flush any remaining records and sync and close the files.
+
+        With an AsyncWriter this only queues the work; the data is on disk
+        once the writer has been synced.
+
+        """
+        try:
+            self.flush()
+        finally:
+            self._do(_sync_file, self.npy_fid)
+            self._do(_sync_file, self.fid)
+
+    def _do(self, func, *args):
+        """Run a file job here or on the writer thread."""
+        if self.writer is None:
+            fids = func(*args)
+            for fid in fids or []:
+                fid.flush()
+        else:
+            self.writer.call(func, *args)
+
+    def _write_header(self):
+        self.npy_fid.write(_npy_header(self.dtype, 0))
+        self.fid.write(",".join(self.names) + "\n")
+        return [self.npy_fid, self.fid]
+
+    def _write_rows(self, rows, n_written):
+        lines = [",".join("%s" % v for v in row) for row in rows.tolist()]
+        self.fid.write("\n".join(lines) + "\n")
+
+        # Append the records before updating the count in the header
+        self.npy_fid.write(rows.tobytes())
+        self.npy_fid.flush()
+        self.npy_fid.seek(0)
+        self.npy_fid.write(_npy_header(self.dtype, n_written))
+        self.npy_fid.seek(0, os.SEEK_END)
+        return [self.npy_fid, self.fid]
+
+
+def load_trials(fname, mmap_mode="r"):
+    """Load the records for a data file as a structured array.
+
+    fname can be the CSV data file or the .npy file itself.
+
+    """
+    npy_fname = op.splitext(fname)[0] + ".npy"
+    return np.load(npy_fname, mmap_mode=mmap_mode)
+
+
+def recover_trials(fname):
+    """Repair the .npy file of a session that ended without closing.
+
+    Whole records past the count in the header are taken into it and a
+    partly written record at the end is dropped. Returns the number of
+    records in the repaired file.
+
+    """
+    npy_fname = op.splitext(fname)[0] + ".npy"
+    with open(npy_fname, "r+b") as fid:
+        npy_format.read_magic(fid)
+        _, _, dtype = npy_format.read_array_header_1_0(fid)
+        data_start = fid.tell()
+        fid.seek(0, os.SEEK_END)
+        n_rows = (fid.tell() - data_start) // dtype.itemsize
+        fid.truncate(data_start + n_rows * dtype.itemsize)
+        header = _npy_header(dtype, n_rows)
+        if len(header) == data_start:
+            fid.seek(0)
+            fid.write(header)
+    return n_rows